@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+"""Benchmarks for building, packing and serializing HyperScale batches
+
+Runs synthetic workloads through Batch.add_upsert, Batch.parts() and the part serialization, and reports
+the throughput of each stage, the peak memory, the number of parts and how the part sizes the packer
+estimated compare to the actual request bodies. Results can be saved as a baseline, and later runs compared
+against it:
+
+    python benchmarks/tagging_benchmark.py --sizes 10k,100k --save-baseline baseline.json
+    (make a change)
+    python benchmarks/tagging_benchmark.py --sizes 10k,100k --compare baseline.json
+
+Nothing is sent to the server."""
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from kentikapi.v5 import tagging
+
+
+# a guid of the usual size, to serialize the parts with
+_guid = '0c6f8d4e-3a2b-4c1d-9e8f-7a6b5c4d3e2f'
+
+
+def _ipv4(rng):
+    return '%d.%d.%d.%d' % (rng.randrange(1, 224), rng.randrange(256), rng.randrange(256), rng.randrange(256))
+
+
+def _ipv6(rng):
+    return '2001:db8:%x:%x::%x' % (rng.randrange(65536), rng.randrange(65536), rng.randrange(65536))
+
+
+def _many_values_ipv4(rng, populators):
+    """Every populator has its own value, with a criteria matching an IPv4 address and a port"""
+    for i in range(populators):
+        crit = tagging.Criteria('src')
+        crit.add_ip_address(_ipv4(rng))
+        crit.add_port(rng.randrange(65536))
+        yield 'value_%d' % i, crit
+
+
+def _few_values_ipv4(rng, populators):
+    """100 values, each with many criteria matching IPv4 prefixes and port ranges"""
+    for i in range(populators):
+        crit = tagging.Criteria('dst')
+        crit.add_ip_address(_ipv4(rng) + '/32')
+        start = rng.randrange(65000)
+        crit.add_port_range(start, start + rng.randrange(500))
+        yield 'value_%d' % (i % 100), crit
+
+
+def _many_values_ipv6(rng, populators):
+    """Every populator has its own value, with a criteria matching two IPv6 addresses"""
+    for i in range(populators):
+        crit = tagging.Criteria('either')
+        crit.add_ip_address(_ipv6(rng))
+        crit.add_ip_address(_ipv6(rng))
+        yield 'value_%d' % i, crit
+
+
+def _few_values_ipv6(rng, populators):
+    """100 values, each with many criteria matching IPv6 prefixes"""
+    for i in range(populators):
+        crit = tagging.Criteria('src')
+        crit.add_ip_address(_ipv6(rng) + '/64')
+        yield 'value_%d' % (i % 100), crit
+
+
+def _mixed(rng, populators):
+    """10,000 values with criteria using most fields: addresses, ports, ASNs, protocols and strings"""
+    for i in range(populators):
+        crit = tagging.Criteria(rng.choice(['src', 'dst', 'either']))
+        crit.add_ip_address(_ipv4(rng))
+        crit.add_port(rng.randrange(65536))
+        crit.add_asn_range(64512, 64512 + rng.randrange(1000))
+        crit.add_protocol(rng.choice([6, 17]))
+        crit.add_site_name('site_%d' % rng.randrange(50))
+        crit.add_country_code(rng.choice(['US', 'DE', 'JP', 'BR']))
+        yield 'value_%d' % (i % 10000), crit
+
+
+_workloads = [
+    ('many_values_ipv4', _many_values_ipv4),
+    ('few_values_ipv4', _few_values_ipv4),
+    ('many_values_ipv6', _many_values_ipv6),
+    ('few_values_ipv6', _few_values_ipv6),
+    ('mixed', _mixed),
+]
+
+
+def _build(workload, populators, seed, canonicalize):
+    batch = tagging.Batch(True, canonicalize=canonicalize)
+    for value, crit in workload(random.Random(seed), populators):
+        batch.add_upsert(value, crit)
+    return batch
+
+
+def _serialize(parts, compression):
+    return [tagging._SerializedPart(part, compression).request(_guid)[1] for part in parts]
+
+
+def _timed(f, *args, **kwargs):
+    """Call f, returning its result and how long it took
+
+    Quick calls are repeated for at least _minTime seconds, returning the fastest time, since
+    timing a single call of a few milliseconds is mostly noise."""
+    best = None
+    total = 0
+    while total < _minTime:
+        start = time.perf_counter()
+        result = f(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+_minTime = 0.2
+
+
+def run_benchmark(name, workload, populators, seed=1, compression=None, canonicalize=False, memory=True, repeat=3):
+    """Run one workload, returning a dict of its results
+
+    Each stage is timed 'repeat' times, keeping the fastest time."""
+    result = {'workload': name, 'populators': populators, 'compression': compression,
+              'canonicalize': canonicalize}
+
+    # the few_values workloads give a value more criteria than fit in a part at 1m populators and up - split them
+    times = []
+    for _ in range(repeat):
+        batch = parts = bodies = None
+        gc.collect()
+        batch, build_time = _timed(_build, workload, populators, seed, canonicalize)
+        parts, parts_time = _timed(batch.parts, compression=compression, split_values=True)
+        bodies, serialize_time = _timed(_serialize, parts, compression)
+        times.append((build_time, parts_time, serialize_time))
+
+    build_time, parts_time, serialize_time = [min(stage_times) for stage_times in zip(*times)]
+    result['build_per_sec'] = populators / build_time
+    result['parts_per_sec'] = populators / parts_time
+    result['serialize_per_sec'] = populators / serialize_time
+    result['total_per_sec'] = populators / (build_time + parts_time + serialize_time)
+
+    # the packer tracks each part's size as it fills it - compare that with the bodies actually sent
+    result['parts'] = len(parts)
+    result['body_bytes'] = sum(len(body) for body in bodies)
+    result['max_body_bytes'] = max(len(body) for body in bodies)
+    result['max_size_error'] = max(abs(len(body) - part.packed_size) for part, body in zip(parts, bodies))
+    if compression is not None:
+        result['json_bytes'] = sum(part.json_size() for part in parts)
+    del batch, parts, bodies
+
+    if memory:
+        # tracing allocations slows everything down, so memory is measured in a run of its own
+        gc.collect()
+        tracemalloc.start()
+        batch = _build(workload, populators, seed, canonicalize)
+        result['batch_bytes'] = tracemalloc.get_traced_memory()[0]
+        _serialize(batch.parts(compression=compression, split_values=True), compression)
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del batch
+
+    return result
+
+
+# result fields where more is better, and where less is better - the others aren't compared
+_higherIsBetter = ['build_per_sec', 'parts_per_sec', 'serialize_per_sec', 'total_per_sec']
+_lowerIsBetter = ['parts', 'body_bytes', 'batch_bytes', 'peak_bytes']
+
+
+def compare(baseline, results, threshold):
+    """Print how the results compare to the baseline, returning the regressions beyond threshold (a ratio)"""
+    baseline_by_key = dict((_result_key(r), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        previous = baseline_by_key.get(_result_key(result))
+        if previous is None:
+            continue
+        for field in _higherIsBetter + _lowerIsBetter:
+            if field not in result or field not in previous or previous[field] == 0:
+                continue
+            change = float(result[field]) / previous[field] - 1
+            worse = change < -threshold if field in _higherIsBetter else change > threshold
+            marker = ' REGRESSION' if worse else ''
+            print('%-50s %-18s %14s -> %14s %+7.1f%%%s' % (_describe(result), field, _format(previous[field]),
+                                                          _format(result[field]), change * 100, marker))
+            if worse:
+                regressions.append((_describe(result), field, change))
+    return regressions
+
+
+def _result_key(result):
+    return result['workload'], result['populators'], result['compression'], result['canonicalize']
+
+
+def _describe(result):
+    description = '%s/%d' % (result['workload'], result['populators'])
+    if result['compression'] is not None:
+        description += '/' + result['compression']
+    if result['canonicalize']:
+        description += '/canonical'
+    return description
+
+
+def _format(n):
+    if isinstance(n, float):
+        return '%.0f' % n
+    return str(n)
+
+
+def _print_result(result):
+    print('%s: %d parts' % (_describe(result), result['parts']))
+    print('  populators/s: build %.0f, parts %.0f, serialize %.0f, total %.0f'
+          % (result['build_per_sec'], result['parts_per_sec'], result['serialize_per_sec'], result['total_per_sec']))
+    line = '  bytes: sent %d, largest body %d' % (result['body_bytes'], result['max_body_bytes'])
+    if 'json_bytes' in result:
+        line += ', uncompressed %d' % result['json_bytes']
+    if 'max_size_error' in result:
+        line += ', largest estimate error %d' % result['max_size_error']
+    print(line)
+    if 'peak_bytes' in result:
+        print('  memory: batch %.1f MB, peak %.1f MB' % (result['batch_bytes'] / 1e6, result['peak_bytes'] / 1e6))
+
+
+def _parse_size(size):
+    """Parse a number of populators like '10k' or '5m'"""
+    multiplier = {'k': 1000, 'm': 1000000}.get(size[-1:].lower(), 1)
+    if multiplier != 1:
+        size = size[:-1]
+    return int(float(size) * multiplier)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark building, packing and serializing tagging batches')
+    parser.add_argument('--sizes', default='10k,100k,1m',
+                        help='comma-separated numbers of populators per workload (eg. 10k,1m,5m)')
+    parser.add_argument('--workloads', default=','.join(name for name, _ in _workloads),
+                        help='comma-separated workloads to run')
+    parser.add_argument('--compression', choices=['gzip', 'deflate'], help='compress the parts')
+    parser.add_argument('--canonicalize', action='store_true', help='build canonicalizing batches')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic workloads')
+    parser.add_argument('--repeat', type=int, default=3, help='times to run each workload, keeping the fastest')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure memory (faster)")
+    parser.add_argument('--save-baseline', metavar='PATH', help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare the results with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change beyond which a comparison is a regression (default 0.1)')
+    args = parser.parse_args(argv)
+
+    workloads = dict(_workloads)
+    names = args.workloads.split(',')
+    for name in names:
+        if name not in workloads:
+            parser.error('unknown workload %s - valid: %s' % (name, ', '.join(n for n, _ in _workloads)))
+
+    results = []
+    for populators in [_parse_size(size) for size in args.sizes.split(',')]:
+        for name in names:
+            result = run_benchmark(name, workloads[name], populators, seed=args.seed,
+                                   compression=args.compression, canonicalize=args.canonicalize,
+                                   memory=not args.no_memory, repeat=args.repeat)
+            _print_result(result)
+            results.append(result)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                       'results': results}, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(baseline, results, args.threshold)
+        if len(regressions) > 0:
+            print('\n%d regressions beyond %.0f%%' % (len(regressions), args.threshold * 100))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
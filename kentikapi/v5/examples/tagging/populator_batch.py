@@ -1,12 +1,7 @@
 #!/usr/bin/env python
 
-from __future__ import print_function
-from builtins import str
-from builtins import map
-from builtins import range
 from kentikapi.v5 import tagging
 import random
-import time
 
 
 #
@@ -38,6 +33,7 @@ batch = tagging.Batch(True)
 
 crit = tagging.Criteria("dst")
 # NOTE: this is an invalid IP address - status response reports this
+# (with tagging.Batch(True, validation='strict'), add_upsert would raise ValueError for it instead)
 crit.add_ip_address("abcdefg")
 batch.add_upsert("src_ip1", crit)
 
@@ -193,13 +189,12 @@ client = tagging.Client(option_api_email, option_api_token)
 guid = client.submit_populator_batch(option_custom_dimension, batch)
 
 # wait up to 60 seconds for the batch to finish:
-for x in range(1, 12):
-    time.sleep(5)
-    status = client.fetch_batch_status(guid)
-    if status.is_finished():
-        print("is_finished: %s" % str(status.is_finished()))
-        print("upsert_error_count: %s" % str(status.invalid_upsert_count()))
-        print("delete_error_count: %s" % str(status.invalid_delete_count()))
-        print()
-        print(status.pretty_response())
-        break
+try:
+    status = client.wait_for_batches([guid], timeout=60)[0]
+    print("is_finished: %s" % str(status.is_finished()))
+    print("upsert_error_count: %s" % str(status.invalid_upsert_count()))
+    print("delete_error_count: %s" % str(status.invalid_delete_count()))
+    print()
+    print(status.pretty_response())
+except TimeoutError:
+    print("batch %s didn't finish in 60 seconds" % guid)
@@ -1,112 +1,503 @@
 #!/usr/bin/env python
 
-from __future__ import print_function
-from builtins import str
-from builtins import object
+from array import array
+import binascii
+from collections import deque, OrderedDict
+from concurrent.futures import as_completed, FIRST_COMPLETED, ThreadPoolExecutor, wait
+import email.utils
+import hashlib
 import json
+import logging
+import mmap
+import os
+import random
+import re
+import socket
+import struct
+import threading
+import time
+import zlib
 
 import requests
+import requests.adapters
 
 
 """HyperScale Tagging API client"""
 _allowedCustomDimensionChars = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+_compressionWbits = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+_retryStatusCodes = set([429, 500, 502, 503, 504])
+_logger = logging.getLogger(__name__)
 
 
 class Batch(object):
-    """Batch collects tags or populators as values and criteria."""
+    """Batch collects tags or populators as values and criteria.
 
-    def __init__(self, replace_all):
+    With canonicalize True, each value's criteria are canonicalized before they're sent: see
+    Criteria.canonicalize(). Criteria of a value that only differ in a single field are also merged
+    into one criteria, and duplicate criteria are dropped.
+
+    With validation 'strict', adding a criteria with a value Kentik would reject (see Criteria.invalid_values())
+    raises ValueError. With 'lenient', the criteria is left out of the batch instead, and the errors are
+    collected per value in validation_errors."""
+
+    def __init__(self, replace_all, canonicalize=False, validation=None):
+        _check_validation(validation)
         self.replace_all = replace_all
-        self.lower_val_to_val = dict()  # keeps track of the value casing passed in
-        self.upserts = dict()
-        self.upserts_size = dict()   # keep track of json str size per value
-        self.deletes = set()
+        self.canonicalize = canonicalize
+        self.validation = validation
+        self.validation_errors = dict()   # value -> list of error messages, with lenient validation
+        self.deletes = dict()   # lower-cased value -> value as passed in, to delete
+        # there can be millions of values, so each takes as little memory as it can: one entry per value, keyed
+        # by the lower-cased value, with the JSON-encoded criteria - on its own if it's the value's only criteria,
+        # or a list of them (None until there's one). Only the casing of values that aren't lower-case is kept
+        self._upserts = dict()
+        self._casing = dict()   # lower-cased value -> value as passed in, for values that aren't lower-case
+        # each distinct encoded criteria is held once, however many values (and Criteria objects) share it -
+        # unless hardly any are shared, and the table would only cost memory
+        self._fragments = dict()
+        self._fragments_added = 0
+        self._criteria = dict()            # when canonicalizing: Criteria per value, merged as they're encoded
+        self._canonical_encoded = dict()   # when canonicalizing: JSON-encoded merged criteria per value
 
     def add_upsert(self, value, criteria):
         """Add a tag or populator to the batch by value and criteria"""
 
         value = value.strip()
-        v = value.lower()
-        self.lower_val_to_val[v] = value
-        criteria_array = self.upserts.get(v)
-        if criteria_array is None:
+        if not _check_criteria(self.validation, self.validation_errors, value, criteria):
+            return
+        v = self._add_value(value)
+
+        if self.canonicalize:
+            # keep a copy to merge with the value's other criteria, once they're all in
+            self._criteria.setdefault(v, []).append(criteria._copy())
+            self._canonical_encoded.pop(v, None)
+            return
+
+        # the criteria is encoded here, once - parts are built by concatenating the encoded criteria
+        self._add_criteria(v, self._intern(criteria.encode()))
+
+    def _add_encoded_upsert(self, value, encoded_criteria):
+        """Add an upsert whose criteria are already JSON-encoded - they're never canonicalized"""
+        v = self._add_value(value)
+        for encoded in encoded_criteria:
+            self._add_criteria(v, self._intern(encoded))
+
+    def _intern(self, encoded):
+        """Return the batch's copy of an encoded criteria, adding it if it's the first"""
+        if self._fragments is None:
+            return encoded
+        encoded = self._fragments.setdefault(encoded, encoded)
+        self._fragments_added += 1
+        if len(self._fragments) == _internCheckSize and self._fragments_added < _internCheckSize * 5 // 4:
+            # fewer than one in five criteria were repeats - stop interning
+            self._fragments = None
+        return encoded
+
+    def _add_value(self, value):
+        """Add an upserted value if it's new, returning its lower-cased key - the latest casing is kept"""
+        v = _value_key(value)
+        if v is value:
+            if len(self._casing) > 0:
+                self._casing.pop(v, None)
+        else:
+            self._casing[v] = value
+        if v not in self._upserts:
+            self._upserts[v] = None
+        return v
+
+    def _add_criteria(self, v, encoded):
+        criteria = self._upserts[v]
+        if criteria is None:
+            self._upserts[v] = encoded
+        elif isinstance(criteria, list):
+            criteria.append(encoded)
+        else:
+            # appended one at a time, the list grows like it would from empty - a literal over-allocates more
             criteria_array = []
-            # start with # '{"value": "some_value", "criteria": []}, '
-            self.upserts_size[v] = 31 + len(value)
-        criteria_array.append(criteria.to_dict())
-        self.upserts[v] = criteria_array
-        self.upserts_size[v] += criteria.json_size()
+            criteria_array.append(criteria)
+            criteria_array.append(encoded)
+            self._upserts[v] = criteria_array
+
+    def _iter_upserts(self):
+        """Yield (value, list of JSON-encoded criteria) for each upserted value"""
+        for v, criteria in self._upserts.items():
+            if criteria is None:
+                criteria_array = []
+            elif isinstance(criteria, list):
+                criteria_array = criteria
+            else:
+                criteria_array = [criteria]
+            if v in self._criteria:
+                criteria_array = self._canonical_criteria(v) + criteria_array
+            yield self._casing.get(v, v), criteria_array
+
+    def _canonical_criteria(self, v):
+        """Return the JSON-encoded, canonicalized and merged criteria added for a value"""
+        encoded = self._canonical_encoded.get(v)
+        if encoded is None:
+            criteria_list = _merge_criteria(self._criteria[v])
+            self._criteria[v] = criteria_list
+            encoded = self._canonical_encoded[v] = [self._intern(criteria.encode()) for criteria in criteria_list]
+        return encoded
 
     def add_delete(self, value):
         """Delete a tag or populator by value - these are processed before upserts"""
 
         value = value.strip()
-        v = value.lower()
-        self.lower_val_to_val[v] = value
-        if len(v) == 0:
+        if len(value) == 0:
             raise ValueError("Invalid value for delete. Value is empty.")
 
-        self.deletes.add(v)
-
-    def parts(self):
-        """Return an array of batch parts to submit"""
-
-        parts = []
-
-        upserts = dict()
-        deletes = []
+        self.deletes[_value_key(value)] = value
 
-        # we keep track of the batch size as we go (pretty close approximation!) so we can chunk it small enough
-        # to limit the HTTP posts to under 700KB - server limits to 750KB, so play it safe
-        max_upload_size = 700000
+    def parts(self, max_upload_size=700000, compression=None, max_open_parts=64, split_values=False):
+        """Return an array of batch parts to submit
 
-        # loop upserts first - fit the deletes in afterward
-        # '{"replace_all": true, "complete": false, "guid": "6659fbfc-3f08-42ee-998c-9109f650f4b7", "upserts": [], "deletes": []}'
-        base_part_size = 118
-        if not self.replace_all:
-            base_part_size += 1  # yeah, this is totally overkill :)
+        Each part is kept under max_upload_size bytes. If compression is 'gzip' or 'deflate',
+        the limit applies to the compressed request body, so parts are packed with
+        much more data.
+        Records are packed biggest first, each into the first of up to max_open_parts parts being
+        filled that has room for it, so the small records fill the room the big ones leave.
+        A value too big for one part raises a ValueError - unless split_values is True, when its
+        criteria are split into upserts in separate parts. Only split values for a server that combines
+        the upserts of a value across parts: otherwise the last of them wins."""
 
-        part_size = base_part_size
-        for value in self.upserts:
-            if (part_size + self.upserts_size[value]) >= max_upload_size:
-                # this record would put us over the limit - close out the batch part and start a new one
-                parts.append(BatchPart(self.replace_all, upserts, deletes))
-                upserts = dict()
-                deletes = []
-                part_size = base_part_size
+        if compression is not None and compression not in _compressionWbits:
+            raise ValueError("Invalid compression. Valid: %s." % ', '.join(sorted(_compressionWbits)))
 
-            # for the new upserts dict, drop the lower-casing of value
-            upserts[self.lower_val_to_val[value]] = self.upserts[value]
-            part_size += self.upserts_size[value]    # updating the approximate size of the batch
+        # part sizes are exact, so we can chunk the batch to limit the HTTP posts to under 700KB by default -
+        # server limits to 750KB, so play it safe
+        room = max_upload_size - BatchPart.base_json_size(self.replace_all)
 
-        for value in self.deletes:
-            # delete adds length of string plus quotes, comma and space
-            if (part_size + len(value) + 4) >= max_upload_size:
-                parts.append(BatchPart(self.replace_all, upserts, deletes))
-                upserts = dict()
-                deletes = []
-                part_size = base_part_size
-
-            # for the new deletes set, drop the lower-casing of value
-            deletes.append({'value': self.lower_val_to_val[value]})
-            part_size += len(value) + 4
-
-        if len(upserts) + len(deletes) > 0:
-            # finish the batch
-            parts.append(BatchPart(self.replace_all, upserts, deletes))
+        upserts = []
+        for value, criteria_array in self._iter_upserts():
+            fragment = _encode_upsert(value, criteria_array)
+            if len(fragment) <= room:
+                upserts.append((fragment, None))
+                continue
+            fragments = _split_upsert(self.replace_all, value, criteria_array, max_upload_size, compression,
+                                      split_values)
+            split_value = value.lower() if len(fragments) > 1 else None
+            upserts.extend((fragment, split_value) for fragment in fragments)
+        # for the new deletes, drop the lower-casing of value
+        deletes = [_encode_delete(value) for value in self.deletes.values()]
+
+        # once the biggest record is a tiny fraction of a part, packing in order already fills
+        # every part to the brim - only sort, and fill several parts at once, when it makes a difference
+        sizes = [len(fragment) for fragment, _ in upserts] + [len(fragment) for fragment in deletes]
+        if len(sizes) > 0 and max(sizes) * 100 > max_upload_size:
+            upserts.sort(key=lambda upsert: len(upsert[0]), reverse=True)
+            deletes.sort(key=len, reverse=True)
+        else:
+            max_open_parts = 1
+        packer = _FirstFitPacker(self.replace_all, max_upload_size, compression, max_open_parts)
+        if len(sizes) > 0:
+            packer.smallest = min(sizes)
+
+        # upserts first - fit the deletes in afterward
+        for fragment, split_value in upserts:
+            packer.add_upsert(fragment, split_value)
+        for fragment in deletes:
+            packer.add_delete(fragment)
+        parts = packer.finish()
 
         if len(parts) == 0:
             if not self.replace_all:
                 raise ValueError("Batch has no data, and 'replace_all' is False")
-            parts.append(BatchPart(self.replace_all, dict(), []))
+            parts.append(_PartPacker(self.replace_all, max_upload_size, compression).finish())
 
         # last part finishes the batch
         parts[-1].set_last_part()
         return parts
 
+    def write_spool(self, path, max_upload_size=700000, compression=None, split_values=False):
+        """Write the batch's parts, serialized and ready to send, to a BatchSpool file - returns the part count
+
+        The parts are packed and compressed as by parts(), so the file can be uploaded later, or from another
+        host, with Client.submit_populator_spool() or submit_tag_spool(), without building anything again."""
+        batch_parts = self.parts(max_upload_size, compression=compression, split_values=split_values)
+        _write_spool(path, batch_parts, self.replace_all, max_upload_size, compression)
+        return len(batch_parts)
+
+
+# how many distinct criteria a batch interns before checking that interning pays off
+_internCheckSize = 10000
+
+
+def _value_key(value):
+    """Return the lower-cased value that identifies a value in a batch
+
+    A value that's already lower-case is its own key, so the batch holds a single string for it."""
+    v = value.lower()
+    return value if v == value else v
+
+
+def _encode_upsert(value, criteria_array):
+    """Return the JSON bytes of an upsert, given its value and its JSON-encoded criteria"""
+    return b''.join([b'{"value": ', _encode_value(value), b', "criteria": [',
+                     b', '.join(criteria_array), b']}'])
+
+
+def _split_upsert(replace_all, value, criteria_array, max_size, compression, split_values):
+    """Return the encoded upserts of a value: a single upsert if it fits in a part, or else - if split_values
+    is True - upserts each with some of its criteria"""
+    fragment = _encode_upsert(value, criteria_array)
+    room = max_size - BatchPart.base_json_size(replace_all)
+    if len(fragment) <= room:
+        return [fragment]
+    if compression is not None:
+        room = max_size - _PartPacker.compressed_slack
+        size = len(zlib.compress(fragment))
+        if size <= room:
+            return [fragment]
+    else:
+        size = len(fragment)
+
+    if not split_values:
+        raise ValueError("Invalid criteria for value %s. Its criteria don't fit in a batch part, "
+                         "and split_values is False." % value)
+    if len(criteria_array) == 1:
+        raise ValueError("Invalid criteria for value %s. A single criteria doesn't fit in a batch part." % value)
+
+    # split the criteria into pieces that should each fit - and split the pieces again if they don't
+    piece_size = sum(len(criteria) + 2 for criteria in criteria_array) // (size // room + 1)
+    fragments = []
+    piece = []
+    piece_size_so_far = 0
+    for criteria in criteria_array:
+        if len(piece) > 0 and piece_size_so_far + len(criteria) > piece_size:
+            fragments.extend(_split_upsert(replace_all, value, piece, max_size, compression, True))
+            piece = []
+            piece_size_so_far = 0
+        piece.append(criteria)
+        piece_size_so_far += len(criteria) + 2
+    fragments.extend(_split_upsert(replace_all, value, piece, max_size, compression, True))
+    return fragments
+
+
+def _encode_delete(value):
+    """Return the JSON bytes of a delete, given its value"""
+    return b'{"value": ' + _encode_value(value) + b'}'
+
+
+def _encode_value(value):
+    return json.dumps(value).encode('utf-8')
+
+
+class _PartPacker(object):
+    """Collects encoded upserts and deletes into a batch part, tracking its exact size as it's filled
+
+    Without compression, the size is the exact JSON size of the part. With compression, records are
+    run through a compressor as they're added: the compressed size is over-estimated until the part
+    gets close to the limit, and then the compressor is flushed to get the exact size."""
+
+    # room left for the compression header and trailer, and the part's JSON around the records
+    compressed_slack = 256
+
+    def __init__(self, replace_all, max_size, compression):
+        self.replace_all = replace_all
+        self.max_size = max_size
+        self.compression = compression
+        self.reset()
+
+    def reset(self):
+        """Start a new, empty part"""
+        self.upserts = []
+        self.deletes = []
+        self.split_values = set()   # values with criteria split across parts that have an upsert in this part
+        self.size = BatchPart.base_json_size(self.replace_all)
+        self._added_criteria = dict()   # index of an upsert -> encoded criteria added to it since it was added
+        self._estimated = False         # whether the compressed size is only an estimate, once records moved
+        if self.compression is not None:
+            self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                                _compressionWbits[self.compression])
+            self._compressed_size = self.compressed_slack
+            self._pending_size = 0   # uncompressed bytes added since the last flush
+
+    def is_empty(self):
+        return len(self.upserts) + len(self.deletes) == 0
+
+    def room(self):
+        """Return how many more bytes fit in the part - an under-estimate when compressing"""
+        if self.compression is None:
+            return self.max_size - self.size
+        return self.max_size - self._compressed_size - self._pending_size
+
+    def fits(self, fragment):
+        """Return whether an encoded record fits in the part - it always fits into an empty part"""
+        if self.is_empty():
+            return True
+
+        if self.compression is None:
+            return self.size + len(fragment) + 2 <= self.max_size   # record, comma and space
+
+        # data added since the last flush compresses to no more than its own size, give or take a few bytes
+        if self._compressed_size + self._pending_size + len(fragment) < self.max_size:
+            return True
+
+        # close to the limit - flush the compressor to find out how much room is really left
+        self._compressed_size += len(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._pending_size = 0
+        return self._compressed_size + len(fragment) < self.max_size
+
+    def add_upsert(self, fragment):
+        self._add(self.upserts, fragment)
+
+    def add_delete(self, fragment):
+        self._add(self.deletes, fragment)
+
+    def add_criteria(self, index, criteria_array):
+        """Add encoded criteria to the upsert at index - the upsert is re-encoded with them when the part is
+        finished, so a value given again and again is only encoded once"""
+        added = b', '.join(criteria_array)
+        self.size += len(added) + 2
+        self._added_criteria.setdefault(index, []).append(added)
+
+        if self.compression is not None:
+            # the compressor sees the criteria after the records that follow the upsert - close, but not exact
+            self._compressed_size += len(self._compressor.compress(b', ' + added))
+            self._pending_size += len(added) + 2
+            self._estimated = True
+
+    def pop_upsert(self, index):
+        """Remove the upsert at index from the part, and return it - the upserts after it move up one"""
+        self._apply_added_criteria()
+        fragment = self.upserts.pop(index)
+        self.size -= len(fragment) + (2 if len(self.upserts) > 0 else 0)
+        if self.compression is not None:
+            self._estimated = True   # the compressor still counts it
+        return fragment
+
+    def _apply_added_criteria(self):
+        for index, added in self._added_criteria.items():
+            upsert = self.upserts[index]
+            self.upserts[index] = b', '.join([upsert[:-2]] + added) + b']}'
+        self._added_criteria = dict()
+
+    def _add(self, fragments, fragment):
+        if len(fragments) > 0:
+            self.size += 2  # comma, space
+        self.size += len(fragment)
+        fragments.append(fragment)
+
+        if self.compression is not None:
+            self._compressed_size += len(self._compressor.compress(fragment))
+            self._compressed_size += len(self._compressor.compress(b', '))
+            self._pending_size += len(fragment) + 2
+
+    def finish(self):
+        """Return the collected records as a batch part, and start a new part"""
+        self._apply_added_criteria()
+        part = BatchPart(self.replace_all, self.upserts, self.deletes)
+        part.max_size = self.max_size
+        if self.compression is None:
+            part.packed_size = self.size
+        elif self._estimated:
+            # records were added out of order or removed - measure the part as it will be sent
+            part.packed_size = len(zlib.compress(part.build_json_prefix())) + self.compressed_slack
+        else:
+            self._compressed_size += len(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+            part.packed_size = self._compressed_size
+        self.reset()
+        return part
+
+
+class _FirstFitPacker(object):
+    """Packs records into batch parts, each into the first part being filled that has room for it
+
+    Up to max_open parts are filled at once. Parts without room for the smallest record are finished
+    as soon as they're found, and when none of the others has room for a record, the fullest one is
+    finished to make room for a new part. Upserts with the criteria of a split value are never put in
+    the same part."""
+
+    def __init__(self, replace_all, max_size, compression, max_open):
+        if max_open < 1:
+            raise ValueError("Invalid max_open_parts. Must be at least 1.")
+        self.replace_all = replace_all
+        self.max_size = max_size
+        self.compression = compression
+        self.max_open = max_open
+        self.smallest = 0   # size of the smallest record to be added
+        self.parts = []
+        self._open = []
+
+    def add_upsert(self, fragment, split_value=None):
+        packer = self._packer_for(fragment, split_value)
+        packer.add_upsert(fragment)
+        if split_value is not None:
+            packer.split_values.add(split_value)
+
+    def add_delete(self, fragment):
+        self._packer_for(fragment, None).add_delete(fragment)
+
+    def _packer_for(self, fragment, split_value):
+        """Return the first open part the record fits in, opening a new part if there's none"""
+        for packer in list(self._open):
+            if split_value in packer.split_values:
+                continue
+            if packer.fits(fragment):
+                return packer
+            if packer.room() < self.smallest + 2:
+                self._open.remove(packer)
+                self.parts.append(packer.finish())
+
+        if len(self._open) < self.max_open:
+            packer = _PartPacker(self.replace_all, self.max_size, self.compression)
+        else:
+            # the fullest part is least likely to take more records - finish it, and reuse its packer
+            packer = min(self._open, key=lambda p: p.room())
+            self._open.remove(packer)
+            self.parts.append(packer.finish())
+        self._open.append(packer)
+        return packer
+
+    def finish(self):
+        """Return all parts, finishing the ones still being filled"""
+        self.parts.extend(packer.finish() for packer in self._open if not packer.is_empty())
+        self._open = []
+        return self.parts
+
+
+def _resplit_part(batch_part, max_size, compression, split_values=False):
+    """Return the records of a batch part packed into parts of up to max_size bytes
+
+    Upserts too big for the new parts are split if split_values is True, and otherwise put in a part of
+    their own. The last of the parts completes the batch if the original part did."""
+    packer = _FirstFitPacker(batch_part.replace_all, max_size, compression, 1)
+    room = max_size - BatchPart.base_json_size(batch_part.replace_all)
+    for fragment in batch_part.upserts:
+        if len(fragment) <= room or not split_values:
+            packer.add_upsert(fragment)
+            continue
+        upsert = json.loads(fragment.decode('utf-8'))
+        fragments = _split_upsert(batch_part.replace_all, upsert['value'],
+                                  [_encode_value(criteria) for criteria in upsert['criteria']], max_size, compression,
+                                  True)
+        split_value = upsert['value'].lower() if len(fragments) > 1 else None
+        for fragment in fragments:
+            packer.add_upsert(fragment, split_value)
+    for fragment in batch_part.deletes:
+        packer.add_delete(fragment)
+
+    parts = packer.finish()
+    if batch_part.complete:
+        parts[-1].set_last_part()
+    return parts
+
+
+def _part_size(batch_part):
+    """Return the size a batch part was packed to"""
+    if batch_part.packed_size is not None:
+        return batch_part.packed_size
+    return batch_part.json_size()
+
 
 class BatchPart(object):
-    """BatchPart contains tags/populators to be sent as part of a (potentially) multi-part logical batch"""
+    """BatchPart contains tags/populators to be sent as part of a (potentially) multi-part logical batch
+
+    Upserts and deletes are held as lists of their JSON encoding (bytes)."""
+
+    # a guid is a UUID string - leave room for it in the size of every part
+    guid_size = 36
 
     def __init__(self, replace_all, upserts, deletes):
         if replace_all not in [True, False]:
@@ -116,73 +507,613 @@ class BatchPart(object):
         self.complete = False
         self.upserts = upserts
         self.deletes = deletes
+        self.max_size = None      # the size limit the part was packed to, and its packed (maybe compressed) size
+        self.packed_size = None
+
+    @staticmethod
+    def base_json_size(replace_all, complete=False):
+        """Return the JSON size of an empty part"""
+        part = BatchPart(replace_all, [], [])
+        part.complete = complete
+        return len(part.build_json('')) + BatchPart.guid_size
+
+    def json_size(self):
+        """Return the exact JSON size of this part, given a guid of the usual size"""
+        size = self.base_json_size(self.replace_all, self.complete)
+        for fragments in (self.upserts, self.deletes):
+            if len(fragments) > 0:
+                size += sum(len(fragment) for fragment in fragments) + 2 * (len(fragments) - 1)
+        return size
+
+    def fill_ratio(self):
+        """Return how full the part was packed, relative to its size limit - None if it wasn't packed"""
+        if self.max_size is None:
+            return None
+        return float(self.packed_size) / self.max_size
 
     def set_last_part(self):
         """Marks this part as the last to be sent for a logical batch"""
         self.complete = True
 
     def build_json(self, guid):
-        """Build JSON with the input guid"""
-        upserts = []
-        for value in self.upserts:
-            upserts.append({"value": value, "criteria": self.upserts[value]})
-        return json.dumps({'replace_all': self.replace_all, 'guid': guid,
-                           'complete': self.complete, 'upserts': upserts, 'deletes': self.deletes})
+        """Build the JSON bytes with the input guid
+
+        The guid comes last, so everything before it is the same no matter which guid is sent."""
+        return self.build_json_prefix() + _encode_guid_suffix(guid)
+
+    def build_json_prefix(self):
+        """Build the JSON bytes up to the guid"""
+        return b''.join([b'{"replace_all": ', _encode_bool(self.replace_all),
+                         b', "complete": ', _encode_bool(self.complete),
+                         b', "upserts": [', b', '.join(self.upserts),
+                         b'], "deletes": [', b', '.join(self.deletes),
+                         b'], "guid": '])
+
+
+def packing_report(batch_parts):
+    """Return a text report of how many records each batch part holds, and how full it is"""
+    lines = []
+    for i, part in enumerate(batch_parts):
+        line = 'part %d: %d upserts, %d deletes, %d bytes' % (i + 1, len(part.upserts), len(part.deletes),
+                                                               part.json_size())
+        if part.max_size is not None:
+            line += ', packed to %d of %d bytes (%.1f%% full)' % (part.packed_size, part.max_size,
+                                                                  part.fill_ratio() * 100)
+        lines.append(line)
+
+    ratios = [part.fill_ratio() for part in batch_parts if part.max_size is not None]
+    if len(ratios) > 0:
+        lines.append('%d parts, %.1f%% full on average, %.1f%% full at least'
+                     % (len(batch_parts), sum(ratios) * 100 / len(ratios), min(ratios) * 100))
+    return '\n'.join(lines)
+
+
+def _encode_bool(b):
+    return b'true' if b else b'false'
+
+
+def _encode_guid_suffix(guid):
+    """Return the end of a batch part's JSON, after its prefix"""
+    return _encode_value(guid) + b'}'
+
+
+# header of a gzip stream without a file name or time, and of a zlib stream with default compression
+_gzipHeader = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+_zlibHeader = b'\x78\x9c'
+
+
+class _SerializedPart(object):
+    """The HTTP request body of a batch part, serialized (and compressed) up to its guid
+
+    The guid isn't known until the first part is acknowledged, but it comes last in the JSON, so the
+    rest of the body can be built ahead of time and only the guid is added when the part is sent.
+    A compressed body is held as a raw deflate stream of the JSON before the guid, flushed to a byte
+    boundary, and its checksum: the compressed guid, the gzip or zlib header and the trailer with the
+    combined checksum are added around it at send time."""
+
+    def __init__(self, batch_part, compression, index=None):
+        start = time.perf_counter()
+        self.batch_part = batch_part
+        self.compression = compression
+        self.index = index
+        self.estimated_size = _part_size(batch_part)   # as packed, with a guid of the usual size
+        prefix = batch_part.build_json_prefix()
+        self._size = len(prefix)
+        if compression is None:
+            self._prefix = prefix
+        else:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self._prefix = compressor.compress(prefix) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if compression == 'gzip':
+                self._checksum = zlib.crc32(prefix)
+            else:
+                self._checksum = zlib.adler32(prefix)
+        self.seconds = time.perf_counter() - start   # how long serializing took
+
+    def json_size(self, guid):
+        """Return the size of the uncompressed JSON, given the batch guid"""
+        return self._size + len(_encode_guid_suffix(guid))
+
+    def estimated_body_size(self, guid):
+        """Return the size of the request body the part was packed by, given the batch guid"""
+        if self.compression is None:
+            return self.estimated_size - BatchPart.guid_size + len(guid)
+        return self.estimated_size
+
+    def request(self, guid):
+        """Return the extra headers and the body to send the part with, given the batch guid"""
+        suffix = _encode_guid_suffix(guid)
+        if self.compression is None:
+            return dict(), b''.join([self._prefix, suffix])
+
+        # the end of the JSON is compressed on its own, finishing the deflate stream
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed_suffix = compressor.compress(suffix) + compressor.flush()
+        if self.compression == 'gzip':
+            header = _gzipHeader
+            trailer = struct.pack('<II', zlib.crc32(suffix, self._checksum) & 0xffffffff,
+                                  (self._size + len(suffix)) & 0xffffffff)
+        else:
+            header = _zlibHeader
+            trailer = struct.pack('>I', zlib.adler32(suffix, self._checksum) & 0xffffffff)
+        return {'Content-Encoding': self.compression}, b''.join([header, self._prefix, compressed_suffix, trailer])
+
+
+class _SpooledPart(_SerializedPart):
+    """A serialized batch part read back from a BatchSpool - the body before the guid is a view of the file"""
+
+    def __init__(self, prefix, json_size, checksum, compression, estimated_size, index):
+        self.batch_part = None
+        self.compression = compression
+        self.index = index
+        self.estimated_size = estimated_size
+        self.seconds = 0
+        self._prefix = prefix
+        self._size = json_size
+        self._checksum = checksum
+
+
+# first and last bytes of a spool file: it's the parts' serialized bodies back to back, followed by a JSON index
+# of them, and the index's offset
+_spoolMagic = b'KTSPOOL1'
+_spoolFooter = struct.Struct('<Q8s')
+
+# how many parts are compressed at once while writing a spool
+_spoolSerializeAhead = 4
+
+
+def _write_spool(path, batch_parts, replace_all, part_size, compression):
+    """Serialize batch parts to a spool file, written to a temporary file and moved into place when complete"""
+    index = {'version': 1, 'replace_all': replace_all, 'compression': compression, 'part_size': part_size,
+             'fingerprint': _parts_fingerprint(batch_parts), 'parts': []}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f, \
+            _PartSerializer(batch_parts, range(len(batch_parts)), compression, _spoolSerializeAhead) as serializer:
+        f.write(_spoolMagic)
+        offset = len(_spoolMagic)
+        for i in range(len(batch_parts)):
+            serialized_part = serializer.get(i)
+            prefix = serialized_part._prefix
+            f.write(prefix)
+            index['parts'].append({'offset': offset, 'length': len(prefix), 'crc32': zlib.crc32(prefix) & 0xffffffff,
+                                   'json_size': serialized_part._size,
+                                   'checksum': getattr(serialized_part, '_checksum', None),
+                                   'estimated_size': serialized_part.estimated_size})
+            offset += len(prefix)
+        f.write(json.dumps(index).encode('utf-8'))
+        f.write(_spoolFooter.pack(offset, _spoolMagic))
+    os.replace(tmp_path, path)
+
+
+class BatchSpool(object):
+    """BatchSpool reads back a batch written with Batch.write_spool(), to upload it
+
+    The file is memory-mapped, and each part's request body is sent as it was written - already packed,
+    serialized and compressed - with only the batch guid added:
+
+        batch.write_spool('/var/spool/kentik/c_my_column.spool', compression='gzip')
+
+        with tagging.BatchSpool('/var/spool/kentik/c_my_column.spool') as spool:
+            guid = client.submit_populator_spool('c_my_column', spool)
+
+    A spool can be uploaded any number of times, and a part that was changed on disk fails its checksum
+    instead of being sent."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            index = self._read_index()
+        except Exception:
+            self._mmap.close()
+            raise
+        self.replace_all = index['replace_all']
+        self.compression = index['compression']
+        self.part_size = index['part_size']
+        self.fingerprint = index['fingerprint']
+        self._parts = index['parts']
+
+    def _read_index(self):
+        mm = self._mmap
+        if len(mm) < len(_spoolMagic) + _spoolFooter.size or mm[:len(_spoolMagic)] != _spoolMagic:
+            raise ValueError('Invalid spool file %s: not a batch spool' % self.path)
+        index_offset, magic = _spoolFooter.unpack(mm[len(mm) - _spoolFooter.size:])
+        if magic != _spoolMagic or index_offset > len(mm) - _spoolFooter.size:
+            raise ValueError('Invalid spool file %s: it is truncated' % self.path)
+        index = json.loads(mm[index_offset:len(mm) - _spoolFooter.size].decode('utf-8'))
+        if index.get('version') != 1:
+            raise ValueError('Invalid spool file %s: unsupported version %s' % (self.path, index.get('version')))
+        return index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._parts)
+
+    def close(self):
+        """Unmap the file"""
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass    # a part is still being held on to - the file is unmapped once it's gone
+
+    def get(self, index):
+        """Return the serialized part 'index', ready to send"""
+        p = self._parts[index]
+        prefix = memoryview(self._mmap)[p['offset']:p['offset'] + p['length']]
+        if zlib.crc32(prefix) & 0xffffffff != p['crc32']:
+            raise ValueError('Invalid spool file %s: part %d is corrupt' % (self.path, index))
+        return _SpooledPart(prefix, p['json_size'], p['checksum'], self.compression, p['estimated_size'], index)
+
+    def part_sizes(self):
+        """Return the sizes of the parts' request bodies (without the guid)"""
+        return [p['length'] for p in self._parts]
+
+
+class StreamingBatch(object):
+    """StreamingBatch collects tags or populators like a Batch, but submits them as it goes
+
+    As soon as a batch part is full, it's sent to the server, so only about one part is ever held in
+    memory. The guid from the first response is carried to the following parts, and the last part
+    is sent, completing the batch, when the StreamingBatch is closed:
+
+        with client.stream_populator_batch('c_my_column', True) as batch:
+            for row in rows:
+                batch.add_upsert(row.value, row.criteria)
+        guid = batch.guid
+
+    Criteria given for a value again, after other values, are added to its upsert while that's still in the
+    part being filled - or the upsert is moved to the next part with them, if they don't fit. Still, add all
+    criteria for a value together: once its part was sent, the value is upserted again, and the server keeps
+    the last upsert. values_regrouped counts the values given again while their upsert could take them.
+    Parts are sized by the client's PartSizePolicy, unless max_upload_size fixes their size, and a value
+    too big for one part is split across parts only if the client's split_values is True.
+    Criteria are validated as in Batch."""
+
+    def __init__(self, client, url, replace_all, max_upload_size=None, validation=None):
+        if replace_all not in [True, False]:
+            raise ValueError("Invalid value for replace_all. Must be True or False.")
+        _check_validation(validation)
+
+        self.replace_all = replace_all
+        self.validation = validation
+        self.validation_errors = dict()   # value -> list of error messages, with lenient validation
+        self.guid = ""
+        self.parts_sent = 0
+        self._client = client
+        self._url = url
+        self._fixed_size = max_upload_size is not None
+        if max_upload_size is None:
+            max_upload_size = client.part_size.size
+        self._packer = _PartPacker(replace_all, max_upload_size, client.compression)
+        self._part_values = dict()    # lower-cased value -> index of its upsert in the part being filled
+        self.values_regrouped = 0
+        self._value = None            # value currently being upserted, and its encoded criteria
+        self._criteria_array = []
+        self._last_response = None
+        self._started = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't complete a batch that failed to build - the server never processes it
+            self._client = None
+
+    def add_upsert(self, value, criteria):
+        """Add a tag or populator to the batch by value and criteria"""
+        self._check_open()
+
+        value = value.strip()
+        if not _check_criteria(self.validation, self.validation_errors, value, criteria):
+            return
+        if self._value is None or self._value.lower() != value.lower():
+            self._flush_upsert()
+            self._value = value
+            if value.lower() in self._part_values:
+                self.values_regrouped += 1
+
+        self._criteria_array.append(criteria.encode())
+
+    def add_delete(self, value):
+        """Delete a tag or populator by value - these are processed before upserts"""
+        self._check_open()
+
+        value = value.strip()
+        if len(value) == 0:
+            raise ValueError("Invalid value for delete. Value is empty.")
+
+        self._add(_encode_delete(value), self._packer.add_delete)
+
+    def close(self):
+        """Send the last part, completing the batch, and return the batch guid"""
+        self._check_open()
+        self._flush_upsert()
+
+        if self._packer.is_empty() and self.parts_sent == 0 and not self.replace_all:
+            raise ValueError("Batch has no data, and 'replace_all' is False")
+
+        part = self._packer.finish()
+        part.set_last_part()
+        self._send(part)
+        _batch_submitted(self._client, self._url, self.guid, self.parts_sent, self._started)
+        self._client = None
+
+        _check_batch_error(self._last_response)
+
+        return self.guid
+
+    def _check_open(self):
+        if self._client is None:
+            raise RuntimeError('StreamingBatch is closed')
+
+    def _flush_upsert(self):
+        """Add the upsert for the current value to the part"""
+        if self._value is None:
+            return
+
+        v = self._value.lower()
+        index = self._part_values.get(v)
+        if index is not None:
+            # given again after other values - keep all its criteria in one upsert
+            if self._packer.fits(b', '.join(self._criteria_array)):
+                self._packer.add_criteria(index, self._criteria_array)
+                self._value = None
+                self._criteria_array = []
+                return
+            # no room left for them - move the upsert to the next part, and add the criteria there
+            upsert = json.loads(self._packer.pop_upsert(index).decode('utf-8'))
+            self._value = upsert['value']
+            self._criteria_array = [_encode_value(criteria) for criteria in upsert['criteria']] + self._criteria_array
+            del self._part_values[v]
+            if not self._packer.is_empty():
+                self._send(self._packer.finish())
+
+        fragments = [_encode_upsert(self._value, self._criteria_array)]
+        if len(fragments[0]) > self._packer.max_size - BatchPart.base_json_size(self.replace_all):
+            # too many criteria for one part - split them into upserts that go in consecutive parts
+            fragments = _split_upsert(self.replace_all, self._value, self._criteria_array, self._packer.max_size,
+                                      self._packer.compression, self._client.split_values)
+        for fragment in fragments:
+            if v in self._part_values:
+                # another piece of a split value - it goes in the next part
+                self._send(self._packer.finish())
+
+            self._add(fragment, self._packer.add_upsert)
+            self._part_values[v] = len(self._packer.upserts) - 1
+        self._value = None
+        self._criteria_array = []
+
+    def _add(self, fragment, add):
+        if not self._packer.fits(fragment):
+            # this record would put us over the limit - send the part and start a new one
+            self._send(self._packer.finish())
+        add(fragment)
+
+    def _send(self, part):
+        if part.packed_size > part.max_size:
+            # criteria added to earlier upserts compressed worse than estimated - send the part as two
+            batch_parts = _resplit_part(part, part.max_size, self._packer.compression, self._client.split_values)
+            if len(batch_parts) > 1:
+                for batch_part in batch_parts:
+                    self._send(batch_part)
+                return
+        self._last_response = self._client._send_part(self._url, part, self.guid, self.parts_sent)
+        self.guid = self._last_response['guid']
+        self.parts_sent += 1
+        self._part_values = dict()
+        if not self._fixed_size:
+            # the next part gets the size the policy settled on, now that it's seen this one sent
+            self._packer.max_size = self._client.part_size.size
+
 
 class Criteria(object):
     """Criteria defines a set of rules that must match for a tag or populator.
 
-    A flow record is tagged with this value if it matches at least one value from each non-empty criteria."""
+    A flow record is tagged with this value if it matches at least one value from each non-empty criteria.
 
-    def __init__(self, direction):
-        # try to approximate the string size as we add to the criteria - starts
-        # with curly brackets, comma, space, length of direction
-        self._size = len(direction) + 20  # from '{"direction": "", } '
-        self._json_dict = dict()
+    Criteria are stored compactly: ports, VLANs, ASNs and protocols in typed arrays, IP addresses
+    packed into integers, and they're only turned into strings when the criteria is encoded. The
+    encoding is kept until the criteria changes, so a criteria added to many values is encoded once."""
+
+    __slots__ = ('_direction', '_addr', '_nexthop', '_port', '_vlans', '_asn', '_nexthop_asn',
+                 '_protocol', '_tcp_flags', '_strings', '_encoded')
 
+    def __init__(self, direction):
         v = direction.lower()
         if v not in ["src", "dst", "either"]:
             raise ValueError("Invalid value for direction. Valid: src, dst, either.")
-        self._json_dict['direction'] = v
-        self._has_field = False
+        self._direction = v
+
+        # fields are only allocated once they're used
+        self._addr = None           # _AddressList
+        self._nexthop = None        # _AddressList
+        self._port = None           # array of start, end pairs - start == end for a single port
+        self._vlans = None          # array of start, end pairs
+        self._asn = None            # array of start, end pairs
+        self._nexthop_asn = None    # array of start, end pairs
+        self._protocol = None       # array of protocol numbers
+        self._tcp_flags = None      # bitmask
+        self._strings = None        # dict of JSON key to list of strings
+        self._encoded = None        # JSON bytes, until the criteria changes
 
     def to_dict(self):
-        return self._json_dict
+        """Return this criteria as a dictionary, as it's represented in JSON"""
+        d = {'direction': self._direction}
+        if self._addr is not None:
+            d['addr'] = self._addr.to_list()
+        if self._port is not None:
+            d['port'] = _range_strings(self._port)
+        if self._vlans is not None:
+            d['vlans'] = _range_strings(self._vlans)
+        if self._protocol is not None:
+            d['protocol'] = self._protocol.tolist()
+        if self._tcp_flags is not None:
+            d['tcp_flags'] = self._tcp_flags
+        if self._asn is not None:
+            d['asn'] = _range_strings(self._asn)
+        if self._nexthop_asn is not None:
+            d['nexthop_asn'] = _range_strings(self._nexthop_asn)
+        if self._nexthop is not None:
+            d['nexthop'] = self._nexthop.to_list()
+        if self._strings is not None:
+            for key in _criteriaStringFields:
+                if key in self._strings:
+                    d[key] = self._strings[key]
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        """Return a criteria from a dictionary, as it's represented in JSON - see to_dict()
+
+        Each field is a list of values or a single value, and is added with its add_ method, which checks it.
+        Ports, VLANs and ASNs can be ranges, like '1000-2000'."""
+        if 'direction' not in d:
+            raise ValueError("Invalid criteria. Direction is missing.")
+        criteria = cls(d['direction'])
+        for key, values in d.items():
+            if key == 'direction':
+                continue
+            method = _criteriaAddMethods.get(key)
+            if method is None:
+                raise ValueError('Invalid criteria field "%s".' % key)
+            if key == 'tcp_flags':
+                criteria.set_tcp_flags(int(values))
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                if key in _criteriaRangeFields:
+                    start, _, end = str(value).partition('-')
+                    try:
+                        start, end = int(start), int(end or start)
+                    except ValueError:
+                        raise ValueError('Invalid %s "%s".' % (key, value))
+                    getattr(criteria, method)(start, end)
+                elif key == 'protocol':
+                    criteria.add_protocol(int(value))
+                else:
+                    getattr(criteria, method)(value)
+        return criteria
+
+    def encode(self):
+        """Return this criteria as JSON bytes"""
+        if self._encoded is None:
+            self._encoded = json.dumps(self.to_dict()).encode('utf-8')
+        return self._encoded
 
     def json_size(self):
-        """Return the approximate size of this criteria represented as JSON"""
-        return self._size
-
-    def _ensure_field(self, key):
-        """Ensure a non-array field"""
-        if self._has_field:
-            self._size += 2  # comma, space
-        self._has_field = True
-
-        self._size += len(key) + 4  # 2 quotes, colon, space
+        """Return the exact size of this criteria represented as JSON"""
+        return len(self.encode())
+
+    def invalid_values(self):
+        """Return (field, value) for each value Kentik would reject - eg. [('ip_address', 'abcdefg')]
+
+        IP addresses are parsed as they're added. MAC addresses, country codes, BGP AS paths and communities
+        are checked here, and the result for each distinct string is cached, so repeated values are cheap."""
+        invalid = []
+        if self._addr is not None and self._addr._other is not None:
+            invalid.extend(('ip_address', address) for address in self._addr._other)
+        if self._nexthop is not None and self._nexthop._other is not None:
+            invalid.extend(('next_hop_ip_address', address) for address in self._nexthop._other)
+        if self._strings is not None:
+            for key, values in self._strings.items():
+                validator = _stringValidators.get(key)
+                if validator is None:
+                    continue
+                for value in values:
+                    if not validator.is_valid(value):
+                        invalid.append((validator.name, value))
+        return invalid
+
+    def canonicalize(self):
+        """Canonicalize the criteria in place, so it encodes smaller but matches the same flows
+
+        IP addresses and prefixes are collapsed into the fewest prefixes that cover them, overlapping and
+        adjacent port, VLAN and ASN ranges are merged, and duplicate values are removed."""
+        self._encoded = None
+        if self._addr is not None:
+            self._addr.canonicalize()
+        if self._nexthop is not None:
+            self._nexthop.canonicalize()
+        for field in ('_port', '_vlans', '_asn', '_nexthop_asn'):
+            ranges = getattr(self, field)
+            if ranges is not None:
+                setattr(self, field, _merge_ranges(ranges))
+        if self._protocol is not None:
+            self._protocol = array('B', sorted(set(self._protocol)))
+        if self._strings is not None:
+            for key, values in self._strings.items():
+                self._strings[key] = _unique(values)
+
+    def _copy(self):
+        """Return a copy of the criteria that can be changed independently"""
+        criteria = Criteria(self._direction)
+        for field in Criteria.__slots__[1:]:
+            value = getattr(self, field)
+            if isinstance(value, (array, _AddressList)):
+                value = value.__copy__()
+            elif isinstance(value, dict):
+                value = dict((key, list(values)) for key, values in value.items())
+            setattr(criteria, field, value)
+        return criteria
+
+    def _list_fields(self):
+        """Return the JSON keys of the non-empty array fields"""
+        keys = [key for key, field in _criteriaArrayFields if getattr(self, field) is not None]
+        if self._strings is not None:
+            keys.extend(self._strings)
+        return keys
+
+    def _signature(self, excluded_key):
+        """Return the JSON of the criteria without one field, to find criteria that differ only in that field"""
+        d = self.to_dict()
+        del d[excluded_key]
+        return json.dumps(d, sort_keys=True)
+
+    def _extend(self, key, other):
+        """Add the values of another criteria's array field to this one's"""
+        self._encoded = None
+        if key in _criteriaArrayFieldsByKey:
+            field = _criteriaArrayFieldsByKey[key]
+            getattr(self, field).extend(getattr(other, field))
+        else:
+            self._strings[key].extend(other._strings[key])
 
     def _ensure_array(self, key, value):
-        """Ensure an array field"""
-        if key not in self._json_dict:
-            self._json_dict[key] = []
-
-            self._size += 2             # brackets
-            self._ensure_field(key)
-
-        if len(self._json_dict[key]) > 0:
-            # this array already has an entry, so add comma and space
-            self._size += 2
-
-        if isinstance(value, str):
-            self._size += 2  # quotes
-        self._size += len(str(value))
-
-        self._json_dict[key].append(value)
+        """Ensure a string array field"""
+        self._encoded = None
+        if self._strings is None:
+            self._strings = dict()
+        values = self._strings.get(key)
+        if values is None:
+            values = self._strings[key] = []
+
+        values.append(value)
+
+    def _add_range(self, field, typecode, start, end):
+        """Add a range (or a single number, when start == end) to a numeric field"""
+        self._encoded = None
+        ranges = getattr(self, field)
+        if ranges is None:
+            ranges = array(typecode)
+            setattr(self, field, ranges)
+
+        ranges.append(start)
+        ranges.append(end)
 
     def add_port(self, port):
         if port < 0 or port > 65535:
             raise ValueError("Invalid port. Valid: 0-65535.")
-        self._ensure_array('port', str(port))
+        self._add_range('_port', 'H', port, port)
 
     def add_port_range(self, start, end):
         if start < 0 or start > 65535:
@@ -194,13 +1125,12 @@ class Criteria(object):
             self.add_port(start)
             return
 
-        ports_str = "%d-%d" % (start, end)
-        self._ensure_array('port', ports_str)
+        self._add_range('_port', 'H', start, end)
 
     def add_vlan(self, vlan):
         if vlan < 0 or vlan > 4095:
             raise ValueError("Invalid vlan. Valid: 0-4095.")
-        self._ensure_array('vlans', str(vlan))
+        self._add_range('_vlans', 'H', vlan, vlan)
 
     def add_vlan_range(self, start, end):
         if start < 0 or start > 4095:
@@ -212,17 +1142,20 @@ class Criteria(object):
             self.add_vlan(start)
             return
 
-        self._ensure_array('vlans', '%d-%d' % (start, end))
+        self._add_range('_vlans', 'H', start, end)
 
     def add_protocol(self, protocol):
         if protocol < 0 or protocol > 255:
             raise ValueError("Invalid protocol. Valid: 0-255.")
 
-        self._ensure_array('protocol', protocol)
+        if self._protocol is None:
+            self._protocol = array('B')
+        self._protocol.append(protocol)
+        self._encoded = None
 
     def add_asn(self, asn):
         _validate_asn(asn)
-        self._ensure_array('asn', str(asn))
+        self._add_range('_asn', _asnTypecode, asn, asn)
 
     def add_asn_range(self, start, end):
         _validate_asn(start)
@@ -235,7 +1168,7 @@ class Criteria(object):
             self.add_asn(start)
             return
 
-        self._ensure_array('asn', '%d-%d' % (start, end))
+        self._add_range('_asn', _asnTypecode, start, end)
 
     def add_last_hop_asn_name(self, last_hop_asn_name):
         v = last_hop_asn_name.strip()
@@ -246,7 +1179,7 @@ class Criteria(object):
 
     def add_next_hop_asn(self, next_hop_asn):
         _validate_asn(next_hop_asn)
-        self._ensure_array('nexthop_asn', str(next_hop_asn))
+        self._add_range('_nexthop_asn', _asnTypecode, next_hop_asn, next_hop_asn)
 
     def add_next_hop_asn_range(self, start, end):
         if start == end:
@@ -255,7 +1188,7 @@ class Criteria(object):
 
         _validate_asn(start)
         _validate_asn(end)
-        self._ensure_array('nextohp_as_name', '%d-%d' % (start, end))
+        self._add_range('_nexthop_asn', _asnTypecode, start, end)
 
     def add_next_hop_asn_name(self, next_hop_asn_name):
         v = next_hop_asn_name.strip()
@@ -269,7 +1202,6 @@ class Criteria(object):
         if len(v) == 0:
             raise ValueError("Invalid bgp_as_path. Value is empty.")
 
-        # TODO: validate
         self._ensure_array('bgp_aspath', v)
 
     def add_bgp_community(self, bgp_community):
@@ -277,7 +1209,6 @@ class Criteria(object):
         if len(v) == 0:
             raise ValueError("Invalid bgp_community. Value is empty.")
 
-        # TODO: validate
         self._ensure_array('bgp_community', v)
 
     def add_tcp_flag(self, tcp_flag):
@@ -286,22 +1217,8 @@ class Criteria(object):
         if tcp_flag not in [1, 2, 4, 8, 16, 32, 64, 128]:
             raise ValueError("Invalid TCP flag. Valid: [1, 2, 4, 8, 16,32, 64, 128]")
 
-        prev_size = 0
-
-        if self._json_dict.get('tcp_flags') is None:
-            self._json_dict['tcp_flags'] = 0
-        else:
-            prev_size = len(str(self._json_dict['tcp_flags'])) + len('tcp_flags') + 3  # str, key, key quotes, colon
-        self._json_dict['tcp_flags'] |= tcp_flag
-
-        # update size
-        new_size = len(str(self._json_dict['tcp_flags'])) + len('tcp_flags') + 3  # str, key, key quotes, colon
-        self._size += new_size - prev_size
-
-        if prev_size == 0 and self._has_field:
-            # add the comma and space
-            self._size += 2
-        self._has_field = True
+        self._tcp_flags = (self._tcp_flags or 0) | tcp_flag
+        self._encoded = None
 
     def set_tcp_flags(self, tcp_flags):
         """Set the complete tcp flag bitmask"""
@@ -309,35 +1226,24 @@ class Criteria(object):
         if tcp_flags < 0 or tcp_flags > 255:
             raise ValueError("Invalid tcp_flags. Valid: 0-255.")
 
-        prev_size = 0
-        if self._json_dict.get('tcp_flags') is not None:
-            prev_size = len(str(self._json_dict['tcp_flags'])) + len('tcp_flags') + 3  # str, key, key quotes, colon
-
-        self._json_dict['tcp_flags'] = tcp_flags
-
-        # update size
-        new_size = len(str(self._json_dict['tcp_flags'])) + len('tcp_flags') + 3  # str, key, key quotes, colon
-        self._size += new_size - prev_size
-
-        if prev_size == 0 and self._has_field:
-            # add the comma and space
-            self._size += 2
-        self._has_field = True
+        self._tcp_flags = tcp_flags
+        self._encoded = None
 
     def add_ip_address(self, ip_address):
         v = ip_address.strip()
         if len(v) == 0:
             raise ValueError("Invalid ip_address. Value is empty.")
 
-        # TODO: validate?
-        self._ensure_array('addr', v)
+        if self._addr is None:
+            self._addr = _AddressList()
+        self._addr.add(v)
+        self._encoded = None
 
     def add_mac_address(self, mac_address):
         v = mac_address.strip()
         if len(v) == 0:
             raise ValueError("Invalid mac_address. Value is empty.")
 
-        # TODO: validate?
         self._ensure_array('mac', v)
 
     def add_country_code(self, country_code):
@@ -345,7 +1251,6 @@ class Criteria(object):
         if len(v) == 0:
             raise ValueError("Invalid country_code. Value is empty.")
 
-        # TODO: validate?
         self._ensure_array('country', v)
 
     def add_site_name(self, site_name):
@@ -378,10 +1283,344 @@ class Criteria(object):
 
     def add_next_hop_ip_address(self, next_hop_ip_address):
         v = next_hop_ip_address.strip()
-        if v == 0:
+        if len(v) == 0:
             raise ValueError("Invalid next_hop_ip_address. Value is empty.")
 
-        self._ensure_array('nexthop', v)
+        if self._nexthop is None:
+            self._nexthop = _AddressList()
+        self._nexthop.add(v)
+        self._encoded = None
+
+
+# string criteria fields, in the order they're encoded
+_criteriaStringFields = ['lasthop_as_name', 'nexthop_as_name', 'bgp_aspath', 'bgp_community', 'mac', 'country',
+                         'site', 'device_type', 'interface_name', 'device_name']
+
+# JSON keys and attributes of the array fields that aren't strings
+_criteriaArrayFields = [('addr', '_addr'), ('nexthop', '_nexthop'), ('port', '_port'), ('vlans', '_vlans'),
+                        ('asn', '_asn'), ('nexthop_asn', '_nexthop_asn'), ('protocol', '_protocol')]
+_criteriaArrayFieldsByKey = dict(_criteriaArrayFields)
+
+
+class _StringValidator(object):
+    """Check of the values of a string criteria field, caching the result for the strings checked most recently"""
+
+    cache_size = 100000
+
+    def __init__(self, name, check):
+        self.name = name        # name of the field in its add_ method
+        self._check = check
+        self._valid = dict()    # string -> whether it's valid
+
+    def is_valid(self, value):
+        valid = self._valid.get(value)
+        if valid is None:
+            if len(self._valid) >= self.cache_size:
+                self._valid.clear()
+            valid = self._valid[value] = bool(self._check(value))
+        return valid
+
+
+_asPathChars = re.compile(r'[0-9 ^$_.*+?()\[\]{}|,-]+\Z').match
+_communityChars = re.compile(r'[0-9 :^$_.*+?()\[\]{}|,-]+\Z').match
+
+# validators of the string criteria fields that are checked, by JSON key
+_stringValidators = {
+    'mac': _StringValidator('mac_address', re.compile(r'[0-9A-Fa-f]{2}([:-]?)[0-9A-Fa-f]{2}(\1[0-9A-Fa-f]{2}){4}\Z|'
+                                                      r'[0-9A-Fa-f]{4}\.[0-9A-Fa-f]{4}\.[0-9A-Fa-f]{4}\Z').match),
+    'country': _StringValidator('country_code', re.compile(r'[A-Za-z]{2}\Z').match),
+    # AS paths and communities can be regular expressions of AS numbers
+    'bgp_aspath': _StringValidator('bgp_as_path', lambda v: _asPathChars(v) is not None and _is_regex(v)),
+    'bgp_community': _StringValidator('bgp_community', lambda v: _communityChars(v) is not None and _is_regex(v)),
+}
+
+
+def _is_regex(value):
+    try:
+        re.compile(value)
+    except re.error:
+        return False
+    return True
+
+
+def _check_validation(validation):
+    if validation not in (None, 'strict', 'lenient'):
+        raise ValueError("Invalid value for validation. Valid: strict, lenient, None.")
+
+
+def _check_criteria(validation, validation_errors, value, criteria):
+    """Return whether to add a criteria for a value - raising ValueError, or recording the errors, if it's invalid"""
+    if validation is None:
+        return True
+    invalid = criteria.invalid_values()
+    if len(invalid) == 0:
+        return True
+    if validation == 'strict':
+        name, invalid_value = invalid[0]
+        raise ValueError('Invalid %s "%s" for value "%s".' % (name, invalid_value, value))
+    validation_errors.setdefault(value, []).extend('Invalid %s "%s".' % (name, invalid_value)
+                                                   for name, invalid_value in invalid)
+    return False
+
+
+# method adding a value of each criteria field, by JSON key
+_criteriaAddMethods = {
+    'addr': 'add_ip_address', 'nexthop': 'add_next_hop_ip_address', 'port': 'add_port_range',
+    'vlans': 'add_vlan_range', 'asn': 'add_asn_range', 'nexthop_asn': 'add_next_hop_asn_range',
+    'protocol': 'add_protocol', 'tcp_flags': 'set_tcp_flags', 'lasthop_as_name': 'add_last_hop_asn_name',
+    'nexthop_as_name': 'add_next_hop_asn_name', 'bgp_aspath': 'add_bgp_as_path', 'bgp_community': 'add_bgp_community',
+    'mac': 'add_mac_address', 'country': 'add_country_code', 'site': 'add_site_name', 'device_type': 'add_device_type',
+    'interface_name': 'add_interface_name', 'device_name': 'add_device_name',
+}
+_criteriaRangeFields = ('port', 'vlans', 'asn', 'nexthop_asn')
+
+# smallest array type that holds a 32-bit ASN
+_asnTypecode = 'I' if array('I').itemsize >= 4 else 'L'
+
+
+def _range_strings(ranges):
+    """Return the strings for an array of start, end pairs - eg. '80' or '1000-2000'"""
+    strings = []
+    for i in range(0, len(ranges), 2):
+        start = ranges[i]
+        end = ranges[i + 1]
+        if start == end:
+            strings.append(str(start))
+        else:
+            strings.append('%d-%d' % (start, end))
+    return strings
+
+
+def _merge_ranges(ranges):
+    """Return an array of start, end pairs with overlapping and adjacent ranges merged"""
+    pairs = sorted((min(ranges[i], ranges[i + 1]), max(ranges[i], ranges[i + 1])) for i in range(0, len(ranges), 2))
+    merged = array(ranges.typecode)
+    for start, end in pairs:
+        if len(merged) > 0 and start <= merged[-1] + 1:
+            merged[-1] = max(merged[-1], end)
+        else:
+            merged.append(start)
+            merged.append(end)
+    return merged
+
+
+def _unique(values):
+    """Return the values without duplicates, keeping their order"""
+    seen = set()
+    unique = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique.append(value)
+    return unique
+
+
+def _merge_criteria(criteria_list):
+    """Canonicalize a value's criteria, and merge the ones that match the same flows but for one field
+
+    Criteria that are the same except for the values of one array field are merged into one criteria with
+    the values of both - a flow matching either one matches the merged one, and vice versa. Criteria without
+    that field at all match any value of it, so they're not merged with criteria that have it."""
+    for criteria in criteria_list:
+        criteria.canonicalize()
+
+    keys = []
+    for criteria in criteria_list:
+        keys.extend(key for key in criteria._list_fields() if key not in keys)
+
+    for key in keys:
+        groups = OrderedDict()
+        for criteria in criteria_list:
+            if key in criteria._list_fields():
+                group_key = criteria._signature(key)
+            else:
+                group_key = id(criteria)
+            groups.setdefault(group_key, []).append(criteria)
+
+        criteria_list = []
+        for group in groups.values():
+            for other in group[1:]:
+                group[0]._extend(key, other)
+            if len(group) > 1:
+                group[0].canonicalize()
+            criteria_list.append(group[0])
+
+    # drop duplicates - eg. criteria without any array field
+    unique = OrderedDict()
+    for criteria in criteria_list:
+        unique.setdefault(criteria.encode(), criteria)
+    return list(unique.values())
+
+
+# prefix length stored for an address without one
+_noPrefixLength = 255
+
+
+class _AddressList(object):
+    """Compact list of IP addresses and CIDR prefixes
+
+    IPv4 addresses are packed with their prefix length into 64-bit integers, and IPv6 addresses into
+    17 bytes each. Anything that doesn't parse is kept as the string given, for the server to judge.
+    Addresses are returned grouped by IPv4, IPv6, then anything else, and IPv6 addresses come back
+    in their canonical form."""
+
+    __slots__ = ('_v4', '_v6', '_other')
+
+    def __init__(self):
+        self._v4 = None       # array of address << 8 | prefix length
+        self._v6 = None       # bytearray of 16 address bytes + prefix length, per address
+        self._other = None    # list of strings
+
+    def __len__(self):
+        count = 0
+        if self._v4 is not None:
+            count += len(self._v4)
+        if self._v6 is not None:
+            count += len(self._v6) // 17
+        if self._other is not None:
+            count += len(self._other)
+        return count
+
+    def add(self, address):
+        parsed = _parse_address(address)
+        if parsed is None:
+            if self._other is None:
+                self._other = []
+            self._other.append(address)
+            return
+
+        packed, prefix_length = parsed
+        if prefix_length is None:
+            prefix_length = _noPrefixLength
+        if len(packed) == 4:
+            if self._v4 is None:
+                self._v4 = array('Q')
+            self._v4.append(struct.unpack('!I', packed)[0] << 8 | prefix_length)
+        else:
+            if self._v6 is None:
+                self._v6 = bytearray()
+            self._v6 += packed
+            self._v6.append(prefix_length)
+
+    def __copy__(self):
+        addresses = _AddressList()
+        addresses.extend(self)
+        return addresses
+
+    def extend(self, other):
+        """Add the addresses of another list"""
+        if other._v4 is not None:
+            if self._v4 is None:
+                self._v4 = array('Q')
+            self._v4.extend(other._v4)
+        if other._v6 is not None:
+            if self._v6 is None:
+                self._v6 = bytearray()
+            self._v6 += other._v6
+        if other._other is not None:
+            if self._other is None:
+                self._other = []
+            self._other.extend(other._other)
+
+    def canonicalize(self):
+        """Collapse the addresses into the fewest prefixes that cover them, and drop duplicates
+
+        A prefix with bits set after its length covers the whole network, eg. 10.1.2.3/8 is 10.0.0.0/8."""
+        if self._v4 is not None:
+            networks = [(n >> 8, n & 0xff) for n in self._v4]
+            self._v4 = array('Q', [address << 8 | prefix_length
+                                   for address, prefix_length in _collapse_networks(networks, 32)])
+        if self._v6 is not None:
+            networks = [(_int_from_bytes(self._v6[i:i + 16]), self._v6[i + 16]) for i in range(0, len(self._v6), 17)]
+            v6 = bytearray()
+            for address, prefix_length in _collapse_networks(networks, 128):
+                v6 += _int_to_bytes(address, 16)
+                v6.append(prefix_length)
+            self._v6 = v6
+        if self._other is not None:
+            self._other = _unique(self._other)
+
+    def to_list(self):
+        addresses = []
+        if self._v4 is not None:
+            for n in self._v4:
+                address = '%d.%d.%d.%d' % (n >> 32 & 0xff, n >> 24 & 0xff, n >> 16 & 0xff, n >> 8 & 0xff)
+                addresses.append(_with_prefix_length(address, n & 0xff))
+        if self._v6 is not None:
+            for i in range(0, len(self._v6), 17):
+                address = socket.inet_ntop(socket.AF_INET6, bytes(self._v6[i:i + 16]))
+                addresses.append(_with_prefix_length(address, self._v6[i + 16]))
+        if self._other is not None:
+            addresses.extend(self._other)
+        return addresses
+
+
+def _parse_address(address):
+    """Parse an IP address or CIDR prefix, returning (packed address, prefix length or None), or None"""
+    ip, slash, prefix_length = address.partition('/')
+    try:
+        packed = socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip)
+    except (socket.error, ValueError):
+        return None
+
+    if not slash:
+        return packed, None
+    try:
+        n = int(prefix_length)
+    except ValueError:
+        return None
+    if str(n) != prefix_length or n > len(packed) * 8:
+        return None
+    return packed, n
+
+
+def _collapse_networks(networks, bits):
+    """Return the fewest (address, prefix length) networks that cover the given ones
+
+    Networks without a prefix length (_noPrefixLength) are single addresses, and single addresses are
+    returned without a prefix length too."""
+    intervals = []
+    for address, prefix_length in networks:
+        if prefix_length == _noPrefixLength:
+            prefix_length = bits
+        host_mask = (1 << (bits - prefix_length)) - 1
+        start = address & ~host_mask
+        intervals.append((start, start | host_mask))
+    intervals.sort()
+
+    collapsed = []
+    merged_start, merged_end = intervals[0]
+    for start, end in intervals[1:] + [(None, None)]:
+        if start is not None and start <= merged_end + 1:
+            merged_end = max(merged_end, end)
+            continue
+
+        # split the merged interval into the largest aligned blocks that fit
+        while merged_start <= merged_end:
+            size = merged_start & -merged_start if merged_start > 0 else 1 << bits
+            while size > merged_end - merged_start + 1:
+                size >>= 1
+            prefix_length = bits - size.bit_length() + 1
+            collapsed.append((merged_start, _noPrefixLength if prefix_length == bits else prefix_length))
+            merged_start += size
+
+        if start is not None:
+            merged_start, merged_end = start, end
+    return collapsed
+
+
+def _int_from_bytes(b):
+    return int(binascii.hexlify(b), 16)
+
+
+def _int_to_bytes(n, length):
+    return binascii.unhexlify('%0*x' % (length * 2, n))
+
+
+def _with_prefix_length(address, prefix_length):
+    if prefix_length == _noPrefixLength:
+        return address
+    return '%s/%d' % (address, prefix_length)
 
 
 def _validate_asn(asn):
@@ -389,83 +1628,793 @@ def _validate_asn(asn):
         raise ValueError("Invalid ASN. Valid: 0-4294967295")
 
 
+def _populator_url(base_url, column_name):
+    """Return the populator batch URL for a custom dimension"""
+    if not set(column_name).issubset(_allowedCustomDimensionChars):
+        raise ValueError('Invalid custom dimension name "%s": must only contain letters, digits, and underscores' % column_name)
+    if len(column_name) < 3 or len(column_name) > 20:
+        raise ValueError('Invalid value "%s": must be between 3-20 characters' % column_name)
+
+    return '%s/api/v5/batch/customdimensions/%s/populators' % (base_url, column_name)
+
+
+def _tag_url(base_url):
+    """Return the tag batch URL"""
+    return '%s/api/v5/batch/tags' % base_url
+
+
+def _status_url(base_url, guid):
+    """Return the batch status URL"""
+    return '%s/api/v5/batch/%s/status' % (base_url, guid)
+
+
+def _request_headers(api_email, api_token):
+    """Return the headers sent with every request"""
+    return {
+        'User-Agent': 'kentik-python-api/0.1',
+        'Content-Type': 'application/json',
+        'X-CH-Auth-Email': api_email,
+        'X-CH-Auth-API-Token': api_token
+    }
+
+
+def _check_part_response(resp_json_dict):
+    """Check the JSON->dict response to a batch part has a guid, and return it"""
+    guid = resp_json_dict.get('guid')
+    if guid is None or len(guid) == 0:
+        raise RuntimeError('guid not found in batch response')
+    return resp_json_dict
+
+
+def _check_batch_error(resp_json_dict):
+    """Raise if the JSON->dict response to the last batch part has an error"""
+    if resp_json_dict.get('error') is not None:
+        raise RuntimeError('Error received from server: %s' % resp_json_dict['error'])
+
+
+class PartSizePolicy(object):
+    """Decides how big the parts of a batch are, adapting the size to how the server handles them
+
+    Parts start at max_size bytes (compressed bytes, when compressing). When the server rejects a part
+    as too large (HTTP 413), or it times out reading the response, the size is cut by shrink_factor -
+    but no lower than min_size - and the part is re-split into smaller parts, sent in its place. Parts
+    taking over slow_seconds to send make the following parts smaller too, and parts sent within
+    fast_seconds grow the size by grow_factor, back up to max_size - but once the server has rejected
+    a part as too large, only up to 90% of the smallest part it rejected.
+
+    A policy with min_size equal to max_size always uses that size:
+
+        client = tagging.Client('my@email.com', 'my_token', part_size=tagging.PartSizePolicy(300000, 300000))
+    """
+
+    def __init__(self, max_size=700000, min_size=50000, shrink_factor=0.5, grow_factor=1.25, fast_seconds=2,
+                 slow_seconds=30):
+        if min_size < 1 or min_size > max_size:
+            raise ValueError("Invalid min_size. Valid: 1-max_size.")
+        if not 0 < shrink_factor < 1:
+            raise ValueError("Invalid shrink_factor. Must be between 0 and 1.")
+        if grow_factor < 1:
+            raise ValueError("Invalid grow_factor. Must be at least 1.")
+
+        self.max_size = max_size
+        self.min_size = min_size
+        self.shrink_factor = shrink_factor
+        self.grow_factor = grow_factor
+        self.fast_seconds = fast_seconds
+        self.slow_seconds = slow_seconds
+        self.size = max_size    # the size of the next parts
+        self._ceiling = max_size  # the size parts grow back to
+        self._lock = threading.Lock()
+
+    def can_shrink(self, part_size):
+        """Return whether a part of part_size bytes could be re-split into smaller parts"""
+        return part_size > self.min_size
+
+    def shrink(self, part_size, rejected=False):
+        """A part of part_size bytes was too big - return the smaller size to re-split it to
+
+        rejected is whether the server refused the part as too large, rather than timing out."""
+        with self._lock:
+            if rejected:
+                self._ceiling = max(self.min_size, min(self._ceiling, int(part_size * 0.9)))
+            self.size = max(self.min_size, min(self.size, int(part_size * self.shrink_factor)))
+            return self.size
+
+    def part_sent(self, part_size, seconds):
+        """A part of part_size bytes was sent in seconds"""
+        with self._lock:
+            if seconds >= self.slow_seconds:
+                self.size = max(self.min_size, min(self.size, int(part_size * self.shrink_factor)))
+            elif seconds <= self.fast_seconds and part_size * 2 >= self.size:
+                # only parts close to the current size say anything about bigger ones
+                self.size = max(self.size, min(self._ceiling, int(self.size * self.grow_factor)))
+
+
+class SubmissionCheckpoint(object):
+    """Records how far the submission of a batch got, so a failed submission can be resumed
+
+    The checkpoint holds the batch guid and how many parts the server acknowledged, and is saved to
+    'path' (if given) after every part, so a submission can even be resumed by a new process:
+
+        checkpoint = tagging.SubmissionCheckpoint.load('/var/tmp/c_my_column.checkpoint')
+        client.submit_populator_batch('c_my_column', batch, checkpoint=checkpoint)
+
+    If the submission fails, submitting the same batch again with the same checkpoint only sends the
+    parts the server hasn't acknowledged yet. Once the batch is complete, the checkpoint is cleared."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._reset()
+
+    def _reset(self):
+        self.url = None
+        self.fingerprint = None   # identifies the batch parts being submitted
+        self.guid = ""
+        self.part_size = None     # the size the batch was split into parts with
+        self.parts_acked = 0      # parts acknowledged by the server, in order
+        self._acked_ahead = set()  # parts acknowledged after the first unacknowledged one, when pipelining
+
+    @classmethod
+    def load(cls, path):
+        """Load a checkpoint from a file, or start a new one if there's no file yet"""
+        checkpoint = cls(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                d = json.load(f)
+            checkpoint.url = d['url']
+            checkpoint.fingerprint = d['fingerprint']
+            checkpoint.guid = d['guid']
+            checkpoint.part_size = d.get('part_size')
+            checkpoint.parts_acked = d['parts_acked']
+            checkpoint._acked_ahead = set(d['acked_ahead'])
+        return checkpoint
+
+    def save(self):
+        """Write the checkpoint to its file, if it has one"""
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'url': self.url, 'fingerprint': self.fingerprint,
+                       'guid': self.guid, 'part_size': self.part_size, 'parts_acked': self.parts_acked,
+                       'acked_ahead': sorted(self._acked_ahead)}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """Forget the submission, and remove the checkpoint file"""
+        self._reset()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _planned_part_size(self, url):
+        """Return the part size of the submission being resumed, so the batch is split the same way again"""
+        if self.url != url:
+            return None
+        return self.part_size
+
+    def _start(self, url, fingerprint, part_size=None):
+        """Start or resume submitting the parts with a fingerprint - returns the index of the first part to send"""
+        if self.url != url or self.fingerprint != fingerprint:
+            # not the submission this checkpoint was recorded for - start over
+            self._reset()
+            self.url = url
+            self.fingerprint = fingerprint
+            self.part_size = part_size
+        return self.parts_acked
+
+    def _is_acked(self, index):
+        return index < self.parts_acked or index in self._acked_ahead
+
+    def _ack(self, index, guid):
+        """Record that the server acknowledged part 'index'"""
+        self.guid = guid
+        self._acked_ahead.add(index)
+        while self.parts_acked in self._acked_ahead:
+            self._acked_ahead.remove(self.parts_acked)
+            self.parts_acked += 1
+        self.save()
+
+
+def _parts_fingerprint(batch_parts):
+    """Return a string that identifies a list of batch parts, to check a checkpoint belongs to them
+
+    It's a hash of the parts' content, so a different batch split into parts of the same shape isn't
+    mistaken for the one the checkpoint was recorded for."""
+    h = hashlib.sha1()
+    for batch_part in batch_parts:
+        # the JSON up to the guid has the part's flags and every upsert and delete in it
+        h.update(batch_part.build_json_prefix())
+        h.update(b'\n')
+    return '%d:%s' % (len(batch_parts), h.hexdigest())
+
+
+def _submission_order(batch_parts, first, checkpoint):
+    """Return the middle parts left to send, and all parts left to send in the order they're sent"""
+    last = len(batch_parts) - 1
+    middle = [index for index in range(max(first, 1), last) if not checkpoint._is_acked(index)]
+    order = list(middle)
+    if first == 0:
+        order.insert(0, 0)
+    if last > 0:
+        order.append(last)
+    return middle, order
+
+
+def _is_too_big_error(e):
+    """Return whether a part request failed in a way that suggests the part is too big
+
+    That's a 413 response, or a timeout waiting for the response."""
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code == 413
+    return isinstance(e, requests.ReadTimeout)
+
+
+def _retry_delay(attempt, backoff_factor, backoff_max):
+    """Return how long to wait before retry number 'attempt': exponential backoff, with full jitter"""
+    return random.uniform(0, min(backoff_max, backoff_factor * (2 ** (attempt - 1))))
+
+
+def _retry_after(headers):
+    """Return the seconds to wait from the Retry-After header of a response, or None if it has none
+
+    The header is either a number of seconds or an HTTP date."""
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+class _StatusPolls(object):
+    """Schedules the status polls of batches being waited on
+
+    Each batch is polled poll_min seconds after the wait starts, and then less and less often, up
+    to every poll_max seconds, so short batches are seen finishing quickly while long-running ones
+    aren't polled needlessly. Every unfinished batch gets a last poll at the deadline."""
+
+    # how much longer to wait before each following poll of a batch
+    growth = 1.5
+
+    def __init__(self, guids, timeout, poll_min, poll_max):
+        if poll_min <= 0 or poll_max < poll_min:
+            raise ValueError("Invalid poll_min or poll_max. Must be 0 < poll_min <= poll_max.")
+
+        self.poll_max = poll_max
+        now = time.monotonic()
+        self.deadline = None if timeout is None else now + timeout
+        self._intervals = OrderedDict((guid, poll_min) for guid in guids)
+        self._next_polls = dict((guid, self._limit(now + poll_min)) for guid in self._intervals)
+
+    def pending(self):
+        """Return the guids of the batches that haven't finished yet"""
+        return list(self._intervals)
+
+    def wait_time(self):
+        """Return how long to wait until the next poll - raises TimeoutError if there are none before the deadline"""
+        next_poll = min(self._next_polls.values())
+        if next_poll == float('inf'):
+            raise TimeoutError("Timed out waiting for batches: %s" % ', '.join(self._intervals))
+        return max(0, next_poll - time.monotonic())
+
+    def due(self):
+        """Return the guids of the batches to poll now"""
+        now = time.monotonic()
+        return [guid for guid, next_poll in self._next_polls.items() if next_poll <= now]
+
+    def polled(self, batch_response):
+        """Record the polled status of a batch, returning whether it has finished"""
+        guid = batch_response.guid
+        if batch_response.is_finished():
+            del self._intervals[guid]
+            del self._next_polls[guid]
+            return True
+
+        now = time.monotonic()
+        if self.deadline is not None and now >= self.deadline:
+            self._next_polls[guid] = float('inf')
+        else:
+            self._intervals[guid] = min(self.poll_max, self._intervals[guid] * self.growth)
+            self._next_polls[guid] = self._limit(now + self._intervals[guid])
+        return False
+
+    def _limit(self, next_poll):
+        if self.deadline is None:
+            return next_poll
+        return min(next_poll, self.deadline)
+
+
+class _PartSerializer(object):
+    """Serializes batch parts in background threads, a few parts ahead of the ones being sent
+
+    Parts are serialized in the order of 'indexes', which is the order they're going to be sent in,
+    keeping up to 'ahead' of them serialized or being serialized, so building the request bodies
+    overlaps with sending the parts before them. With 'ahead' 0, each part is serialized when it's
+    needed."""
+
+    def __init__(self, batch_parts, indexes, compression, ahead):
+        self.batch_parts = batch_parts
+        self.compression = compression
+        self.ahead = ahead
+        self._queue = deque(indexes)    # parts not serialized yet
+        self._futures = dict()          # parts being serialized, by index
+        self._lock = threading.Lock()
+        self._executor = None
+        if ahead > 0:
+            self._executor = ThreadPoolExecutor(max_workers=ahead)
+            self._fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop serializing parts ahead - parts already being serialized are left to finish"""
+        if self._executor is not None:
+            for future in self._futures.values():
+                future.cancel()
+            self._executor.shutdown(wait=False)
+
+    def get(self, index):
+        """Return the _SerializedPart for part 'index', serializing it now if it isn't already"""
+        with self._lock:
+            future = self._futures.pop(index, None)
+            if future is None and index in self._queue:
+                self._queue.remove(index)
+            self._fill()
+
+        if future is None:
+            return _SerializedPart(self.batch_parts[index], self.compression, index)
+        return future.result()
+
+    def _fill(self):
+        while len(self._futures) < self.ahead and len(self._queue) > 0:
+            index = self._queue.popleft()
+            self._futures[index] = self._executor.submit(_SerializedPart, self.batch_parts[index], self.compression,
+                                                         index)
+
+
+class Instrumentation(object):
+    """Instrumentation receives timings and sizes from a client as it submits batches
+
+    Pass an instance to the client to collect them: override the methods of the events you're interested
+    in - the ones here do nothing. Methods are called from the threads sending the parts, so they must be
+    thread-safe, and quick. tagging_metrics has implementations exporting to StatsD and Prometheus.
+    url is the URL the batch is submitted to, which identifies the custom dimension (or tags)."""
+
+    def batch_packed(self, url, part_count, seconds):
+        """A batch was packed into part_count parts, taking seconds"""
+
+    def part_serialized(self, url, index, estimated_bytes, json_bytes, body_bytes, seconds):
+        """Part number 'index' of a batch was serialized and is about to be sent
+
+        estimated_bytes is the size of the (maybe compressed) request body the part was packed by, body_bytes
+        its actual size, and json_bytes the size of the uncompressed JSON. Serializing took seconds."""
+
+    def request_finished(self, method, url, status, body_bytes, seconds, attempt):
+        """An HTTP request got a response with status (None for a connection error or timeout)
+
+        body_bytes is the size of the request body, and attempt is 0 for the first try and counts up
+        for the retries."""
+
+    def request_retried(self, method, url, attempt, delay):
+        """A request is retried (for the 'attempt' time) after waiting delay seconds"""
+
+    def part_sent(self, url, index, guid, seconds):
+        """Part number 'index' of batch guid was accepted, taking seconds including any retries"""
+
+    def part_resplit(self, url, index, part_bytes, part_count, size):
+        """Part number 'index', packed to part_bytes, was too big and was re-split into part_count parts of size"""
+
+    def batch_submitted(self, url, guid, part_count, seconds):
+        """All part_count parts of batch guid were accepted, in seconds from when the batch was packed
+
+        For a StreamingBatch, seconds are counted from when it was started."""
+
+    def batch_finished(self, batch_response, seconds):
+        """Polling the status saw a batch had finished processing, seconds after it was submitted
+
+        If the batch was submitted by another client, seconds is counted from when the wait started."""
+
+
+class _SubmissionTimes(object):
+    """Remembers when recent batches were submitted, to time how long the server takes to process them"""
+
+    # how many batches to remember
+    limit = 10000
+
+    def __init__(self):
+        self._times = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, guid):
+        with self._lock:
+            self._times[guid] = time.perf_counter()
+            if len(self._times) > self.limit:
+                self._times.popitem(last=False)
+
+    def pop(self, guid, default):
+        with self._lock:
+            return self._times.pop(guid, default)
+
+
+def _batch_submitted(client, url, guid, part_count, started):
+    """Report a submitted batch to the client's instrumentation"""
+    client._submission_times.add(guid)
+    client.instrumentation.batch_submitted(url, guid, part_count, time.perf_counter() - started)
+
+
+def _batch_finished(client, batch_response, wait_started):
+    """Report a batch seen finishing to the client's instrumentation"""
+    started = client._submission_times.pop(batch_response.guid, wait_started)
+    client.instrumentation.batch_finished(batch_response, time.perf_counter() - started)
+
+
 class Client(object):
-    """Tagging client submits HyperScale batches to Kentik"""
+    """Tagging client submits HyperScale batches to Kentik
+
+    The client keeps a pool of keep-alive HTTP connections that is shared by all batch part
+    submissions and status checks. Call close() when done, or use the client as a context manager:
+
+        with tagging.Client('my@email.com', 'my_token') as client:
+            client.submit_populator_batch('c_my_column', batch)
+    """
+
+    def __init__(self, api_email, api_token, base_url='https://api.kentik.com',
+                 pool_size=10, timeout=(10, 300), compression=None, max_in_flight=1,
+                 max_retries=3, backoff_factor=0.5, backoff_max=30, serialize_ahead=2, instrumentation=None,
+                 part_size=None, rate_limiter=None, split_values=False):
+        """Create a client
+
+        pool_size is the maximum number of connections kept alive per host. timeout is passed
+        to each HTTP request: either a single number of seconds, or a (connect, read) tuple.
+        compression can be 'gzip' or 'deflate' to compress batch parts on upload - parts are then
+        sized by their compressed size, so far fewer requests are needed per batch.
+        max_in_flight is how many parts of a batch may be sent at once: after the first part returns
+        the batch guid, up to max_in_flight of the middle parts are sent concurrently, and the last
+        part is sent once they've all succeeded.
+        Requests failing with a connection error, a timeout, a 429 or a 5xx response are retried up to
+        max_retries times, waiting a random time of up to backoff_factor * 2^(retry - 1) seconds
+        (but no more than backoff_max) before each retry - or as long as the Retry-After header of a 429 or
+        503 response says, if that's longer.
+        serialize_ahead is how many of the upcoming parts of a batch are serialized (and compressed)
+        in background threads while earlier parts are being sent - 0 builds each part just before
+        it's sent.
+        instrumentation, an Instrumentation, receives timings and sizes of the batch submissions.
+        part_size, a PartSizePolicy, decides how big batch parts are - by default, they start at 700KB
+        and shrink if the server rejects them as too large or is slow to take them.
+        rate_limiter, eg. a tagging_scheduler.TokenBucket, is waited on before every request, and told
+        about every 429 response - share one between clients to keep them all under an API rate limit.
+        split_values lets the criteria of a value too big for one part be split into upserts in several
+        parts - only for a server that combines them, as the last upsert of a value wins otherwise. By default,
+        submitting such a value raises a ValueError."""
+        if pool_size < 1:
+            raise ValueError("Invalid pool_size. Must be at least 1.")
+        if max_in_flight < 1 or max_in_flight > pool_size:
+            raise ValueError("Invalid max_in_flight. Valid: 1-pool_size.")
+        if compression is not None and compression not in _compressionWbits:
+            raise ValueError("Invalid compression. Valid: %s." % ', '.join(sorted(_compressionWbits)))
+        if max_retries < 0:
+            raise ValueError("Invalid max_retries. Must be at least 0.")
+        if serialize_ahead < 0:
+            raise ValueError("Invalid serialize_ahead. Must be at least 0.")
 
-    def __init__(self, api_email, api_token, base_url='https://api.kentik.com'):
         self.api_email = api_email
         self.api_token = api_token
         self.base_url = base_url
-
-    def _submit_batch(self, url, batch):
-        """Submit the batch, returning the JSON->dict from the last HTTP response"""
-        # TODO: validate column_name
-        batch_parts = batch.parts()
-
-        guid = ""
-        headers = {
-            'User-Agent': 'kentik-python-api/0.1',
-            'Content-Type': 'application/json',
-            'X-CH-Auth-Email': self.api_email,
-            'X-CH-Auth-API-Token': self.api_token
-        }
-
-        # submit each part
-        last_part = dict()
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.compression = compression
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.serialize_ahead = serialize_ahead
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.part_size = part_size if part_size is not None else PartSizePolicy()
+        self.rate_limiter = rate_limiter
+        self.split_values = split_values
+        self._submission_times = _SubmissionTimes()
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._session.headers.update(_request_headers(api_email, api_token))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close all pooled connections"""
+        self._session.close()
+
+    def _request(self, method, url, retry_timeouts=True, **kwargs):
+        """Send an HTTP request, retrying it on transient errors, and return the successful response
+
+        With retry_timeouts False, a timeout waiting for the response is raised right away."""
+        body_bytes = len(kwargs.get('data') or b'')
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            start = time.perf_counter()
+            retry_after = None
+            try:
+                resp = self._session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.instrumentation.request_finished(method, url, None, body_bytes, time.perf_counter() - start,
+                                                      attempt)
+                if attempt >= self.max_retries or (not retry_timeouts and isinstance(e, requests.ReadTimeout)):
+                    raise
+                _logger.info('%s %s failed, retrying: %s', method, url, e)
+            else:
+                self.instrumentation.request_finished(method, url, resp.status_code, body_bytes,
+                                                      time.perf_counter() - start, attempt)
+                if resp.status_code in (429, 503):
+                    retry_after = _retry_after(resp.headers)
+                if resp.status_code == 429 and self.rate_limiter is not None:
+                    self.rate_limiter.throttled(retry_after)
+                if resp.status_code not in _retryStatusCodes or attempt >= self.max_retries:
+                    # break out at first sign of trouble
+                    resp.raise_for_status()
+                    return resp
+                _logger.info('%s %s failed with HTTP %d, retrying', method, url, resp.status_code)
+
+            attempt += 1
+            delay = _retry_delay(attempt, self.backoff_factor, self.backoff_max)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            self.instrumentation.request_retried(method, url, attempt, delay)
+            time.sleep(delay)
+
+    def _send_part(self, url, batch_part, guid, index=None):
+        """Send a single batch part, returning the JSON->dict from the HTTP response"""
+        return self._send_sized_part(url, _SerializedPart(batch_part, self.compression, index), guid)
+
+    def _send_sized_part(self, url, serialized_part, guid):
+        """Send a batch part, re-splitting it into smaller parts if it's too big for the server
+
+        Returns the JSON->dict from the HTTP response to the (last) part."""
+        if serialized_part.batch_part is None:
+            # spooled - it's sent as it was serialized
+            return self._send_serialized_part(url, serialized_part, guid)
+        part_size = _part_size(serialized_part.batch_part)
+        can_shrink = self.part_size.can_shrink(part_size)
+        if can_shrink and part_size > self.part_size.size:
+            # packed before the size came down - split it now, rather than have it fail
+            batch_parts = _resplit_part(serialized_part.batch_part, self.part_size.size, self.compression,
+                                        self.split_values)
+            if len(batch_parts) > 1:
+                return self._send_resplit_parts(url, serialized_part.index, batch_parts, guid)
+
+        start = time.perf_counter()
+        try:
+            # a part that can be made smaller is re-split right away on a timeout, rather than retried as is
+            resp_json_dict = self._send_serialized_part(url, serialized_part, guid, retry_timeouts=not can_shrink)
+        except (requests.HTTPError, requests.ReadTimeout) as e:
+            if not can_shrink or not _is_too_big_error(e):
+                raise
+            size = self.part_size.shrink(part_size, rejected=isinstance(e, requests.HTTPError))
+            batch_parts = _resplit_part(serialized_part.batch_part, size, self.compression, self.split_values)
+            if len(batch_parts) < 2:
+                raise
+            _logger.warning('Batch part %s of %d bytes failed (%s), re-splitting it into %d parts of %d bytes',
+                            serialized_part.index, part_size, e, len(batch_parts), size)
+            self.instrumentation.part_resplit(url, serialized_part.index, part_size, len(batch_parts), size)
+            return self._send_resplit_parts(url, serialized_part.index, batch_parts, guid)
+
+        self.part_size.part_sent(part_size, time.perf_counter() - start)
+        return resp_json_dict
+
+    def _send_resplit_parts(self, url, index, batch_parts, guid):
+        """Send the parts a part was re-split into, in its place"""
         for batch_part in batch_parts:
-            # submit
-            resp = requests.post(url, headers=headers, data=batch_part.build_json(guid))
-
-            # print the HTTP response to help debug
-            print(resp.text)
-
-            # break out at first sign of trouble
-            resp.raise_for_status()
-            last_part = resp.json()
+            resp_json_dict = self._send_sized_part(url, _SerializedPart(batch_part, self.compression, index), guid)
+            guid = resp_json_dict['guid']
+        return resp_json_dict
+
+    def _send_serialized_part(self, url, serialized_part, guid, retry_timeouts=True):
+        """Send a single serialized batch part, returning the JSON->dict from the HTTP response"""
+        start = time.perf_counter()
+        headers, data = serialized_part.request(guid)
+        self.instrumentation.part_serialized(url, serialized_part.index,
+                                             serialized_part.estimated_body_size(guid), serialized_part.json_size(guid),
+                                             len(data), serialized_part.seconds)
+        resp = self._request('POST', url, retry_timeouts=retry_timeouts, headers=headers, data=data)
+
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug('Batch part %s response: %s', serialized_part.index, resp.text)
+
+        resp_json_dict = _check_part_response(resp.json())
+        self.instrumentation.part_sent(url, serialized_part.index, resp_json_dict['guid'],
+                                       time.perf_counter() - start)
+        return resp_json_dict
+
+    def _submit_batch(self, url, batch, checkpoint=None):
+        """Submit the batch, returning the JSON->dict from the last HTTP response"""
+        resumable = checkpoint is not None
+        if checkpoint is None:
+            checkpoint = SubmissionCheckpoint()
+        # a resumed submission is split into the same parts as before
+        part_size = checkpoint._planned_part_size(url) or self.part_size.size
+
+        start = time.perf_counter()
+        batch_parts = batch.parts(part_size, compression=self.compression, split_values=self.split_values)
+        self.instrumentation.batch_packed(url, len(batch_parts), time.perf_counter() - start)
+        start = time.perf_counter()
+
+        # a resumed submission skips the parts the server already has - hashing them is only needed to resume
+        fingerprint = _parts_fingerprint(batch_parts) if resumable else None
+        first = checkpoint._start(url, fingerprint, part_size)
+        middle, order = _submission_order(batch_parts, first, checkpoint)
+
+        # upcoming parts are serialized in the background while the ones before them are sent
+        with _PartSerializer(batch_parts, order, self.compression, self.serialize_ahead) as serializer:
+            return self._send_parts(url, serializer, len(batch_parts), first, middle, checkpoint, start)
+
+    def _submit_spool(self, url, spool, checkpoint=None):
+        """Submit the parts of a BatchSpool, returning the JSON->dict from the last HTTP response"""
+        if checkpoint is None:
+            checkpoint = SubmissionCheckpoint()
+        start = time.perf_counter()
+        # a checkpoint of the same batch submitted from memory resumes from the spool, and the other way around
+        first = checkpoint._start(url, spool.fingerprint, spool.part_size)
+        middle, _ = _submission_order(spool, first, checkpoint)
+        return self._send_parts(url, spool, len(spool), first, middle, checkpoint, start)
+
+    def _send_parts(self, url, parts, part_count, first, middle, checkpoint, start):
+        """Send the parts of a batch not sent yet - parts.get(index) returns a _SerializedPart"""
+        guid = checkpoint.guid
+        if first == 0:
+            # the first part gets us the guid
+            last_part = self._send_sized_part(url, parts.get(0), "")
             guid = last_part['guid']
-            if guid is None or len(guid) == 0:
-                raise RuntimeError('guid not found in batch response')
+            checkpoint._ack(0, guid)
+            if part_count == 1:
+                checkpoint.clear()
+                _batch_submitted(self, url, guid, part_count, start)
+                return last_part
+
+        # submit the parts in between
+        if self.max_in_flight == 1:
+            for index in middle:
+                self._send_sized_part(url, parts.get(index), guid)
+                checkpoint._ack(index, guid)
+        else:
+            self._send_parts_pipelined(url, parts, middle, guid, checkpoint)
 
+        # the last part completes the batch, once everything before it is in
+        last_part = self._send_sized_part(url, parts.get(part_count - 1), guid)
+        checkpoint.clear()
+        _batch_submitted(self, url, guid, part_count, start)
         return last_part
 
-    def submit_populator_batch(self, column_name, batch):
+    def _send_parts_pipelined(self, url, parts, indexes, guid, checkpoint):
+        """Send batch parts concurrently, up to max_in_flight at a time, stopping at the first error"""
+        if len(indexes) == 0:
+            return
+
+        def send(index):
+            return self._send_sized_part(url, parts.get(index), guid)
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            futures = dict()
+            for index in indexes:
+                futures[executor.submit(send, index)] = index
+
+            # on the first error, cancel the parts not sent yet, but still record the ones in flight that succeed
+            error = None
+            not_done = set(futures)
+            while len(not_done) > 0:
+                done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.cancelled():
+                        continue
+                    if future.exception() is None:
+                        checkpoint._ack(futures[future], guid)
+                    elif error is None:
+                        error = future.exception()
+                        for pending in not_done:
+                            pending.cancel()
+
+        if error is not None:
+            raise error
+
+    def submit_populator_batch(self, column_name, batch, checkpoint=None):
         """Submit a populator batch
 
         Submit a populator batch as a series of HTTP requests in small chunks,
-        returning the batch GUID, or raising exception on error."""
-        if not set(column_name).issubset(_allowedCustomDimensionChars):
-            raise ValueError('Invalid custom dimension name "%s": must only contain letters, digits, and underscores' % column_name)
-        if len(column_name) < 3 or len(column_name) > 20:
-            raise ValueError('Invalid value "%s": must be between 3-20 characters' % column_name)
+        returning the batch GUID, or raising exception on error.
+        Pass a SubmissionCheckpoint to be able to resume the submission if it fails."""
+        url = _populator_url(self.base_url, column_name)
+        resp_json_dict = self._submit_batch(url, batch, checkpoint)
+        _check_batch_error(resp_json_dict)
+
+        return resp_json_dict['guid']
+
+    def submit_tag_batch(self, batch, checkpoint=None):
+        """Submit a tag batch, returning the batch GUID, or raising exception on error"""
+        resp_json_dict = self._submit_batch(_tag_url(self.base_url), batch, checkpoint)
+        _check_batch_error(resp_json_dict)
+
+        return resp_json_dict['guid']
+
+    def submit_populator_spool(self, column_name, spool, checkpoint=None):
+        """Submit a populator batch from a BatchSpool, returning the batch GUID, or raising exception on error
 
-        url = '%s/api/v5/batch/customdimensions/%s/populators' % (self.base_url, column_name)
-        resp_json_dict = self._submit_batch(url, batch)
-        if resp_json_dict.get('error') is not None:
-            raise RuntimeError('Error received from server: %s' % resp_json_dict['error'])
+        The parts are sent as they were written to the spool - their size and compression are the spool's,
+        whatever the client's part_size and compression. Pass a SubmissionCheckpoint to be able to resume
+        the submission if it fails."""
+        resp_json_dict = self._submit_spool(_populator_url(self.base_url, column_name), spool, checkpoint)
+        _check_batch_error(resp_json_dict)
 
         return resp_json_dict['guid']
 
-    def submit_tag_batch(self, batch):
-        """Submit a tag batch"""
-        url = '%s/api/v5/batch/tags' % self.base_url
-        self._submit_batch(url, batch)
+    def submit_tag_spool(self, spool, checkpoint=None):
+        """Submit a tag batch from a BatchSpool, returning the batch GUID, or raising exception on error"""
+        resp_json_dict = self._submit_spool(_tag_url(self.base_url), spool, checkpoint)
+        _check_batch_error(resp_json_dict)
+
+        return resp_json_dict['guid']
+
+    def stream_populator_batch(self, column_name, replace_all, max_upload_size=None, validation=None):
+        """Start a populator batch that is submitted while it's being built
+
+        Returns a StreamingBatch - parts are sent as soon as they're full, and the last part
+        is sent when the StreamingBatch is closed. Parts are sized by the client's part_size
+        policy, unless max_upload_size is given."""
+        return StreamingBatch(self, _populator_url(self.base_url, column_name), replace_all, max_upload_size,
+                              validation)
+
+    def stream_tag_batch(self, replace_all, max_upload_size=None, validation=None):
+        """Start a tag batch that is submitted while it's being built"""
+        return StreamingBatch(self, _tag_url(self.base_url), replace_all, max_upload_size, validation)
 
     def fetch_batch_status(self, guid):
         """Fetch the status of a batch, given the guid"""
-        url = '%s/api/v5/batch/%s/status' % (self.base_url, guid)
-        headers = {
-            'User-Agent': 'kentik-python-api/0.1',
-            'Content-Type': 'application/json',
-            'X-CH-Auth-Email': self.api_email,
-            'X-CH-Auth-API-Token': self.api_token
-        }
-
-        resp = requests.get(url, headers=headers)
-
-        # break out at first sign of trouble
-        resp.raise_for_status()
+        resp = self._request('GET', _status_url(self.base_url, guid))
         return BatchResponse(guid, resp.json())
 
+    def iter_finished_batches(self, guids, timeout=None, poll_min=1, poll_max=30):
+        """Wait for batches to finish, yielding the BatchResponse of each batch as it finishes
+
+        The batches are polled concurrently, each one first poll_min seconds after the wait starts
+        and then less and less often, up to every poll_max seconds. Raises TimeoutError if some
+        batches still haven't finished after timeout seconds (if given)."""
+        polls = _StatusPolls(guids, timeout, poll_min, poll_max)
+        wait_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            while len(polls.pending()) > 0:
+                time.sleep(polls.wait_time())
+                futures = [executor.submit(self.fetch_batch_status, guid) for guid in polls.due()]
+                for future in as_completed(futures):
+                    batch_response = future.result()
+                    if polls.polled(batch_response):
+                        _batch_finished(self, batch_response, wait_started)
+                        yield batch_response
+
+    def wait_for_batches(self, guids, timeout=None, callback=None, poll_min=1, poll_max=30):
+        """Wait for batches to finish, returning their BatchResponses in the order of guids
+
+        callback, if given, is called with each BatchResponse as soon as its batch finishes.
+        Polling works like in iter_finished_batches."""
+        batch_responses = dict()
+        for batch_response in self.iter_finished_batches(guids, timeout, poll_min, poll_max):
+            batch_responses[batch_response.guid] = batch_response
+            if callback is not None:
+                callback(batch_response)
+        return [batch_responses[guid] for guid in guids]
+
 
 class BatchResponse(object):
     """Manages the response JSON from batch status check"""
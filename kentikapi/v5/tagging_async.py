@@ -0,0 +1,324 @@
+"""asyncio HyperScale Tagging API client
+
+Requires aiohttp - install it with the 'async' extra: pip install kentikapi[async]"""
+
+import asyncio
+import functools
+import json
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    raise ImportError('kentikapi.v5.tagging_async requires aiohttp - install it with: pip install kentikapi[async]')
+
+from kentikapi.v5 import tagging
+from kentikapi.v5.tagging import _batch_finished, _batch_submitted, _check_batch_error, _check_part_response, \
+    _compressionWbits, _part_size, _parts_fingerprint, _PartSerializer, _populator_url, _request_headers, \
+    _resplit_part, _retry_after, _retry_delay, _retryStatusCodes, _SerializedPart, _status_url, _StatusPolls, \
+    _submission_order, _SubmissionTimes, _tag_url
+
+
+_logger = logging.getLogger(__name__)
+
+
+def _is_too_big_error(e):
+    """Return whether a part request failed in a way that suggests the part is too big"""
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status == 413
+    return isinstance(e, asyncio.TimeoutError)
+
+
+async def _in_thread(func, *args, **kwargs):
+    """Run func in the event loop's default executor, so its CPU work doesn't stall the loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+class AsyncClient(object):
+    """Tagging client submits HyperScale batches to Kentik, without blocking the event loop
+
+    All requests share a pool of keep-alive connections, so one process can drive batches for many
+    custom dimensions at once:
+
+        async with AsyncClient('my@email.com', 'my_token') as client:
+            guids = await asyncio.gather(*[client.submit_populator_batch(column_name, batch)
+                                           for column_name, batch in batches])
+    """
+
+    def __init__(self, api_email, api_token, base_url='https://api.kentik.com',
+                 pool_size=10, timeout=(10, 300), compression=None, max_in_flight=1,
+                 max_retries=3, backoff_factor=0.5, backoff_max=30, serialize_ahead=2, instrumentation=None,
+                 part_size=None, split_values=False):
+        """Create a client - the options are the same as tagging.Client's
+
+        pool_size is the maximum number of connections open at once: requests wait for a free
+        connection beyond that. Batches are packed into parts, and parts re-split and serialized,
+        in threads, so building them doesn't block the event loop either."""
+        if pool_size < 1:
+            raise ValueError("Invalid pool_size. Must be at least 1.")
+        if max_in_flight < 1 or max_in_flight > pool_size:
+            raise ValueError("Invalid max_in_flight. Valid: 1-pool_size.")
+        if compression is not None and compression not in _compressionWbits:
+            raise ValueError("Invalid compression. Valid: %s." % ', '.join(sorted(_compressionWbits)))
+        if max_retries < 0:
+            raise ValueError("Invalid max_retries. Must be at least 0.")
+        if serialize_ahead < 0:
+            raise ValueError("Invalid serialize_ahead. Must be at least 0.")
+
+        self.api_email = api_email
+        self.api_token = api_token
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.compression = compression
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.serialize_ahead = serialize_ahead
+        self.instrumentation = instrumentation if instrumentation is not None else tagging.Instrumentation()
+        self.part_size = part_size if part_size is not None else tagging.PartSizePolicy()
+        self.split_values = split_values
+        self._submission_times = _SubmissionTimes()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Close all pooled connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        """Return the HTTP session, creating it in the running event loop the first time"""
+        if self._session is None:
+            if isinstance(self.timeout, tuple):
+                connect, read = self.timeout
+                timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+            else:
+                timeout = aiohttp.ClientTimeout(sock_connect=self.timeout, sock_read=self.timeout)
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                                  headers=_request_headers(self.api_email, self.api_token),
+                                                  timeout=timeout)
+        return self._session
+
+    async def _request(self, method, url, retry_timeouts=True, **kwargs):
+        """Send an HTTP request, retrying it on transient errors, and return the JSON->dict response
+
+        Also returns the response text. With retry_timeouts False, a timeout is raised right away."""
+        body_bytes = len(kwargs.get('data') or b'')
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            retry_after = None
+            try:
+                async with self._get_session().request(method, url, **kwargs) as resp:
+                    text = await resp.text()
+                    self.instrumentation.request_finished(method, url, resp.status, body_bytes,
+                                                          time.perf_counter() - start, attempt)
+                    if resp.status in (429, 503):
+                        retry_after = _retry_after(resp.headers)
+                    if resp.status not in _retryStatusCodes or attempt >= self.max_retries:
+                        # break out at first sign of trouble
+                        resp.raise_for_status()
+                        return json.loads(text), text
+                    _logger.info('%s %s failed with HTTP %d, retrying', method, url, resp.status)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.instrumentation.request_finished(method, url, None, body_bytes, time.perf_counter() - start,
+                                                      attempt)
+                if attempt >= self.max_retries or (not retry_timeouts and isinstance(e, asyncio.TimeoutError)):
+                    raise
+                _logger.info('%s %s failed, retrying: %r', method, url, e)
+
+            attempt += 1
+            delay = _retry_delay(attempt, self.backoff_factor, self.backoff_max)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            self.instrumentation.request_retried(method, url, attempt, delay)
+            await asyncio.sleep(delay)
+
+    async def _send_sized_part(self, url, serialized_part, guid):
+        """Send a batch part, re-splitting it into smaller parts if it's too big for the server
+
+        Works like tagging.Client's, returning the JSON->dict from the HTTP response to the (last) part."""
+        part_size = _part_size(serialized_part.batch_part)
+        can_shrink = self.part_size.can_shrink(part_size)
+        if can_shrink and part_size > self.part_size.size:
+            batch_parts = await _in_thread(_resplit_part, serialized_part.batch_part, self.part_size.size,
+                                           self.compression, self.split_values)
+            if len(batch_parts) > 1:
+                return await self._send_resplit_parts(url, serialized_part.index, batch_parts, guid)
+
+        start = time.perf_counter()
+        try:
+            resp_json_dict = await self._send_serialized_part(url, serialized_part, guid,
+                                                              retry_timeouts=not can_shrink)
+        except (aiohttp.ClientResponseError, asyncio.TimeoutError) as e:
+            if not can_shrink or not _is_too_big_error(e):
+                raise
+            size = self.part_size.shrink(part_size, rejected=isinstance(e, aiohttp.ClientResponseError))
+            batch_parts = await _in_thread(_resplit_part, serialized_part.batch_part, size, self.compression,
+                                           self.split_values)
+            if len(batch_parts) < 2:
+                raise
+            _logger.warning('Batch part %s of %d bytes failed (%r), re-splitting it into %d parts of %d bytes',
+                            serialized_part.index, part_size, e, len(batch_parts), size)
+            self.instrumentation.part_resplit(url, serialized_part.index, part_size, len(batch_parts), size)
+            return await self._send_resplit_parts(url, serialized_part.index, batch_parts, guid)
+
+        self.part_size.part_sent(part_size, time.perf_counter() - start)
+        return resp_json_dict
+
+    async def _send_resplit_parts(self, url, index, batch_parts, guid):
+        """Send the parts a part was re-split into, in its place"""
+        for batch_part in batch_parts:
+            serialized_part = await _in_thread(_SerializedPart, batch_part, self.compression, index)
+            resp_json_dict = await self._send_sized_part(url, serialized_part, guid)
+            guid = resp_json_dict['guid']
+        return resp_json_dict
+
+    async def _send_serialized_part(self, url, serialized_part, guid, retry_timeouts=True):
+        """Send a single serialized batch part, returning the JSON->dict from the HTTP response"""
+        start = time.perf_counter()
+        headers, data = serialized_part.request(guid)
+        self.instrumentation.part_serialized(url, serialized_part.index,
+                                             serialized_part.estimated_body_size(guid), serialized_part.json_size(guid),
+                                             len(data), serialized_part.seconds)
+        resp_json_dict, text = await self._request('POST', url, retry_timeouts=retry_timeouts, headers=headers,
+                                                   data=data)
+        _logger.debug('Batch part %s response: %s', serialized_part.index, text)
+
+        _check_part_response(resp_json_dict)
+        self.instrumentation.part_sent(url, serialized_part.index, resp_json_dict['guid'],
+                                       time.perf_counter() - start)
+        return resp_json_dict
+
+    async def _send_next_part(self, url, serializer, index, guid):
+        """Send part 'index', waiting for it to be serialized in a thread"""
+        serialized_part = await _in_thread(serializer.get, index)
+        return await self._send_sized_part(url, serialized_part, guid)
+
+    async def _submit_batch(self, url, batch, checkpoint=None):
+        """Submit the batch, returning the JSON->dict from the last HTTP response"""
+        resumable = checkpoint is not None
+        if checkpoint is None:
+            checkpoint = tagging.SubmissionCheckpoint()
+        # a resumed submission is split into the same parts as before
+        part_size = checkpoint._planned_part_size(url) or self.part_size.size
+
+        start = time.perf_counter()
+        batch_parts = await _in_thread(batch.parts, part_size, compression=self.compression,
+                                       split_values=self.split_values)
+        self.instrumentation.batch_packed(url, len(batch_parts), time.perf_counter() - start)
+        start = time.perf_counter()
+
+        # a resumed submission skips the parts the server already has - hashing them is only needed to resume
+        fingerprint = await _in_thread(_parts_fingerprint, batch_parts) if resumable else None
+        first = checkpoint._start(url, fingerprint, part_size)
+        guid = checkpoint.guid
+        middle, order = _submission_order(batch_parts, first, checkpoint)
+
+        # upcoming parts are serialized in the background while the ones before them are sent
+        with _PartSerializer(batch_parts, order, self.compression, self.serialize_ahead) as serializer:
+            if first == 0:
+                # the first part gets us the guid
+                last_part = await self._send_next_part(url, serializer, 0, "")
+                guid = last_part['guid']
+                checkpoint._ack(0, guid)
+                if len(batch_parts) == 1:
+                    checkpoint.clear()
+                    _batch_submitted(self, url, guid, len(batch_parts), start)
+                    return last_part
+
+            # submit the parts in between
+            if self.max_in_flight == 1:
+                for index in middle:
+                    await self._send_next_part(url, serializer, index, guid)
+                    checkpoint._ack(index, guid)
+            else:
+                await self._send_parts_pipelined(url, serializer, middle, guid, checkpoint)
+
+            # the last part completes the batch, once everything before it is in
+            last_part = await self._send_next_part(url, serializer, len(batch_parts) - 1, guid)
+        checkpoint.clear()
+        _batch_submitted(self, url, guid, len(batch_parts), start)
+        return last_part
+
+    async def _send_parts_pipelined(self, url, serializer, indexes, guid, checkpoint):
+        """Send batch parts concurrently, up to max_in_flight at a time, stopping at the first error"""
+        if len(indexes) == 0:
+            return
+
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        errors = []
+
+        async def send(index):
+            async with semaphore:
+                # after the first error, skip the parts not sent yet, but let the ones in flight finish
+                if len(errors) > 0:
+                    return
+                try:
+                    await self._send_next_part(url, serializer, index, guid)
+                except Exception as e:
+                    errors.append(e)
+                    return
+                checkpoint._ack(index, guid)
+
+        await asyncio.gather(*[send(index) for index in indexes])
+        if len(errors) > 0:
+            raise errors[0]
+
+    async def submit_populator_batch(self, column_name, batch, checkpoint=None):
+        """Submit a populator batch
+
+        Submit a populator batch as a series of HTTP requests in small chunks,
+        returning the batch GUID, or raising exception on error.
+        Pass a SubmissionCheckpoint to be able to resume the submission if it fails."""
+        url = _populator_url(self.base_url, column_name)
+        resp_json_dict = await self._submit_batch(url, batch, checkpoint)
+        _check_batch_error(resp_json_dict)
+
+        return resp_json_dict['guid']
+
+    async def submit_tag_batch(self, batch, checkpoint=None):
+        """Submit a tag batch, returning the batch GUID, or raising exception on error"""
+        resp_json_dict = await self._submit_batch(_tag_url(self.base_url), batch, checkpoint)
+        _check_batch_error(resp_json_dict)
+
+        return resp_json_dict['guid']
+
+    async def fetch_batch_status(self, guid):
+        """Fetch the status of a batch, given the guid"""
+        resp_json_dict, _ = await self._request('GET', _status_url(self.base_url, guid))
+        return tagging.BatchResponse(guid, resp_json_dict)
+
+    async def iter_finished_batches(self, guids, timeout=None, poll_min=1, poll_max=30):
+        """Wait for batches to finish, yielding the BatchResponse of each batch as it finishes
+
+        Polling works like in tagging.Client.iter_finished_batches."""
+        polls = _StatusPolls(guids, timeout, poll_min, poll_max)
+        wait_started = time.perf_counter()
+        while len(polls.pending()) > 0:
+            await asyncio.sleep(polls.wait_time())
+            for next_response in asyncio.as_completed([self.fetch_batch_status(guid) for guid in polls.due()]):
+                batch_response = await next_response
+                if polls.polled(batch_response):
+                    _batch_finished(self, batch_response, wait_started)
+                    yield batch_response
+
+    async def wait_for_batches(self, guids, timeout=None, callback=None, poll_min=1, poll_max=30):
+        """Wait for batches to finish, returning their BatchResponses in the order of guids
+
+        callback, if given, is called with each BatchResponse as soon as its batch finishes."""
+        batch_responses = dict()
+        async for batch_response in self.iter_finished_batches(guids, timeout, poll_min, poll_max):
+            batch_responses[batch_response.guid] = batch_response
+            if callback is not None:
+                callback(batch_response)
+        return [batch_responses[guid] for guid in guids]
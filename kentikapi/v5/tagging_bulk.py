@@ -0,0 +1,227 @@
+"""Bulk construction of HyperScale batches from columnar data
+
+Building a batch row by row with Criteria and Batch.add_upsert validates and encodes every row separately.
+The functions here take whole columns instead - NumPy arrays, pandas columns, or plain sequences - validate
+each column in one pass, group the rows by value and criteria, and encode each group once."""
+
+from collections import OrderedDict
+from numbers import Real
+import re
+import socket
+
+from kentikapi.v5 import tagging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def batch_from_columns(replace_all, value, direction, addr=None, port=None, protocol=None, asn=None):
+    """Return a Batch with one populator (or tag) per row of the columns
+
+    value and direction are required columns. addr (IP addresses or CIDR prefixes), port, protocol and asn
+    are optional columns, and rows can leave them empty with None (or NaN). Each row is a criteria for its
+    value, as if it was built like:
+
+        crit = tagging.Criteria(direction[i])
+        crit.add_ip_address(addr[i])
+        crit.add_port(port[i])
+        crit.add_protocol(protocol[i])
+        crit.add_asn(asn[i])
+        batch.add_upsert(value[i], crit)
+
+    but rows with the same value, direction, port, protocol and ASN are grouped into one criteria with all
+    of their addresses, which matches the same flows. Unlike add_ip_address(), an address that isn't an IP
+    address or CIDR prefix raises ValueError."""
+    values = _string_column(value, 'value')
+    row_count = len(values)
+    directions = _direction_column(direction, row_count)
+    addrs = _address_column(addr, row_count)
+    ports = _number_column(port, 'port', 0, 65535, row_count)
+    protocols = _number_column(protocol, 'protocol', 0, 255, row_count)
+    asns = _number_column(asn, 'asn', 0, 4294967295, row_count)
+
+    # group the rows into criteria - only the addresses differ within a group. Rows without an address
+    # match any address, so they're kept apart from rows with one
+    groups = OrderedDict()
+    addressless = OrderedDict()
+    ipv6 = any(':' in ip for ip in set(addrs) if ip is not None)
+    for v, d, p, proto, a, ip in zip(values, directions, ports, protocols, asns, addrs):
+        key = (v, d, p, proto, a)
+        if ip is None:
+            addressless[key] = None
+            continue
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [ip]
+        else:
+            group.append(ip)
+
+    batch = tagging.Batch(replace_all)
+    for key, group in list(groups.items()) + list(addressless.items()):
+        batch._add_encoded_upsert(key[0], [_encode_criteria(key, group, ipv6)])
+    return batch
+
+
+def _encode_criteria(key, addrs, ipv6=True):
+    """Return the JSON of a criteria, encoded the same way as Criteria.encode()
+
+    addrs are canonical addresses, as from _address_column(), and ipv6 is False if none of them is IPv6."""
+    _, d, p, proto, a = key
+    encoded = ['{"direction": "', d, '"']
+    if addrs is not None:
+        if ipv6 and any(':' in ip for ip in addrs):
+            # Criteria lists IPv4 addresses before IPv6 ones
+            addrs = [ip for ip in addrs if ':' not in ip] + [ip for ip in addrs if ':' in ip]
+        encoded.append(', "addr": ["')
+        encoded.append('", "'.join(addrs))
+        encoded.append('"]')
+    if p is not None:
+        encoded.append(', "port": ["%d"]' % p)
+    if proto is not None:
+        encoded.append(', "protocol": [%d]' % proto)
+    if a is not None:
+        encoded.append(', "asn": ["%d"]' % a)
+    encoded.append('}')
+    return ''.join(encoded).encode('utf-8')
+
+
+def batch_from_dataframe(replace_all, df, value='value', direction='direction', addr='addr', port='port',
+                         protocol='protocol', asn='asn'):
+    """Return a Batch with one populator (or tag) per row of a pandas DataFrame
+
+    The arguments name the DataFrame columns to use, as in batch_from_columns - optional columns that
+    aren't in the DataFrame are left out."""
+
+    def column(name):
+        if name is None or name not in df.columns:
+            return None
+        return df[name]
+
+    return batch_from_columns(replace_all, df[value], df[direction], addr=column(addr), port=column(port),
+                              protocol=column(protocol), asn=column(asn))
+
+
+def _to_list(column):
+    if hasattr(column, 'tolist'):
+        return column.tolist()
+    return list(column)
+
+
+def _check_length(column, name, row_count):
+    if len(column) != row_count:
+        raise ValueError("Invalid %s column. Expected %d rows, got %d." % (name, row_count, len(column)))
+
+
+def _is_missing(x):
+    return x is None or x != x   # NaN isn't equal to itself
+
+
+def _check_strings(column, name, missing_ok=False):
+    """Raise ValueError on the first row of a column that isn't a string - or is missing, unless missing_ok"""
+    for row, s in enumerate(column):
+        if isinstance(s, str) or (missing_ok and _is_missing(s)):
+            continue
+        if _is_missing(s):
+            raise ValueError("Invalid %s in row %d. Value is missing." % (name, row))
+        raise ValueError("Invalid %s in row %d. Value must be a string." % (name, row))
+
+
+def _string_column(column, name):
+    strings = _to_list(column)
+    _check_strings(strings, name)
+    strings = [s.strip() for s in strings]
+    if '' in strings:
+        raise ValueError("Invalid %s in row %d. Value is empty." % (name, strings.index('')))
+    return strings
+
+
+def _direction_column(column, row_count):
+    directions = _to_list(column)
+    _check_strings(directions, 'direction')
+    directions = [d.lower() for d in directions]
+    _check_length(directions, 'direction', row_count)
+    invalid = set(directions) - set(["src", "dst", "either"])
+    if len(invalid) > 0:
+        raise ValueError("Invalid direction in row %d. Valid: src, dst, either."
+                         % directions.index(next(iter(invalid))))
+    return directions
+
+
+def _address_column(column, row_count):
+    """Return a column of addresses in the form Criteria lists them in (None where missing), checking
+    they're IP addresses or CIDR prefixes"""
+    if column is None:
+        return [None] * row_count
+
+    addrs = _to_list(column)
+    _check_strings(addrs, 'addr', missing_ok=True)
+    addrs = [None if _is_missing(a) else a.strip() for a in addrs]
+    _check_length(addrs, 'addr', row_count)
+    if '' in addrs:
+        raise ValueError("Invalid addr in row %d. Value is empty." % addrs.index(''))
+
+    # addresses repeat across rows - parse each one once
+    canonical = dict((a, a if _isCanonicalIPv4(a) else _canonical_address(a)) for a in set(addrs) if a is not None)
+    if None in canonical.values():
+        row = next(i for i, a in enumerate(addrs) if a is not None and canonical[a] is None)
+        raise ValueError("Invalid addr in row %d. Valid: IP addresses and CIDR prefixes." % row)
+    canonical[None] = None
+    return [canonical[a] for a in addrs]
+
+
+# IPv4 addresses and prefixes already written the way Criteria lists them - the common case, checked without
+# parsing them
+_octet = r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+_isCanonicalIPv4 = re.compile(r'\.'.join([_octet] * 4) + r'(?:/(?:3[0-2]|[12]?[0-9]))?\Z').match
+
+
+def _canonical_address(address):
+    """Return an address as Criteria lists it - IPv6 in its canonical form - or None if it isn't an IP address
+    or CIDR prefix"""
+    parsed = tagging._parse_address(address)
+    if parsed is None:
+        return None
+    packed, prefix_length = parsed
+    ip = socket.inet_ntop(socket.AF_INET if len(packed) == 4 else socket.AF_INET6, packed)
+    if prefix_length is None:
+        return ip
+    return '%s/%d' % (ip, prefix_length)
+
+
+def _number_column(column, name, low, high, row_count):
+    """Return a column of integers (None where missing), checking they're between low and high"""
+    if column is None:
+        return [None] * row_count
+
+    if numpy is not None and hasattr(column, 'dtype'):
+        a = numpy.asarray(column)
+        if a.dtype.kind in 'iu':
+            # no missing values - check the whole column at once
+            _check_length(a, name, row_count)
+            bad = numpy.nonzero((a < low) | (a > high))[0]
+            if len(bad) > 0:
+                raise ValueError("Invalid %s in row %d. Valid: %d-%d." % (name, bad[0], low, high))
+            return a.tolist()
+        if a.dtype.kind == 'f':
+            # NaN marks missing values
+            _check_length(a, name, row_count)
+            present = ~numpy.isnan(a)
+            bad = numpy.nonzero(present & ((a < low) | (a > high) | (a != numpy.floor(a))))[0]
+            if len(bad) > 0:
+                raise ValueError("Invalid %s in row %d. Valid: %d-%d." % (name, bad[0], low, high))
+            return [int(x) if p else None for x, p in zip(a.tolist(), present.tolist())]
+
+    numbers = [None if _is_missing(x) else x for x in _to_list(column)]
+    _check_length(numbers, name, row_count)
+    present = [x for x in numbers if x is not None]
+    if len(present) > 0 and (not all(isinstance(x, Real) for x in present) or min(present) < low
+                             or max(present) > high):
+        bad = next(i for i, x in enumerate(numbers) if x is not None and not (isinstance(x, Real) and low <= x <= high))
+        raise ValueError("Invalid %s in row %d. Valid: %d-%d." % (name, bad, low, high))
+    integers = [None if x is None else int(x) for x in numbers]
+    if integers != numbers:
+        bad = next(i for i, (x, n) in enumerate(zip(numbers, integers)) if x != n)
+        raise ValueError("Invalid %s in row %d. Valid: %d-%d." % (name, bad, low, high))
+    return integers
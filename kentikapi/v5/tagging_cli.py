@@ -0,0 +1,307 @@
+"""Command line tool to push HyperScale populators and tags from CSV or JSON lines files
+
+    kentik-tagging push --dimension c_my_column --replace-all populators.csv
+    kentik-tagging push --tags --format jsonl - < tags.jsonl
+    kentik-tagging push --dimension c_my_column --replace-all --dry-run populators.csv.gz
+
+Rows are streamed to Kentik as they're read - each batch part is sent as soon as it's full - so memory use
+doesn't grow with the size of the input. The API credentials are taken from the KENTIK_API_EMAIL and
+KENTIK_API_TOKEN environment variables, or from --email and --token.
+
+A CSV file has a header row naming its columns: 'value', 'direction' (or --direction for every row), and any
+of the criteria fields as they're named in the batch API JSON - addr, port, protocol, asn, site, device_name,
+and so on. A cell can hold several values separated by ';', and ports, VLANs and ASNs can be ranges like
+1000-2000. Empty cells are left out of the criteria.
+
+A JSON lines file has an object per line: either an upsert as in the batch API, like
+{"value": "web", "criteria": [{"direction": "src", "addr": ["10.0.0.0/8"]}]}, a value with a single criteria,
+like {"value": "web", "direction": "src", "addr": ["10.0.0.0/8"]}, or a delete, like
+{"value": "old", "delete": true}.
+
+Give all the rows of a value one after another, so they're sent as a single upsert. Rows of a value that come
+back after other values are merged into its upsert only while its part is still being filled: the push warns
+about such ungrouped input, as a value that comes back after its part was sent is upserted twice, and the
+server keeps the last upsert."""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+from kentikapi.v5 import tagging
+
+
+# errors listed in the summary of a push, when invalid rows are skipped
+_maxErrorsShown = 10
+
+
+class _ProgressInstrumentation(tagging.Instrumentation):
+    """Counts the parts a push has sent, and the bytes of every request sending them"""
+
+    def __init__(self):
+        self.parts = 0
+        self.json_bytes = 0
+        self.body_bytes = 0
+        self.resplits = 0
+
+    def part_serialized(self, url, index, estimated_bytes, json_bytes, body_bytes, seconds):
+        self.json_bytes += json_bytes
+        self.body_bytes += body_bytes
+
+    def part_sent(self, url, index, guid, seconds):
+        self.parts += 1
+
+    def part_resplit(self, url, index, part_bytes, part_count, size):
+        self.resplits += 1
+
+
+class _DryRunClient(tagging.Client):
+    """Client that serializes batch parts exactly as it would send them, without sending them"""
+
+    def _send_serialized_part(self, url, serialized_part, guid, retry_timeouts=True):
+        headers, data = serialized_part.request(guid)
+        self.instrumentation.part_serialized(url, serialized_part.index,
+                                             serialized_part.estimated_body_size(guid), serialized_part.json_size(guid),
+                                             len(data), serialized_part.seconds)
+        self.instrumentation.part_sent(url, serialized_part.index, 'dry-run', 0)
+        return {'guid': 'dry-run'}
+
+
+class _Push(object):
+    """Streams the rows of an input into a batch, skipping or rejecting invalid ones"""
+
+    def __init__(self, batch, instrumentation, strict, progress_interval):
+        self.batch = batch
+        self.instrumentation = instrumentation
+        self.strict = strict
+        self.rows = 0
+        self.upserts = 0
+        self.deletes = 0
+        self.errors = []              # the first few (line, error) of the skipped rows
+        self.skipped = 0
+        self.ungrouped_line = None    # where a value first came back after other values
+        self._progress_interval = progress_interval
+        self._started = time.perf_counter()
+        self._last_progress = self._started
+
+    def add(self, line, value, criteria_list, delete):
+        """Add the row at a line, with a list of criteria dicts to upsert, or a delete"""
+        self.rows += 1
+        try:
+            if delete:
+                self.batch.add_delete(value)
+                self.deletes += 1
+            else:
+                if not value.strip():
+                    raise ValueError("Invalid value. Value is empty.")
+                criteria = [tagging.Criteria.from_dict(d) for d in criteria_list]
+                if len(criteria) == 0:
+                    raise ValueError("Invalid row. It has no criteria.")
+                for c in criteria:
+                    invalid = c.invalid_values()
+                    if invalid:
+                        raise ValueError('Invalid %s "%s".' % invalid[0])
+                for c in criteria:
+                    self.batch.add_upsert(value, c)
+                self.upserts += 1
+                if self.ungrouped_line is None and self.batch.values_regrouped > 0:
+                    self.ungrouped_line = line
+                    sys.stderr.write('warning: line %d: the input isn\'t grouped by value - sort it by value, '
+                                     'or criteria of values that come back after their part was sent are lost\n'
+                                     % line)
+        except (ValueError, TypeError, AttributeError) as e:
+            if self.strict:
+                raise ValueError('line %d: %s' % (line, e))
+            self.skipped += 1
+            if len(self.errors) < _maxErrorsShown:
+                self.errors.append((line, str(e)))
+
+        if self._progress_interval and self.rows % 1000 == 0:
+            now = time.perf_counter()
+            if now - self._last_progress >= self._progress_interval:
+                self._last_progress = now
+                self.report_progress(now)
+
+    def report_progress(self, now):
+        seconds = now - self._started
+        sys.stderr.write('%d rows read, %d parts sent (%.1f MB), %d rows/s\n'
+                         % (self.rows, self.instrumentation.parts, self.instrumentation.body_bytes / 1e6,
+                            self.rows / seconds if seconds > 0 else 0))
+        sys.stderr.flush()
+
+    def seconds(self):
+        return time.perf_counter() - self._started
+
+
+def _open_input(path):
+    """Open an input file as text - '-' is stdin, and files ending in .gz are decompressed"""
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def _input_format(path, input_format):
+    if input_format is not None:
+        return input_format
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.jsonl') or name.endswith('.ndjson'):
+        return 'jsonl'
+    return 'csv'
+
+
+def _read_csv(f, separator, direction):
+    """Yield (line, value, list of criteria dicts, delete) for the rows of a CSV file"""
+    reader = csv.reader(f)
+    header = next(reader, None)
+    if header is None:
+        return
+    header = [name.strip() for name in header]
+    if 'value' not in header:
+        raise ValueError('Invalid CSV header: there is no value column')
+    if 'direction' not in header and direction is None:
+        raise ValueError('Invalid CSV header: there is no direction column, and no --direction')
+    fields = []
+    for i, name in enumerate(header):
+        if name in ('value', 'direction'):
+            continue
+        if name not in tagging._criteriaAddMethods:
+            raise ValueError('Invalid CSV header: unknown column "%s". Valid: value, direction, %s'
+                             % (name, ', '.join(sorted(tagging._criteriaAddMethods))))
+        fields.append((i, name))
+    value_column = header.index('value')
+    direction_column = header.index('direction') if 'direction' in header else None
+
+    for row in reader:
+        if len(row) == 0:
+            continue
+        if len(row) != len(header):
+            raise ValueError('line %d: expected %d columns, got %d' % (reader.line_num, len(header), len(row)))
+        d = {'direction': row[direction_column].strip() if direction_column is not None else direction}
+        for i, name in fields:
+            cell = row[i].strip()
+            if cell:
+                d[name] = [v for v in cell.split(separator) if v.strip()]
+        yield reader.line_num, row[value_column], [d], False
+
+
+def _read_jsonl(f, direction):
+    """Yield (line, value, list of criteria dicts, delete) for the lines of a JSON lines file"""
+    for line, text in enumerate(f, 1):
+        if not text.strip():
+            continue
+        try:
+            d = json.loads(text)
+        except ValueError as e:
+            raise ValueError('line %d: invalid JSON: %s' % (line, e))
+        if not isinstance(d, dict) or not isinstance(d.get('value'), str):
+            raise ValueError('line %d: expected an object with a value' % line)
+        value = d.pop('value')
+        if d.pop('delete', False):
+            yield line, value, None, True
+        elif 'criteria' in d:
+            yield line, value, d['criteria'], False
+        else:
+            if direction is not None:
+                d.setdefault('direction', direction)
+            yield line, value, [d], False
+
+
+def push(args):
+    """Stream an input file into a populator or tag batch, returning the exit status"""
+    instrumentation = _ProgressInstrumentation()
+    if args.dry_run:
+        client = _DryRunClient('', '', compression=args.compression, instrumentation=instrumentation)
+    else:
+        email = args.email or os.environ.get('KENTIK_API_EMAIL')
+        token = args.token or os.environ.get('KENTIK_API_TOKEN')
+        if not email or not token:
+            raise ValueError('the API credentials are missing: set KENTIK_API_EMAIL and KENTIK_API_TOKEN, '
+                             'or pass --email and --token')
+        client = tagging.Client(email, token, base_url=args.base_url, compression=args.compression,
+                                instrumentation=instrumentation)
+
+    input_format = _input_format(args.input, args.format)
+    with client, _open_input(args.input) as f:
+        if args.tags:
+            batch = client.stream_tag_batch(args.replace_all, max_upload_size=args.part_size)
+        else:
+            batch = client.stream_populator_batch(args.dimension, args.replace_all, max_upload_size=args.part_size)
+        with batch:
+            p = _Push(batch, instrumentation, args.validation == 'strict', args.progress)
+            if input_format == 'csv':
+                rows = _read_csv(f, args.separator, args.direction)
+            else:
+                rows = _read_jsonl(f, args.direction)
+            for line, value, criteria_list, delete in rows:
+                p.add(line, value, criteria_list, delete)
+        seconds = p.seconds()
+
+    print('%d rows read in %.1fs (%d rows/s): %d upserted, %d deleted, %d skipped'
+          % (p.rows, seconds, p.rows / seconds if seconds > 0 else 0, p.upserts, p.deletes, p.skipped))
+    print('%d parts, %d bytes of JSON, %d bytes %s (%.1f MB/s)'
+          % (instrumentation.parts, instrumentation.json_bytes, instrumentation.body_bytes,
+             'would be sent' if args.dry_run else 'sent',
+             instrumentation.body_bytes / 1e6 / seconds if seconds > 0 else 0))
+    if p.ungrouped_line is not None:
+        print('%d values came back after other values, from line %d on - the input isn\'t grouped by value'
+              % (batch.values_regrouped, p.ungrouped_line), file=sys.stderr)
+    if instrumentation.resplits:
+        print('%d parts were re-split after the server rejected them as too big' % instrumentation.resplits)
+    if args.dry_run:
+        print('dry run - nothing was sent')
+    else:
+        print('batch guid: %s' % batch.guid)
+    for line, error in p.errors:
+        print('line %d skipped: %s' % (line, error), file=sys.stderr)
+    if p.skipped > len(p.errors):
+        print('... and %d more rows skipped' % (p.skipped - len(p.errors)), file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='kentik-tagging', description='Kentik HyperScale tagging tools')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('push', help='stream populators or tags from a CSV or JSON lines file to Kentik',
+                            description='Stream populators or tags from a CSV or JSON lines file to Kentik')
+    p.add_argument('input', nargs='?', default='-', help="file to read, or '-' for stdin (default)")
+    target = p.add_mutually_exclusive_group(required=True)
+    target.add_argument('--dimension', metavar='NAME', help='custom dimension to push populators to')
+    target.add_argument('--tags', action='store_true', help='push tags')
+    p.add_argument('--replace-all', action='store_true',
+                   help='replace everything already there with the input, instead of adding to it')
+    p.add_argument('--format', choices=['csv', 'jsonl'], help='input format (default: from the file name, or csv)')
+    p.add_argument('--separator', default=';', help="separator of several values in a CSV cell (default ';')")
+    p.add_argument('--direction', choices=['src', 'dst', 'either'], help='direction of rows without one')
+    p.add_argument('--validation', choices=['strict', 'lenient'], default='strict',
+                   help='stop at the first invalid row (strict, the default), or skip invalid rows (lenient)')
+    p.add_argument('--dry-run', action='store_true',
+                   help="build and serialize the batch parts, and report their count and size, without sending")
+    p.add_argument('--compression', choices=['gzip', 'deflate'], help='compress the batch parts')
+    p.add_argument('--part-size', type=int, help='fixed size of the batch parts in bytes (default: adaptive)')
+    p.add_argument('--progress', type=float, default=10, metavar='SECONDS',
+                   help='seconds between progress reports on stderr, 0 for none (default 10)')
+    p.add_argument('--email', help='API email (default: $KENTIK_API_EMAIL)')
+    p.add_argument('--token', help='API token (default: $KENTIK_API_TOKEN)')
+    p.add_argument('--base-url', default='https://api.kentik.com', help='API base URL')
+    p.add_argument('-v', '--verbose', action='count', default=0, help='log more: -v for info, -vv for debug')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)],
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    try:
+        return push(args)
+    except (ValueError, RuntimeError, IOError) as e:
+        parser.exit(1, 'kentik-tagging: error: %s\n' % e)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""Delta sync of HyperScale populators and tags
+
+Instead of uploading the full set of populators every time, DeltaSync keeps a local SQLite snapshot of what
+was last submitted for each custom dimension, and only submits the values that changed since then."""
+
+import hashlib
+import sqlite3
+import time
+
+from kentikapi.v5 import tagging
+
+
+# snapshot name for the tag batch - custom dimension names can't contain ':'
+_tagsDimension = ':tags'
+
+
+class SnapshotStore(object):
+    """SnapshotStore keeps the values and criteria last submitted per custom dimension in an SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS snapshot ('
+                               'dimension TEXT NOT NULL, '
+                               'value_key TEXT NOT NULL, '     # lower-cased value
+                               'value TEXT NOT NULL, '
+                               'digest BLOB NOT NULL, '
+                               'criteria BLOB NOT NULL, '      # JSON array of the criteria
+                               'PRIMARY KEY (dimension, value_key))')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS dimension ('
+                               'dimension TEXT PRIMARY KEY, '
+                               'last_full_replace REAL NOT NULL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def last_full_replace(self, dimension):
+        """Return when the dimension was last fully replaced (seconds since the epoch), or None"""
+        row = self._conn.execute('SELECT last_full_replace FROM dimension WHERE dimension = ?',
+                                 (dimension,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def digests(self, dimension):
+        """Return a dict of lower-cased value to (value, digest) for the dimension"""
+        rows = self._conn.execute('SELECT value_key, value, digest FROM snapshot WHERE dimension = ?', (dimension,))
+        return dict((row[0], (row[1], bytes(row[2]))) for row in rows)
+
+    def replace(self, dimension, entries):
+        """Replace the whole snapshot of a dimension with entries of (value, digest, criteria JSON)"""
+        with self._conn:
+            self._conn.execute('DELETE FROM snapshot WHERE dimension = ?', (dimension,))
+            self._insert(dimension, entries)
+            self._conn.execute('INSERT OR REPLACE INTO dimension (dimension, last_full_replace) VALUES (?, ?)',
+                               (dimension, time.time()))
+
+    def update(self, dimension, entries, deleted_keys):
+        """Upsert entries of (value, digest, criteria JSON), and remove the lower-cased deleted_keys"""
+        with self._conn:
+            self._insert(dimension, entries)
+            self._conn.executemany('DELETE FROM snapshot WHERE dimension = ? AND value_key = ?',
+                                   ((dimension, key) for key in deleted_keys))
+
+    def _insert(self, dimension, entries):
+        self._conn.executemany('INSERT OR REPLACE INTO snapshot (dimension, value_key, value, digest, criteria) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               ((dimension, value.lower(), value, sqlite3.Binary(digest), sqlite3.Binary(criteria))
+                                for value, digest, criteria in entries))
+
+
+class DeltaSync(object):
+    """DeltaSync submits only what changed in a custom dimension since the last successful submission
+
+    Build the complete desired state of the dimension as a replace-all Batch, as you would to submit it
+    directly, and sync it:
+
+        with tagging_delta.SnapshotStore('/var/lib/kentik/snapshot.db') as store:
+            sync = tagging_delta.DeltaSync(client, store)
+            sync.sync_populators('c_my_column', batch)
+
+    The batch is compared to the snapshot of the last submission: only new or changed values are submitted
+    as upserts, and values that are gone are submitted as deletes, in a batch with replace_all False. The
+    full batch is still submitted when there's no snapshot yet, and every full_replace_interval seconds
+    as a safety net."""
+
+    def __init__(self, client, store, full_replace_interval=24 * 60 * 60):
+        self.client = client
+        self.store = store
+        self.full_replace_interval = full_replace_interval
+
+    def sync_populators(self, column_name, batch, force_full=False):
+        """Sync the populators of a custom dimension to the desired state in a replace-all batch
+
+        Returns the guid of the submitted batch, or None if nothing changed."""
+        return self._sync(column_name, batch, force_full,
+                          lambda b: self.client.submit_populator_batch(column_name, b))
+
+    def sync_tags(self, batch, force_full=False):
+        """Sync the tags to the desired state in a replace-all batch
+
+        Returns the guid of the submitted batch, or None if nothing changed."""
+        return self._sync(_tagsDimension, batch, force_full, self.client.submit_tag_batch)
+
+    def _sync(self, dimension, batch, force_full, submit):
+        if not batch.replace_all:
+            raise ValueError("Invalid batch: a delta sync needs the complete state, in a batch with replace_all True")
+
+        entries = [(value, _digest(value, criteria_array), criteria_array)
+                   for value, criteria_array in batch._iter_upserts()]
+
+        last_full_replace = self.store.last_full_replace(dimension)
+        if force_full or last_full_replace is None or time.time() - last_full_replace >= self.full_replace_interval:
+            result = submit(batch)
+            self.store.replace(dimension, _snapshot_entries(entries))
+            return result
+
+        # diff the desired state against the snapshot
+        snapshot = self.store.digests(dimension)
+        delta = tagging.Batch(False)
+        changed = []
+        for value, digest, criteria_array in entries:
+            key = value.lower()
+            previous = snapshot.pop(key, None)
+            if previous is None or previous[1] != digest:
+                delta._add_encoded_upsert(value, criteria_array)
+                changed.append((value, digest, criteria_array))
+
+        # whatever is left in the snapshot is no longer wanted
+        for value, _ in snapshot.values():
+            delta.add_delete(value)
+
+        if len(changed) == 0 and len(snapshot) == 0:
+            return None
+
+        result = submit(delta)
+        self.store.update(dimension, _snapshot_entries(changed), snapshot.keys())
+        return result
+
+
+def _digest(value, criteria_array):
+    """Return a digest of a value and its criteria, ignoring the order of the criteria"""
+    h = hashlib.sha1(value.encode('utf-8'))
+    for criteria in sorted(criteria_array):
+        h.update(b'\0')
+        h.update(criteria)
+    return h.digest()
+
+
+def _snapshot_entries(entries):
+    """Return the (value, digest, criteria JSON) to store for entries of (value, digest, encoded criteria)"""
+    return ((value, digest, b'[' + b', '.join(criteria_array) + b']') for value, digest, criteria_array in entries)
@@ -0,0 +1,504 @@
+"""Offline matching of HyperScale populators and tags against flow records
+
+Kentik only shows which flows a batch tags once the batch has been processed. Matcher answers that locally:
+it compiles the criteria of a batch into lookup tables, and finds the value each flow record would be tagged
+with. Flow records are columns - NumPy arrays, pandas columns, or plain sequences - and they're matched a chunk
+of rows at a time with vectorized lookups, never row by row.
+
+Requires NumPy - install it with the 'match' extra: pip install kentikapi[match]"""
+
+from bisect import bisect_right
+import json
+import struct
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError('kentikapi.v5.tagging_match requires NumPy - install it with: pip install kentikapi[match]')
+
+from kentikapi.v5 import tagging
+from kentikapi.v5.tagging import _int_from_bytes, _parse_address
+
+
+# flow record columns matched by each criteria field, for the source and destination side of a flow. Fields
+# that aren't about one side of the flow use the same column for both
+_flowColumns = {
+    'addr': ('src_addr', 'dst_addr'),
+    'nexthop': ('src_nexthop', 'dst_nexthop'),
+    'port': ('src_port', 'dst_port'),
+    'vlans': ('src_vlan', 'dst_vlan'),
+    'asn': ('src_asn', 'dst_asn'),
+    'nexthop_asn': ('src_nexthop_asn', 'dst_nexthop_asn'),
+    'protocol': ('protocol', 'protocol'),
+    'lasthop_as_name': ('src_lasthop_as_name', 'dst_lasthop_as_name'),
+    'nexthop_as_name': ('src_nexthop_as_name', 'dst_nexthop_as_name'),
+    'bgp_aspath': ('src_bgp_aspath', 'dst_bgp_aspath'),
+    'bgp_community': ('src_bgp_community', 'dst_bgp_community'),
+    'mac': ('src_mac', 'dst_mac'),
+    'country': ('src_country', 'dst_country'),
+    'site': ('site', 'site'),
+    'device_type': ('device_type', 'device_type'),
+    'interface_name': ('src_interface_name', 'dst_interface_name'),
+    'device_name': ('device_name', 'device_name'),
+}
+_tcpFlagsColumn = 'tcp_flags'
+
+# fields in the order they're preferred for finding a criteria's candidate flows - the ones that usually
+# narrow them down most come first, the rest are only checked on the candidates
+_fieldOrder = ['addr', 'nexthop', 'asn', 'nexthop_asn', 'mac', 'interface_name', 'device_name', 'country',
+               'bgp_community', 'bgp_aspath', 'nexthop_as_name', 'lasthop_as_name', 'site', 'device_type',
+               'vlans', 'port', 'protocol']
+
+_addressFields = ('addr', 'nexthop')
+_rangeFields = ('port', 'vlans', 'asn', 'nexthop_asn')
+
+# sides of a flow a criteria's direction matches
+_directionSides = {'src': (0,), 'dst': (1,), 'either': (0, 1)}
+
+# IPv4 addresses are coded as themselves, IPv6 addresses above them
+_v6CodeBase = 1 << 32
+
+# a trie level is indexed densely if its prefixes span at most this many slots, or this many per prefix
+_denseIndexMinSize = 1 << 16
+_denseIndexMaxSpread = 16
+
+
+class Matcher(object):
+    """Matcher finds which value of a batch each flow record would be tagged with
+
+    The batch is either a Batch, or (value, criteria) pairs, where criteria is a Criteria or a list of them:
+
+        matcher = tagging_match.Matcher(batch)
+        result = matcher.match({'src_addr': src_addrs, 'dst_addr': dst_addrs, 'src_port': src_ports, ...})
+
+    Flow records are a dict of columns, a pandas DataFrame, or a NumPy structured array. A criteria field is
+    matched against the columns of the side of the flow its direction selects - eg. addr against src_addr
+    for 'src', dst_addr for 'dst', and either of them for 'either' (with the criteria's other fields matched on
+    the same side). protocol, tcp_flags, site, device_type and device_name are columns for the whole flow.
+    Addresses are strings, or integers for IPv4. Missing values are None, NaN or an empty string, and don't
+    match any criteria that has the field. String fields are matched exactly - including bgp_aspath and
+    bgp_community, whatever patterns Kentik itself accepts there - and a TCP flags criteria matches flows
+    with any of its flags set.
+
+    As in Kentik, a flow matches a criteria if it matches at least one value from each non-empty field of it,
+    and it's tagged with a value if it matches any of the value's criteria."""
+
+    def __init__(self, batch):
+        self.values = []            # values in batch order
+        self._fields = [_Field(name, i) for i, name in enumerate(_fieldOrder)]
+        fields_by_name = dict((field.name, field) for field in self._fields)
+
+        rule_values = []            # a rule is a criteria on one side of the flow: its value index,
+        rule_sides = []             # 0 for src or 1 for dst,
+        rule_keys = []              # the field its candidate flows are found by, or -1,
+        rule_tcp_flags = []         # and its TCP flags mask, or 0
+        for value, criteria_list in _batch_criteria(batch):
+            value_index = len(self.values)
+            self.values.append(value)
+            for criteria in criteria_list:
+                ranges = dict()
+                for key, field_values in criteria.items():
+                    if key in fields_by_name:
+                        ranges[key] = fields_by_name[key].parse(field_values)
+                if any(len(field_ranges) == 0 for field_ranges in ranges.values()):
+                    continue    # eg. only addresses that don't parse - it can't match anything
+
+                keys = [field.index for field in self._fields if field.name in ranges]
+                for side in _directionSides[criteria['direction']]:
+                    rule = len(rule_values)
+                    rule_values.append(value_index)
+                    rule_sides.append(side)
+                    rule_keys.append(keys[0] if keys else -1)
+                    rule_tcp_flags.append(criteria.get('tcp_flags') or 0)
+                    for key, field_ranges in ranges.items():
+                        fields_by_name[key].add(rule, side, field_ranges)
+
+        rule_count = len(rule_values)
+        self._rule_values = numpy.array(rule_values, dtype=numpy.int64)
+        self._rule_sides = numpy.array(rule_sides, dtype=numpy.int8)
+        self._rule_keys = numpy.array(rule_keys, dtype=numpy.int16)
+        self._rule_tcp_flags = numpy.array(rule_tcp_flags, dtype=numpy.int64)
+        self._unkeyed = numpy.nonzero(self._rule_keys < 0)[0]
+        self._fields = [field for field in self._fields if field.finish(rule_count, self._rule_keys)]
+
+    def match(self, flows, chunk_size=1000000):
+        """Return a MatchResult with the value each flow record matched, and the count of flows per value
+
+        Flows are matched chunk_size rows at a time, which bounds the memory used for candidate matches."""
+        names = _column_names(flows)
+        columns = set()
+        for field in self._fields:
+            columns.update(field.columns[side] for side in field.sides)
+        if numpy.any(self._rule_tcp_flags):
+            columns.add(_tcpFlagsColumn)
+        missing = sorted(columns - names)
+        if missing:
+            raise ValueError('Invalid flow records: the criteria need columns %s' % ', '.join(missing))
+
+        row_count = None
+        for name in columns:
+            length = len(flows[name])
+            if row_count is not None and length != row_count:
+                raise ValueError('Invalid flow records: columns have different lengths')
+            row_count = length
+        if row_count is None:
+            row_count = len(flows[next(iter(names))]) if names else 0
+
+        # codes per (field, side) - a shared column is only converted once
+        codes = dict()
+        for field in self._fields:
+            converted = dict()
+            for side in field.sides:
+                name = field.columns[side]
+                if name not in converted:
+                    converted[name] = field.flow_codes(flows[name])
+                codes[(field.index, side)] = converted[name]
+        tcp_flags = _number_codes(flows[_tcpFlagsColumn]) if _tcpFlagsColumn in columns else None
+
+        value_count = len(self.values)
+        value_index = numpy.full(row_count, -1, dtype=numpy.int64)
+        counts = numpy.zeros(value_count, dtype=numpy.int64)
+        for start in range(0, row_count, chunk_size):
+            end = min(start + chunk_size, row_count)
+            chunk_codes = dict((key, c[start:end]) for key, c in codes.items())
+            chunk_tcp_flags = tcp_flags[start:end] if tcp_flags is not None else None
+            rows, values = self._match_chunk(chunk_codes, chunk_tcp_flags, end - start)
+            if len(rows) == 0:
+                continue
+
+            # most flows match a single criteria, and need no sorting. A flow that matched several counts once
+            # per value, however many of the value's criteria it matched, and takes the first value
+            multiple = numpy.bincount(rows, minlength=end - start)[rows] > 1
+            single_rows = rows[~multiple]
+            counts += numpy.bincount(values[~multiple], minlength=value_count)
+            value_index[start + single_rows] = values[~multiple]
+            if numpy.any(multiple):
+                matches = numpy.unique(rows[multiple] * value_count + values[multiple])
+                rows = matches // value_count
+                values = matches % value_count
+                counts += numpy.bincount(values, minlength=value_count)
+                first = numpy.ones(len(rows), dtype=bool)
+                first[1:] = rows[1:] != rows[:-1]
+                value_index[start + rows[first]] = values[first]
+        return MatchResult(self.values, value_index, counts)
+
+    def _match_chunk(self, codes, tcp_flags, row_count):
+        """Return the (row, value index) pairs of the flows of a chunk that matched a criteria"""
+        candidate_rows = []
+        candidate_rules = []
+        for field in self._fields:
+            for side, trie in field.tries.items():
+                rows, rules = trie.lookup(codes[(field.index, side)])
+                candidate_rows.append(rows)
+                candidate_rules.append(rules)
+        for rule in self._unkeyed:
+            candidate_rows.append(numpy.arange(row_count, dtype=numpy.int64))
+            candidate_rules.append(numpy.full(row_count, rule, dtype=numpy.int64))
+        if not candidate_rows:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        rows = numpy.concatenate(candidate_rows)
+        rules = numpy.concatenate(candidate_rules)
+
+        # check the candidates against the fields of their criteria that didn't find them
+        keep = numpy.ones(len(rows), dtype=bool)
+        for field in self._fields:
+            selected = numpy.nonzero(field.has[rules] & (self._rule_keys[rules] != field.index))[0]
+            if len(selected) == 0:
+                continue
+            selected_rules = rules[selected]
+            selected_rows = rows[selected]
+            if len(field.sides) == 1:
+                side_codes = codes[(field.index, field.sides[0])][selected_rows]
+            else:
+                src_codes = codes[(field.index, 0)]
+                dst_codes = codes[(field.index, 1)]
+                if src_codes is dst_codes:
+                    side_codes = src_codes[selected_rows]
+                else:
+                    side_codes = numpy.where(self._rule_sides[selected_rules] == 0,
+                                             src_codes[selected_rows], dst_codes[selected_rows])
+            keep[selected[~field.contains(selected_rules, side_codes)]] = False
+
+        if tcp_flags is not None:
+            masks = self._rule_tcp_flags[rules]
+            selected = numpy.nonzero(masks)[0]
+            flags = tcp_flags[rows[selected]]
+            matched = (flags >= 0) & ((flags & masks[selected]) != 0)
+            keep[selected[~matched]] = False
+
+        return rows[keep], self._rule_values[rules[keep]]
+
+
+class MatchResult(object):
+    """Which value each flow record matched, and how many flow records matched each value"""
+
+    def __init__(self, values, value_index, counts):
+        self.values = values              # values in batch order
+        self.value_index = value_index    # per flow record: index in values of the first value it matched, or -1
+        self.counts = counts              # per value: count of flow records that matched it
+
+    def matched_values(self):
+        """Return the first value each flow record matched, or None"""
+        return [self.values[i] if i >= 0 else None for i in self.value_index.tolist()]
+
+    def counts_by_value(self):
+        """Return a dict of value to count of flow records matched, for the values that matched any"""
+        return dict((self.values[i], int(self.counts[i])) for i in numpy.nonzero(self.counts)[0])
+
+
+class _Field(object):
+    """A criteria field compiled for matching
+
+    Every value of the field is turned into an integer code - IP addresses, numbers, or an index for strings -
+    so the values a criteria matches are ranges of codes, and a flow's value is a single code (-1 if it's
+    missing). The ranges are kept twice: sorted by rule to check a flow against a given rule, and in a trie
+    per side to find the rules a flow's value matches."""
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        self.columns = _flowColumns[name]
+        self.sides = ()
+        self.tries = dict()           # side -> _PrefixTrie of the rules that find their candidates by this field
+        self.has = None               # per rule: whether it has this field
+        self._ranges = []             # (rule, side, start, end), until the field is finished
+        self._strings = dict()        # string -> code, for string fields
+        self._v6_bounds = set()       # IPv6 range starts and ends + 1, for address fields
+        self._bits = 0
+        self._starts = None           # rule << bits | range start, sorted
+        self._ends = None             # rule << bits | range end
+        self._rule_ranges = None      # per rule: index of its first range, and of its last one
+
+    def parse(self, values):
+        """Return a list of (start, end) ranges for the values of this field in a criteria"""
+        ranges = []
+        if self.name in _addressFields:
+            for address in values:
+                parsed = _parse_address(address)
+                if parsed is None:
+                    continue
+                packed, prefix_length = parsed
+                bits = len(packed) * 8
+                host_mask = (1 << (bits - (bits if prefix_length is None else prefix_length))) - 1
+                start = _int_from_bytes(packed) & ~host_mask
+                if bits == 32:
+                    ranges.append((start, start | host_mask))
+                else:
+                    # IPv6 ranges are kept as addresses above _v6CodeBase until all the bounds are known
+                    ranges.append((_v6CodeBase + start, _v6CodeBase + (start | host_mask)))
+                    self._v6_bounds.add(start)
+                    self._v6_bounds.add((start | host_mask) + 1)
+        elif self.name in _rangeFields:
+            for value in values:
+                start, _, end = str(value).partition('-')
+                ranges.append((int(start), int(end or start)))
+        elif self.name == 'protocol':
+            ranges.extend((protocol, protocol) for protocol in values)
+        else:
+            for value in values:
+                code = self._strings.setdefault(value, len(self._strings))
+                ranges.append((code, code))
+        return ranges
+
+    def add(self, rule, side, ranges):
+        self._ranges.extend((rule, side, start, end) for start, end in ranges)
+
+    def finish(self, rule_count, rule_keys):
+        """Build the lookup tables, returning False if no criteria has this field"""
+        if not self._ranges:
+            return False
+
+        if self._v6_bounds:
+            self._v6_bounds = sorted(self._v6_bounds)
+            ranges = []
+            for rule, side, start, end in self._ranges:
+                if start >= _v6CodeBase:
+                    start = _v6CodeBase + bisect_right(self._v6_bounds, start - _v6CodeBase)
+                    end = _v6CodeBase + bisect_right(self._v6_bounds, end - _v6CodeBase + 1) - 1
+                ranges.append((rule, side, start, end))
+            self._ranges = ranges
+
+        # merge each rule's overlapping ranges, so that a flow matches a rule through one range at most
+        self._ranges.sort()
+        merged = []
+        for rule, side, start, end in self._ranges:
+            if merged and merged[-1][0] == rule and start <= merged[-1][3] + 1:
+                if end > merged[-1][3]:
+                    merged[-1] = (rule, side, merged[-1][2], end)
+            else:
+                merged.append((rule, side, start, end))
+        self._ranges = None
+
+        self._bits = max(max(end for _, _, _, end in merged).bit_length(), 1)
+        if (rule_count << self._bits) >= 1 << 63:
+            raise ValueError('Invalid batch: too many criteria to match')
+        self._starts = numpy.array([rule << self._bits | start for rule, _, start, _ in merged], dtype=numpy.int64)
+        self._ends = numpy.array([rule << self._bits | end for rule, _, _, end in merged], dtype=numpy.int64)
+        rules = numpy.array([rule for rule, _, _, _ in merged], dtype=numpy.int64)
+        self.has = numpy.zeros(rule_count, dtype=bool)
+        self.has[rules] = True
+        self._rule_ranges = numpy.zeros((2, rule_count), dtype=numpy.int64)
+        self._rule_ranges[0] = numpy.searchsorted(rules, numpy.arange(rule_count))
+        self._rule_ranges[1] = numpy.searchsorted(rules, numpy.arange(rule_count), side='right') - 1
+        self.sides = tuple(sorted(set(side for _, side, _, _ in merged)))
+
+        for rule, side, start, end in merged:
+            if rule_keys[rule] == self.index:
+                trie = self.tries.get(side)
+                if trie is None:
+                    trie = self.tries[side] = _PrefixTrie()
+                trie.add(rule, start, end)
+        for trie in self.tries.values():
+            trie.finish()
+        return True
+
+    def contains(self, rules, codes):
+        """Return whether each flow code is in a range of the rule it's paired with"""
+        valid = (codes >= 0) & (codes < 1 << self._bits)
+        keys = (rules << self._bits) | numpy.where(valid, codes, 0)
+        # most rules have a single range to compare with - only search the ranges of the others
+        i = self._rule_ranges[0][rules]
+        several = numpy.nonzero(self._rule_ranges[1][rules] > i)[0]
+        if len(several) > 0:
+            i[several] = numpy.searchsorted(self._starts, keys[several], side='right') - 1
+        return valid & (self._starts[i] <= keys) & (self._ends[i] >= keys)
+
+    def flow_codes(self, column):
+        """Return the codes of the values of a flow record column"""
+        if self.name in _addressFields:
+            a = numpy.asarray(column)
+            if a.dtype.kind in 'iu':
+                return a.astype(numpy.int64)    # IPv4 addresses as integers
+            return _string_codes(a, self._address_code)
+        if self.name in _rangeFields or self.name == 'protocol':
+            return _number_codes(column)
+        return _string_codes(numpy.asarray(column), lambda s: self._strings.get(s, -1))
+
+    def _address_code(self, address):
+        parsed = _parse_address(address.strip())
+        if parsed is None or parsed[1] is not None:
+            return -1
+        packed = parsed[0]
+        if len(packed) == 4:
+            return struct.unpack('!I', packed)[0]
+        if not self._v6_bounds:
+            return -1
+        return _v6CodeBase + bisect_right(self._v6_bounds, _int_from_bytes(packed))
+
+
+class _PrefixTrie(object):
+    """Ranges of codes split into aligned blocks, and stored one level of the trie per block size
+
+    Each level is a sorted array of block prefixes with the rules that have each, so a whole column of codes is
+    looked up one level at a time: shift the codes to the level's prefix length, and search the array."""
+
+    def __init__(self):
+        self._blocks = dict()     # shift -> list of (prefix, rule)
+        self._levels = []         # (shift, prefixes, offsets of their rules, rules, _DenseIndex or None)
+
+    def add(self, rule, start, end):
+        while start <= end:
+            size = start & -start if start > 0 else 1 << 63
+            while size > end - start + 1:
+                size >>= 1
+            shift = size.bit_length() - 1
+            self._blocks.setdefault(shift, []).append((start >> shift, rule))
+            start += size
+
+    def finish(self):
+        for shift, blocks in sorted(self._blocks.items()):
+            blocks.sort()
+            prefixes = numpy.array([prefix for prefix, _ in blocks], dtype=numpy.int64)
+            rules = numpy.array([rule for _, rule in blocks], dtype=numpy.int64)
+            unique_prefixes, offsets = numpy.unique(prefixes, return_index=True)
+            offsets = numpy.append(offsets, len(prefixes))
+            self._levels.append((shift, unique_prefixes, offsets, rules, _DenseIndex.build(unique_prefixes)))
+        self._blocks = None
+
+    def lookup(self, codes):
+        """Return the (row, rule) pairs of the codes that are in a rule's range"""
+        found_rows = []
+        found_rules = []
+        for shift, prefixes, offsets, rules, dense in self._levels:
+            keys = codes >> shift         # missing codes are -1, and stay -1
+            if dense is not None:
+                i = dense.lookup(keys)
+            else:
+                i = numpy.minimum(numpy.searchsorted(prefixes, keys), len(prefixes) - 1)
+            rows = numpy.nonzero(prefixes[i] == keys)[0]
+            if len(rows) == 0:
+                continue
+            first = offsets[i[rows]]
+            counts = offsets[i[rows] + 1] - first
+            if len(rules) == len(prefixes):
+                found_rules.append(rules[first])      # one rule per prefix
+            else:
+                # every rule of each prefix: repeat the row, and step through the prefix's rules
+                rows = numpy.repeat(rows, counts)
+                steps = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+                found_rules.append(rules[numpy.repeat(first, counts) + steps])
+            found_rows.append(rows)
+        if not found_rows:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate(found_rows), numpy.concatenate(found_rules)
+
+
+class _DenseIndex(object):
+    """Index of sorted prefixes that span a small range, by their offset from the first - looking a prefix up
+    is a single array access, where a binary search would be a cache miss per step"""
+
+    def __init__(self, base, slots):
+        self._base = base
+        self._slots = slots
+
+    @classmethod
+    def build(cls, prefixes):
+        """Return the index of the prefixes, or None if they're spread too widely to be worth one"""
+        span = int(prefixes[-1]) - int(prefixes[0]) + 1
+        if span > _denseIndexMinSize and span > len(prefixes) * _denseIndexMaxSpread:
+            return None
+        slots = numpy.zeros(span, dtype=numpy.int32)
+        slots[prefixes - prefixes[0]] = numpy.arange(len(prefixes), dtype=numpy.int32)
+        return cls(prefixes[0], slots)
+
+    def lookup(self, keys):
+        """Return the index of each key's prefix - of any prefix, for keys that aren't one"""
+        return self._slots[numpy.clip(keys - self._base, 0, len(self._slots) - 1)]
+
+
+def _batch_criteria(batch):
+    """Yield (value, list of criteria dicts) for a Batch, or for (value, Criteria or list of them) pairs"""
+    if isinstance(batch, tagging.Batch):
+        for value, criteria_array in batch._iter_upserts():
+            yield value, [json.loads(encoded.decode('utf-8')) for encoded in criteria_array]
+        return
+
+    for value, criteria in batch:
+        if isinstance(criteria, tagging.Criteria):
+            criteria = [criteria]
+        yield value, [c.to_dict() for c in criteria]
+
+
+def _column_names(flows):
+    names = getattr(getattr(flows, 'dtype', None), 'names', None)
+    if names is not None:
+        return set(names)
+    return set(flows.keys())
+
+
+def _number_codes(column):
+    """Return the codes of a numeric column - missing values (None or NaN) are -1"""
+    a = numpy.asarray(column)
+    if a.dtype.kind in 'iu':
+        return a.astype(numpy.int64)
+    a = numpy.asarray(column, dtype=float)
+    return numpy.where(numpy.isnan(a), -1, a).astype(numpy.int64)
+
+
+def _string_codes(a, code):
+    """Return the codes of a string column, converting each distinct string once"""
+    if a.dtype.kind == 'O':
+        a = numpy.array(['' if s is None or s != s else s for s in a.tolist()], dtype=str)
+    unique_strings, inverse = numpy.unique(a, return_inverse=True)
+    codes = numpy.array([code(s) if s else -1 for s in unique_strings.tolist()], dtype=numpy.int64)
+    return codes[inverse.reshape(-1)]
@@ -0,0 +1,280 @@
+"""Metrics exporters for batch submissions
+
+Instrumentations for tagging.Client and tagging_async.AsyncClient that turn the submission events into
+metrics for dashboards:
+
+    metrics = tagging_metrics.PrometheusInstrumentation()
+    metrics.serve(9105)
+    client = tagging.Client('my@email.com', 'my_token', instrumentation=metrics)
+
+StatsdInstrumentation sends them to a StatsD daemon over UDP instead. Neither needs a client library."""
+
+from collections import defaultdict
+import re
+import socket
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from kentikapi.v5 import tagging
+
+
+_populatorUrl = re.compile(r'/customdimensions/([^/]+)/populators$')
+_tagUrl = re.compile(r'/batch/tags$')
+
+
+def _target(url):
+    """Return the custom dimension a batch URL is for, 'tags' for tag batches, or '' for other URLs"""
+    match = _populatorUrl.search(url)
+    if match is not None:
+        return match.group(1)
+    if _tagUrl.search(url) is not None:
+        return 'tags'
+    return ''
+
+
+class StatsdInstrumentation(tagging.Instrumentation):
+    """Sends submission metrics to a StatsD daemon
+
+    Timers are in milliseconds - except part.size_error_bytes, a timer of how many bytes the size a part
+    was packed by was off from its request body. Metrics about parts and batches are named after their
+    custom dimension (or 'tags'), eg. kentik.tagging.c_my_column.part.send_ms. Sending is fire-and-forget over UDP, so
+    a missing daemon never slows down or fails a submission."""
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='kentik.tagging'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def close(self):
+        self._socket.close()
+
+    def _send(self, *metrics):
+        data = '\n'.join('%s.%s' % (self.prefix, metric) for metric in metrics).encode('utf-8')
+        try:
+            self._socket.sendto(data, self.address)
+        except (socket.error, OSError):
+            pass
+
+    def batch_packed(self, url, part_count, seconds):
+        target = _target(url)
+        self._send('%s.batch.pack_ms:%.3f|ms' % (target, seconds * 1000),
+                   '%s.batch.parts:%d|c' % (target, part_count))
+
+    def part_serialized(self, url, index, estimated_bytes, json_bytes, body_bytes, seconds):
+        target = _target(url)
+        self._send('%s.part.serialize_ms:%.3f|ms' % (target, seconds * 1000),
+                   '%s.part.json_bytes:%d|c' % (target, json_bytes),
+                   '%s.part.body_bytes:%d|c' % (target, body_bytes),
+                   '%s.part.size_error_bytes:%d|ms' % (target, abs(body_bytes - estimated_bytes)))
+
+    def request_finished(self, method, url, status, body_bytes, seconds, attempt):
+        self._send('request.%s.%s:1|c' % (method, status or 'error'),
+                   'request.%s.latency_ms:%.3f|ms' % (method, seconds * 1000))
+
+    def request_retried(self, method, url, attempt, delay):
+        self._send('request.%s.retries:1|c' % method)
+
+    def part_sent(self, url, index, guid, seconds):
+        target = _target(url)
+        self._send('%s.part.sent:1|c' % target,
+                   '%s.part.send_ms:%.3f|ms' % (target, seconds * 1000))
+
+    def part_resplit(self, url, index, part_bytes, part_count, size):
+        target = _target(url)
+        self._send('%s.part.resplit:1|c' % target,
+                   '%s.part.size_bytes:%d|g' % (target, size))
+
+    def batch_submitted(self, url, guid, part_count, seconds):
+        target = _target(url)
+        self._send('%s.batch.submitted:1|c' % target,
+                   '%s.batch.submit_ms:%.3f|ms' % (target, seconds * 1000))
+
+    def batch_finished(self, batch_response, seconds):
+        self._send('batch.finished:1|c',
+                   'batch.processing_ms:%.3f|ms' % (seconds * 1000),
+                   'batch.invalid_upserts:%d|c' % batch_response.invalid_upsert_count(),
+                   'batch.invalid_deletes:%d|c' % batch_response.invalid_delete_count())
+
+
+# the metrics collected by PrometheusInstrumentation: (name, type, help)
+_prometheusMetrics = [
+    ('kentik_tagging_batches_packed_total', 'counter', 'Batches packed into parts'),
+    ('kentik_tagging_batch_pack_seconds', 'histogram', 'Time to pack a batch into parts'),
+    ('kentik_tagging_part_serialize_seconds', 'histogram', 'Time to serialize a batch part'),
+    ('kentik_tagging_part_json_bytes_total', 'counter', 'Uncompressed JSON bytes of the parts sent'),
+    ('kentik_tagging_part_body_bytes_total', 'counter', 'Request body bytes of the parts sent'),
+    ('kentik_tagging_part_size_error_bytes', 'histogram',
+     'Difference between the size a part was packed by and the size of its request body'),
+    ('kentik_tagging_requests_total', 'counter', 'HTTP requests by method and status'),
+    ('kentik_tagging_request_seconds', 'histogram', 'HTTP request latency'),
+    ('kentik_tagging_retries_total', 'counter', 'HTTP requests retried'),
+    ('kentik_tagging_parts_sent_total', 'counter', 'Batch parts accepted by the server'),
+    ('kentik_tagging_part_send_seconds', 'histogram', 'Time to send a batch part, including retries'),
+    ('kentik_tagging_parts_resplit_total', 'counter', 'Batch parts re-split into smaller parts after failing'),
+    ('kentik_tagging_part_size_bytes', 'gauge', 'Size batch parts were last re-split to'),
+    ('kentik_tagging_batches_submitted_total', 'counter', 'Batches completely submitted'),
+    ('kentik_tagging_batch_submit_seconds', 'histogram', 'Time to send all parts of a batch'),
+    ('kentik_tagging_batches_finished_total', 'counter', 'Batches seen finishing processing'),
+    ('kentik_tagging_batch_processing_seconds', 'histogram',
+     'Time from submitting a batch until its status showed it finished'),
+    ('kentik_tagging_invalid_upserts_total', 'counter', 'Invalid upserts reported in finished batches'),
+    ('kentik_tagging_invalid_deletes_total', 'counter', 'Invalid deletes reported in finished batches'),
+]
+
+_prometheusBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+# buckets of the histograms that aren't of seconds
+_prometheusSizeBuckets = {
+    'kentik_tagging_part_size_error_bytes': (0, 16, 64, 256, 1024, 4096, 16384, 65536),
+}
+
+
+class PrometheusInstrumentation(tagging.Instrumentation):
+    """Collects submission metrics in memory, for Prometheus to scrape
+
+    render() returns the metrics in the Prometheus text format, and serve() exposes them over HTTP.
+    Metrics about parts and batches have a 'target' label with the custom dimension (or 'tags'). buckets
+    are the bounds of the histograms of seconds."""
+
+    def __init__(self, buckets=_prometheusBuckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = defaultdict(float)    # (name, labels) -> value, for counters and gauges
+        self._histograms = dict()            # (name, labels) -> [bucket counts..., sum, count]
+        self._server = None
+
+    def batch_packed(self, url, part_count, seconds):
+        labels = (('target', _target(url)),)
+        with self._lock:
+            self._values[('kentik_tagging_batches_packed_total', labels)] += 1
+            self._observe('kentik_tagging_batch_pack_seconds', labels, seconds)
+
+    def part_serialized(self, url, index, estimated_bytes, json_bytes, body_bytes, seconds):
+        labels = (('target', _target(url)),)
+        with self._lock:
+            self._observe('kentik_tagging_part_serialize_seconds', labels, seconds)
+            self._values[('kentik_tagging_part_json_bytes_total', labels)] += json_bytes
+            self._values[('kentik_tagging_part_body_bytes_total', labels)] += body_bytes
+            self._observe('kentik_tagging_part_size_error_bytes', labels, abs(body_bytes - estimated_bytes))
+
+    def request_finished(self, method, url, status, body_bytes, seconds, attempt):
+        with self._lock:
+            labels = (('method', method), ('status', str(status or 'error')))
+            self._values[('kentik_tagging_requests_total', labels)] += 1
+            self._observe('kentik_tagging_request_seconds', (('method', method),), seconds)
+
+    def request_retried(self, method, url, attempt, delay):
+        with self._lock:
+            self._values[('kentik_tagging_retries_total', (('method', method),))] += 1
+
+    def part_sent(self, url, index, guid, seconds):
+        labels = (('target', _target(url)),)
+        with self._lock:
+            self._values[('kentik_tagging_parts_sent_total', labels)] += 1
+            self._observe('kentik_tagging_part_send_seconds', labels, seconds)
+
+    def part_resplit(self, url, index, part_bytes, part_count, size):
+        labels = (('target', _target(url)),)
+        with self._lock:
+            self._values[('kentik_tagging_parts_resplit_total', labels)] += 1
+            self._values[('kentik_tagging_part_size_bytes', labels)] = size
+
+    def batch_submitted(self, url, guid, part_count, seconds):
+        labels = (('target', _target(url)),)
+        with self._lock:
+            self._values[('kentik_tagging_batches_submitted_total', labels)] += 1
+            self._observe('kentik_tagging_batch_submit_seconds', labels, seconds)
+
+    def batch_finished(self, batch_response, seconds):
+        with self._lock:
+            self._values[('kentik_tagging_batches_finished_total', ())] += 1
+            self._observe('kentik_tagging_batch_processing_seconds', (), seconds)
+            self._values[('kentik_tagging_invalid_upserts_total', ())] += batch_response.invalid_upsert_count()
+            self._values[('kentik_tagging_invalid_deletes_total', ())] += batch_response.invalid_delete_count()
+
+    def _buckets(self, name):
+        return _prometheusSizeBuckets.get(name, self.buckets)
+
+    def _observe(self, name, labels, value):
+        buckets = self._buckets(name)
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            histogram = self._histograms[(name, labels)] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            values = dict(self._values)
+            histograms = dict((key, list(histogram)) for key, histogram in self._histograms.items())
+
+        lines = []
+        for name, kind, description in _prometheusMetrics:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if kind != 'histogram':
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+                continue
+
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(self._buckets(name), histogram):
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', repr(float(bound))),)),
+                                                     count))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', '+Inf'),)), histogram[-1]))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(histogram[-2])))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host=''):
+        """Serve the metrics at http://host:port/metrics from a background thread"""
+        instrumentation = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                data = instrumentation.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever, name='PrometheusInstrumentation')
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """Stop serving the metrics"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+def _format_value(value):
+    if value == int(value):
+        return '%d' % value
+    return repr(value)
@@ -0,0 +1,189 @@
+"""Submission of many HyperScale batches at once, under an API rate limit
+
+A TokenBucket passed to the client as its rate_limiter spaces out every request the client sends - batch
+parts, retries and status polls alike - and backs off when the server answers 429 Too Many Requests. A
+SubmissionScheduler then submits the batches of many custom dimensions (and tags) concurrently through that
+client, so the API is kept busy up to the limit rather than waiting on one batch after another:
+
+    limiter = tagging_scheduler.TokenBucket(rate=10)
+    with tagging.Client('my@email.com', 'my_token', rate_limiter=limiter) as client:
+        scheduler = tagging_scheduler.SubmissionScheduler(client)
+        for column_name, batch in batches.items():
+            scheduler.add_populator_batch(column_name, batch)
+        scheduler.add_tag_batch(tag_batch, priority=1)
+        for job in scheduler.run():
+            print(job.column_name, job.guid, job.error)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+from kentikapi.v5 import tagging
+
+
+_logger = logging.getLogger(__name__)
+
+
+# how often a run of 429 responses may cut the rate, in seconds - the requests already in flight when the
+# first one arrives are likely to be throttled too, and shouldn't each cut it again
+_throttleCooldown = 1.0
+
+# how much of the configured rate each request granted without a 429 wins back, after the rate was cut
+_recoveryStep = 0.02
+
+
+class TokenBucket(object):
+    """A request budget of rate requests per second, shared by all the threads of one or more clients
+
+    Up to burst requests (one second's worth, by default) may go out back to back, after which they're
+    spaced 1/rate seconds apart. When the server still answers 429, requests are held back for as long as
+    its Retry-After header says, and the rate is halved - but to no less than min_rate - to then grow back
+    by a little with every request that goes through. When several hosts submit against the same account,
+    give each a share of the account's limit."""
+
+    def __init__(self, rate, burst=None, min_rate=None):
+        if rate <= 0:
+            raise ValueError("Invalid rate. Must be more than 0.")
+        if burst is None:
+            burst = max(1.0, float(rate))
+        if burst < 1:
+            raise ValueError("Invalid burst. Must be at least 1.")
+        if min_rate is None:
+            min_rate = rate / 16.0
+        if min_rate <= 0 or min_rate > rate:
+            raise ValueError("Invalid min_rate. Valid: more than 0, up to rate.")
+
+        self.max_rate = float(rate)
+        self.burst = float(burst)
+        self.min_rate = float(min_rate)
+        self._rate = self.max_rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()    # when tokens were last added - in the future while paused
+        self._last_cut = None
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        """The current rate, in requests per second - less than max_rate after the server throttled"""
+        with self._lock:
+            return self._rate
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+    def acquire(self):
+        """Wait until a request may be sent"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    if self._rate < self.max_rate:
+                        self._rate = min(self.max_rate, self._rate + self.max_rate * _recoveryStep)
+                    return
+                wait = max(0, self._updated - now) + (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        """Tell the bucket the server answered 429, with the seconds of its Retry-After header (or None)"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = 0
+            if retry_after is not None:
+                # nothing is sent, and no tokens are gained, until the server said to come back
+                self._updated = max(self._updated, now + retry_after)
+            if self._last_cut is None or now - self._last_cut >= _throttleCooldown:
+                self._last_cut = now
+                self._rate = max(self.min_rate, self._rate / 2)
+                _logger.warning('Throttled by the server, slowing down to %.2f requests/s%s', self._rate,
+                                '' if retry_after is None else ' after %.1fs' % retry_after)
+
+
+class SubmissionJob(object):
+    """A batch to submit with a SubmissionScheduler, and the outcome once it has run
+
+    column_name is None for a tag batch. After the run, guid is the batch guid if the submission
+    succeeded, error the exception it failed with otherwise, and seconds how long it took."""
+
+    def __init__(self, column_name, batch, priority, checkpoint):
+        self.column_name = column_name
+        self.batch = batch
+        self.priority = priority
+        self.checkpoint = checkpoint
+        self.guid = None
+        self.error = None
+        self.seconds = None
+
+    def __repr__(self):
+        return 'SubmissionJob(%s, guid=%s, error=%r)' % (self.column_name or 'tags', self.guid, self.error)
+
+
+class SubmissionScheduler(object):
+    """Submits many populator and tag batches concurrently through one client
+
+    Up to max_concurrent batches are submitted at once - by default, as many as the client's connection
+    pool has room for with each sending max_in_flight parts. Batches with a higher priority start first,
+    and batches with the same priority in the order they were added. Give the client a rate_limiter, like
+    a TokenBucket, to keep all of them under the API rate limit together."""
+
+    def __init__(self, client, max_concurrent=None):
+        if max_concurrent is None:
+            max_concurrent = max(1, client.pool_size // client.max_in_flight)
+        if max_concurrent < 1:
+            raise ValueError("Invalid max_concurrent. Must be at least 1.")
+        self.client = client
+        self.max_concurrent = max_concurrent
+        self._jobs = []
+
+    def add_populator_batch(self, column_name, batch, priority=0, checkpoint=None):
+        """Add a populator batch for a custom dimension to the next run, returning its SubmissionJob"""
+        tagging._populator_url('', column_name)    # fail now on an invalid name, rather than in the run
+        return self._add(SubmissionJob(column_name, batch, priority, checkpoint))
+
+    def add_tag_batch(self, batch, priority=0, checkpoint=None):
+        """Add a tag batch to the next run, returning its SubmissionJob"""
+        return self._add(SubmissionJob(None, batch, priority, checkpoint))
+
+    def _add(self, job):
+        self._jobs.append(job)
+        return job
+
+    def run(self, callback=None):
+        """Submit all the batches added since the last run, returning their SubmissionJobs in the order added
+
+        A batch that fails doesn't stop the others: its job has the error. callback, if given, is called
+        with each job as soon as it's done, eg. to start waiting for its batch."""
+        jobs, self._jobs = self._jobs, []
+        if len(jobs) == 0:
+            return jobs
+        # the executor starts its work in the order it's submitted - sorted is stable, so ties keep their order
+        ordered = sorted(jobs, key=lambda job: -job.priority)
+
+        def run_job(job):
+            self._submit(job)
+            if callback is not None:
+                callback(job)
+
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrent, len(jobs))) as executor:
+            futures = [executor.submit(run_job, job) for job in ordered]
+        for future in futures:
+            future.result()    # only raises if the callback did
+        return jobs
+
+    def _submit(self, job):
+        start = time.perf_counter()
+        try:
+            if job.column_name is None:
+                job.guid = self.client.submit_tag_batch(job.batch, job.checkpoint)
+            else:
+                job.guid = self.client.submit_populator_batch(job.column_name, job.batch, job.checkpoint)
+        except Exception as e:
+            job.error = e
+            _logger.warning('Submitting the %s batch failed: %s', job.column_name or 'tag', e)
+        job.seconds = time.perf_counter() - start
@@ -0,0 +1,434 @@
+"""Local stand-in for the Kentik HyperScale batch API
+
+BatchServer runs in-process (or from the command line) and implements the batch endpoints the tagging
+clients use, so the clients can be load and fault tested offline:
+
+    with tagging_testserver.BatchServer(latency=0.05, error_rate=0.01) as server:
+        client = tagging.Client('my@email.com', 'my_token', base_url=server.url)
+        guid = client.submit_populator_batch('c_my_column', batch)
+        print(server.stats())
+
+It follows the guid and 'complete' semantics of the real API, rejects bodies over the size limit, and can
+inject latency, errors, throttling and bandwidth caps. Completed batches are applied to an in-memory copy
+of the populators and tags, so the end result of a submission can be checked too. Run it standalone with:
+
+    python -m kentikapi.v5.tagging_testserver --port 8080 --latency 0.05"""
+
+import argparse
+from collections import Counter, deque
+import gzip
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+_populatorPath = re.compile(r'^/api/v5/batch/customdimensions/([A-Za-z0-9_]{3,20})/populators$')
+_tagPath = '/api/v5/batch/tags'
+_statusPath = re.compile(r'^/api/v5/batch/([^/]+)/status$')
+
+
+class BatchServer(object):
+    """An HTTP server implementing the HyperScale batch API, with fault injection
+
+    latency is the seconds each request is delayed by, or a (min, max) tuple to pick at random.
+    error_rate is the fraction of requests failed with one of error_statuses, and throttle_rate the
+    fraction failed with 429 Too Many Requests and a Retry-After of retry_after seconds. rate_limit
+    enforces an API rate limit of that many requests per second (with bursts of up to a second's
+    worth): requests beyond it get a 429, with a Retry-After of the seconds until one would be let
+    through. bandwidth caps how fast request bodies are read, in bytes per second per connection.
+    Batches are reported as pending for processing_time seconds after they complete. As in the real API, the
+    last upsert of a value in a batch wins - merge_upserts combines the criteria of all of them instead, for
+    testing clients that split a value's criteria across parts."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0, error_statuses=(500, 502, 503, 504),
+                 throttle_rate=0, retry_after=1, rate_limit=None, bandwidth=None, max_body_size=750000,
+                 processing_time=0, merge_upserts=False, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.bandwidth = bandwidth
+        self.max_body_size = max_body_size
+        self.processing_time = processing_time
+        self.merge_upserts = merge_upserts
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._injected = deque()       # statuses to fail the next requests with
+        self._batches = dict()         # by guid
+        self._targets = dict()         # the applied populators (by custom dimension) and tags: lower value -> upsert
+        self._stats = Counter()
+        self._allowance = rate_limit       # requests the rate limit lets through right now
+        self._allowance_time = time.monotonic()
+        self._thread = None
+
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.batch_server = self
+
+    @property
+    def url(self):
+        """The base URL to pass to the client"""
+        host, port = self._httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='BatchServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def serve_forever(self):
+        """Serve in the calling thread, until stop() is called"""
+        self._httpd.serve_forever()
+
+    def stop(self):
+        """Stop serving and close the listening socket"""
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def inject(self, status, count=1):
+        """Fail the next 'count' requests with an HTTP status, regardless of the error rates"""
+        with self._lock:
+            self._injected.extend([status] * count)
+
+    def stats(self):
+        """Return counters of requests, parts, bytes and response statuses"""
+        with self._lock:
+            return dict(self._stats)
+
+    def batch(self, guid):
+        """Return the state of a batch as a dict, or None if there's no such batch"""
+        with self._lock:
+            batch = self._batches.get(guid)
+            if batch is None:
+                return None
+            return batch.to_dict()
+
+    def populators(self, column_name):
+        """Return the applied populators of a custom dimension, as a dict of value to list of criteria"""
+        return self._applied('customdimensions/%s' % column_name)
+
+    def tags(self):
+        """Return the applied tags, as a dict of value to list of criteria"""
+        return self._applied('tags')
+
+    def _applied(self, target):
+        with self._lock:
+            upserts = self._targets.get(target, dict())
+            return dict((upsert['value'], upsert['criteria']) for upsert in upserts.values())
+
+    def _fault(self):
+        """Return the HTTP status to fail a request with and the Retry-After of a 429, or (None, None)"""
+        with self._lock:
+            if len(self._injected) > 0:
+                return self._injected.popleft(), self.retry_after
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                self._allowance = min(self.rate_limit,
+                                      self._allowance + (now - self._allowance_time) * self.rate_limit)
+                self._allowance_time = now
+                if self._allowance < 1:
+                    return 429, int(math.ceil((1 - self._allowance) / self.rate_limit))
+                self._allowance -= 1
+            r = self._random.random()
+            if r < self.throttle_rate:
+                return 429, self.retry_after
+            if r < self.throttle_rate + self.error_rate:
+                return self._random.choice(self.error_statuses), None
+        return None, None
+
+    def _delay(self):
+        latency = self.latency
+        if isinstance(latency, tuple):
+            with self._lock:
+                latency = self._random.uniform(*latency)
+        if latency > 0:
+            time.sleep(latency)
+
+    def _count(self, *names, **amounts):
+        with self._lock:
+            for name in names:
+                self._stats[name] += 1
+            for name, amount in amounts.items():
+                self._stats[name] += amount
+
+    def _submit_part(self, target, part):
+        """Add a part to its batch, returning (status, response dict)"""
+        with self._lock:
+            guid = part['guid']
+            if guid == '':
+                guid = str(uuid.uuid4())
+                batch = self._batches[guid] = _Batch(guid, target, part['replace_all'], self.merge_upserts)
+            else:
+                batch = self._batches.get(guid)
+                if batch is None:
+                    return 404, {'error': 'Unknown batch guid %s' % guid}
+                if batch.target != target:
+                    return 400, {'error': 'Batch %s is for %s, not %s' % (guid, batch.target, target)}
+                if batch.complete:
+                    return 400, {'error': 'Batch %s is already complete' % guid}
+                if batch.replace_all != part['replace_all']:
+                    return 400, {'error': 'replace_all differs from the first part of batch %s' % guid}
+
+            batch.add(part['upserts'], part['deletes'])
+            self._stats['parts_accepted'] += 1
+            if not part['complete']:
+                return 200, {'guid': guid, 'message': 'Part received'}
+
+            batch.complete = True
+            batch.completed_at = time.time()
+            self._apply(batch)
+            self._stats['batches_completed'] += 1
+            return 200, {'guid': guid, 'message': 'Batch complete'}
+
+    def _apply(self, batch):
+        """Apply a completed batch to the populators or tags of its target"""
+        if batch.replace_all:
+            applied = dict()
+        else:
+            applied = self._targets.get(batch.target, dict())
+            for value in batch.deletes:
+                applied.pop(value.lower(), None)
+        for key, upsert in batch.upserts.items():
+            applied[key] = upsert
+        self._targets[batch.target] = applied
+
+    def _status(self, guid):
+        """Return (status, response dict) for a batch status request"""
+        with self._lock:
+            batch = self._batches.get(guid)
+            if batch is None:
+                return 404, {'error': 'Unknown batch guid %s' % guid}
+            response = batch.to_dict()
+        response['is_pending'] = not batch.complete or time.time() - batch.completed_at < self.processing_time
+        return 200, response
+
+
+class _Batch(object):
+    """The parts of a batch received so far"""
+
+    def __init__(self, guid, target, replace_all, merge_upserts=False):
+        self.guid = guid
+        self.target = target
+        self.replace_all = replace_all
+        self.merge_upserts = merge_upserts
+        self.complete = False
+        self.completed_at = None
+        self.parts = 0
+        self.upserts = dict()     # lower value -> upsert
+        self.deletes = []
+        self.invalid_upserts = 0
+        self.invalid_deletes = 0
+
+    def add(self, upserts, deletes):
+        self.parts += 1
+        for upsert in upserts:
+            if not _valid_upsert(upsert):
+                self.invalid_upserts += 1
+                continue
+            previous = self.upserts.get(upsert['value'].lower())
+            if self.merge_upserts and previous is not None:
+                previous['criteria'].extend(upsert['criteria'])
+            else:
+                self.upserts[upsert['value'].lower()] = upsert
+        for delete in deletes:
+            if isinstance(delete, dict) and _valid_value(delete.get('value')):
+                self.deletes.append(delete['value'])
+            else:
+                self.invalid_deletes += 1
+
+    def to_dict(self):
+        return {'guid': self.guid, 'target': self.target, 'replace_all': self.replace_all,
+                'complete': self.complete, 'parts': self.parts,
+                'upserts': {'total': len(self.upserts) + self.invalid_upserts, 'invalid': self.invalid_upserts},
+                'deletes': {'total': len(self.deletes) + self.invalid_deletes, 'invalid': self.invalid_deletes}}
+
+
+def _valid_value(value):
+    return isinstance(value, str) and len(value.strip()) > 0
+
+
+def _valid_upsert(upsert):
+    if not isinstance(upsert, dict) or not _valid_value(upsert.get('value')):
+        return False
+    criteria = upsert.get('criteria')
+    if not isinstance(criteria, list) or len(criteria) == 0:
+        return False
+    return all(isinstance(c, dict) and c.get('direction') in ('src', 'dst', 'either') for c in criteria)
+
+
+def _parse_part(data):
+    """Return the batch part in a request body, or raise ValueError"""
+    part = json.loads(data.decode('utf-8'))
+    if not isinstance(part, dict):
+        raise ValueError('Batch part must be a JSON object')
+    for key, kind in (('replace_all', bool), ('complete', bool), ('upserts', list), ('deletes', list),
+                      ('guid', str)):
+        if not isinstance(part.get(key), kind):
+            raise ValueError('Batch part is missing %s, or it has the wrong type' % key)
+    return part
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server.batch_server
+        body = self._read_body(server)
+        if body is None:
+            return
+
+        if not self._check_request(server):
+            return
+
+        match = _populatorPath.match(self.path)
+        if match is not None:
+            target = 'customdimensions/%s' % match.group(1)
+        elif self.path == _tagPath:
+            target = 'tags'
+        else:
+            return self._reply(server, 404, {'error': 'Not found'})
+
+        try:
+            data = _decode_body(body, self.headers.get('Content-Encoding'))
+            part = _parse_part(data)
+        except (ValueError, OSError, zlib.error) as e:
+            return self._reply(server, 400, {'error': 'Invalid batch part: %s' % e})
+
+        server._count(uncompressed_bytes_received=len(data))
+        status, response = server._submit_part(target, part)
+        self._reply(server, status, response)
+
+    def do_GET(self):
+        server = self.server.batch_server
+        if not self._check_request(server):
+            return
+
+        match = _statusPath.match(self.path)
+        if match is None:
+            return self._reply(server, 404, {'error': 'Not found'})
+        status, response = server._status(match.group(1))
+        self._reply(server, status, response)
+
+    def _read_body(self, server):
+        """Read the request body at the capped bandwidth - returns None if it was rejected"""
+        length = int(self.headers.get('Content-Length', 0))
+        if length > server.max_body_size:
+            # read it anyway, so the client gets the response rather than a broken connection
+            remaining = length
+            while remaining > 0:
+                remaining -= len(self.rfile.read(min(65536, remaining))) or remaining
+            server._count('requests')
+            self._reply(server, 413, {'error': 'Request body of %d bytes is over the limit of %d bytes'
+                                               % (length, server.max_body_size)})
+            return None
+
+        chunks = []
+        received = 0
+        start = time.time()
+        while received < length:
+            chunk = self.rfile.read(min(65536, length - received))
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+            received += len(chunk)
+            if server.bandwidth is not None:
+                wait = start + float(received) / server.bandwidth - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+        server._count(bytes_received=received)
+        return b''.join(chunks)
+
+    def _check_request(self, server):
+        """Count the request, and fail it if it's unauthenticated or a fault is injected - returns whether to go on"""
+        server._count('requests')
+        server._delay()
+
+        if not self.headers.get('X-CH-Auth-Email') or not self.headers.get('X-CH-Auth-API-Token'):
+            self._reply(server, 401, {'error': 'Missing X-CH-Auth-Email or X-CH-Auth-API-Token'})
+            return False
+
+        status, retry_after = server._fault()
+        if status is None:
+            return True
+        headers = dict()
+        if status == 429:
+            headers['Retry-After'] = str(retry_after)
+        self._reply(server, status, {'error': 'Injected fault'}, headers)
+        return False
+
+    def _reply(self, server, status, response, headers=None):
+        server._count('status_%d' % status)
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _decode_body(body, content_encoding):
+    if content_encoding is None or content_encoding == 'identity':
+        return body
+    if content_encoding == 'gzip':
+        return gzip.decompress(body)
+    if content_encoding == 'deflate':
+        return zlib.decompress(body)
+    raise ValueError('Unsupported Content-Encoding %s' % content_encoding)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the Kentik batch API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='seconds to delay each request by')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failed with a 5xx')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='fraction of requests failed with a 429')
+    parser.add_argument('--rate-limit', type=float, help='requests per second let through, beyond which a 429')
+    parser.add_argument('--bandwidth', type=float, help='bytes per second to read request bodies at')
+    parser.add_argument('--max-body-size', type=int, default=750000)
+    parser.add_argument('--processing-time', type=float, default=0,
+                        help='seconds completed batches are reported as pending')
+    parser.add_argument('--merge-upserts', action='store_true',
+                        help='combine the criteria of a value upserted in several parts, rather than keep the last')
+    args = parser.parse_args(argv)
+
+    server = BatchServer(args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+                         throttle_rate=args.throttle_rate, rate_limit=args.rate_limit, bandwidth=args.bandwidth,
+                         max_body_size=args.max_body_size, processing_time=args.processing_time,
+                         merge_upserts=args.merge_upserts)
+    print('Serving the batch API at %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats(), indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,21 @@ from setuptools import setup, find_packages
 
 setup(
     name='kentikapi',
-    version='0.1.10',
+    version='0.2.0',
     author='Blake Caldwell',
     packages=find_packages(),
     url='https://github.com/kentik/api-client',
     license='LICENSE.txt',
     description='Kentik API Client',
     long_description=open('README.md').read(),
+    python_requires='>=3.7',
     install_requires=['requests'],
+    extras_require={
+        'async': ['aiohttp'],
+        'match': ['numpy'],
+        'test': ['pytest', 'numpy', 'aiohttp'],
+    },
+    entry_points={
+        'console_scripts': ['kentik-tagging = kentikapi.v5.tagging_cli:main'],
+    },
 )
@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+from kentikapi.v5 import tagging, tagging_testserver
+
+
+@pytest.fixture
+def server():
+    with tagging_testserver.BatchServer() as server:
+        yield server
+
+
+def random_populators(count, seed=1):
+    """Return a list of (value, list of Criteria) with a mix of fields, for count values"""
+    rng = random.Random(seed)
+    populators = []
+    for i in range(count):
+        criteria_list = []
+        for _ in range(rng.randint(1, 3)):
+            criteria = tagging.Criteria(rng.choice(['src', 'dst', 'either']))
+            for _ in range(rng.randint(1, 4)):
+                criteria.add_ip_address('10.%d.%d.%d/%d' % (rng.randrange(256), rng.randrange(256),
+                                                            rng.randrange(256), rng.choice([24, 28, 32])))
+            if rng.random() < 0.5:
+                start = rng.randrange(1, 60000)
+                criteria.add_port_range(start, start + rng.randrange(100))
+            if rng.random() < 0.3:
+                criteria.add_protocol(rng.choice([6, 17]))
+            if rng.random() < 0.2:
+                criteria.add_site_name('site-%d' % rng.randrange(5))
+            criteria_list.append(criteria)
+        populators.append(('Value-%d' % i, criteria_list))
+    return populators
+
+
+def make_batch(populators, replace_all=True):
+    batch = tagging.Batch(replace_all)
+    for value, criteria_list in populators:
+        for criteria in criteria_list:
+            batch.add_upsert(value, criteria)
+    return batch
+
+
+def expected_state(populators):
+    """Return the populators as the test server reports them once applied: value -> list of criteria dicts"""
+    return dict((value, [criteria.to_dict() for criteria in criteria_list]) for value, criteria_list in populators)
+
+
+class FailAfter(tagging.Instrumentation):
+    """Makes the server fail the request after 'parts' parts were sent"""
+
+    def __init__(self, server, parts):
+        self.server = server
+        self.parts = parts
+        self.sent = 0
+
+    def part_sent(self, url, index, guid, seconds):
+        self.sent += 1
+        if self.sent == self.parts:
+            self.server.inject(500)
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from kentikapi.v5 import tagging, tagging_testserver
+
+from conftest import expected_state, make_batch, random_populators
+
+pytest.importorskip('aiohttp')
+tagging_async = pytest.importorskip('kentikapi.v5.tagging_async')
+
+
+def _run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.mark.parametrize('compression, max_in_flight', [(None, 1), ('gzip', 4)])
+def test_round_trip(server, compression, max_in_flight):
+    populators = random_populators(2000)
+    batches = dict(('c_async_%d' % i, make_batch(populators[i::3])) for i in range(3))
+
+    async def submit():
+        async with tagging_async.AsyncClient('test@example.com', 'token', base_url=server.url,
+                                             compression=compression, max_in_flight=max_in_flight,
+                                             part_size=tagging.PartSizePolicy(30000, 30000)) as client:
+            return await asyncio.gather(*[client.submit_populator_batch(column_name, batch)
+                                          for column_name, batch in batches.items()])
+
+    guids = _run(submit())
+    assert len(set(guids)) == 3
+    for i in range(3):
+        assert server.populators('c_async_%d' % i) == expected_state(populators[i::3])
+
+
+def test_too_big_parts_are_resplit():
+    populators = random_populators(2000)
+    with tagging_testserver.BatchServer(max_body_size=60000) as server:
+        async def submit():
+            async with tagging_async.AsyncClient('test@example.com', 'token', base_url=server.url,
+                                                 part_size=tagging.PartSizePolicy(200000, 10000)) as client:
+                return await client.submit_tag_batch(make_batch(populators))
+
+        _run(submit())
+        assert server.stats()['status_413'] >= 1
+        assert server.tags() == expected_state(populators)
+
+
+@pytest.fixture
+def server_process():
+    """A BatchServer in a process of its own, so parsing the parts doesn't hold this process' GIL"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    process = subprocess.Popen([sys.executable, '-u', '-m', 'kentikapi.v5.tagging_testserver', '--port', '0'],
+                               stdout=subprocess.PIPE, env=env, universal_newlines=True)
+    try:
+        line = process.stdout.readline()
+        assert line.startswith('Serving the batch API at '), line
+        yield line.split()[-1]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def test_packing_does_not_stall_the_event_loop(server_process):
+    batch = make_batch(random_populators(40000))
+    start = time.perf_counter()
+    batch.parts()
+    packing_seconds = time.perf_counter() - start
+
+    async def ticker(stop, gaps):
+        last = time.perf_counter()
+        while not stop.is_set():
+            await asyncio.sleep(0.01)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    async def submit():
+        stop = asyncio.Event()
+        gaps = []
+        ticks = asyncio.ensure_future(ticker(stop, gaps))
+        await asyncio.sleep(0.05)    # let the ticker start
+        async with tagging_async.AsyncClient('test@example.com', 'token', base_url=server_process,
+                                             compression='gzip') as client:
+            await client.submit_populator_batch('c_async_loop', batch, tagging.SubmissionCheckpoint())
+        stop.set()
+        await ticks
+        return max(gaps)
+
+    max_gap = _run(submit())
+    # packing alone takes far longer than the loop may go without running the ticker
+    assert max_gap < max(0.1, packing_seconds / 4), (max_gap, packing_seconds)
@@ -0,0 +1,105 @@
+import random
+
+import pytest
+
+from kentikapi.v5 import tagging, tagging_bulk
+
+
+def _random_columns(count, seed):
+    rng = random.Random(seed)
+    columns = dict(value=[], direction=[], addr=[], port=[], protocol=[], asn=[])
+    for _ in range(count):
+        columns['value'].append('Value-%d' % rng.randrange(count // 10))
+        columns['direction'].append(rng.choice(['src', 'dst', 'either', 'SRC']))
+        kind = rng.random()
+        if kind < 0.1:
+            addr = None
+        elif kind < 0.6:
+            addr = '%d.%d.%d.%d' % (rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.randrange(256))
+            if rng.random() < 0.5:
+                addr += '/%d' % rng.randrange(33)
+        else:
+            # IPv6 written in all sorts of ways
+            addr = rng.choice(['2001:DB8::%X', '2001:db8:0:0::%x', '2001:0db8::0:%x', '::ffff:%x']) \
+                % rng.randrange(1, 65536)
+            if rng.random() < 0.5:
+                addr += '/%d' % rng.randrange(129)
+        columns['addr'].append(addr)
+        columns['port'].append(rng.choice([None, 80, 443]))
+        columns['protocol'].append(rng.choice([None, 6, 17]))
+        columns['asn'].append(rng.choice([None, 15169, 4200000000]))
+    return columns
+
+
+def _criteria_by_value(batch):
+    return dict((value.lower(), sorted(criteria_array)) for value, criteria_array in batch._iter_upserts())
+
+
+@pytest.mark.parametrize('seed', [1, 2])
+def test_batch_from_columns_encodes_like_criteria(seed):
+    columns = _random_columns(5000, seed)
+
+    # the same grouping, with a Criteria per group built as any caller would
+    groups = dict()
+    for row in zip(*[columns[name] for name in ('value', 'direction', 'addr', 'port', 'protocol', 'asn')]):
+        value, direction, addr, port, protocol, asn = row
+        key = (value, direction.lower(), port, protocol, asn, addr is None)
+        criteria = groups.get(key)
+        if criteria is None:
+            criteria = groups[key] = tagging.Criteria(direction)
+            if port is not None:
+                criteria.add_port(port)
+            if protocol is not None:
+                criteria.add_protocol(protocol)
+            if asn is not None:
+                criteria.add_asn(asn)
+        if addr is not None:
+            criteria.add_ip_address(addr)
+    expected = tagging.Batch(True)
+    for key, criteria in groups.items():
+        expected.add_upsert(key[0], criteria)
+
+    batch = tagging_bulk.batch_from_columns(True, **columns)
+    assert _criteria_by_value(batch) == _criteria_by_value(expected)
+
+
+def test_batch_from_columns_orders_ipv4_before_ipv6():
+    batch = tagging_bulk.batch_from_columns(True, ['web'] * 3, ['src'] * 3,
+                                            addr=['2001:DB8::1', '10.0.0.1/8', '2001:db8:0::2/64'])
+    assert list(batch._iter_upserts()) == \
+        [('web', [b'{"direction": "src", "addr": ["10.0.0.1/8", "2001:db8::1", "2001:db8::2/64"]}'])]
+
+
+@pytest.mark.parametrize('addr', ['10.0.0.256', '10.0.0.1/33', 'example.com', '2001:db8::1/129', '10.0.0.1/08'])
+def test_batch_from_columns_rejects_invalid_addresses(addr):
+    with pytest.raises(ValueError) as e:
+        tagging_bulk.batch_from_columns(True, ['a', 'b', 'c'], ['src'] * 3, addr=['10.0.0.1', None, addr])
+    assert 'Invalid addr in row 2' in str(e.value)
+
+
+@pytest.mark.parametrize('column, value', [('value', float('nan')), ('value', None), ('value', 7),
+                                           ('direction', float('nan')), ('addr', 10)])
+def test_batch_from_columns_rejects_non_strings(column, value):
+    columns = dict(value=['a', 'b', 'c'], direction=['src'] * 3, addr=['10.0.0.1', None, '10.0.0.2'])
+    columns[column][1] = value
+    with pytest.raises(ValueError) as e:
+        tagging_bulk.batch_from_columns(True, **columns)
+    assert 'Invalid %s in row 1' % column in str(e.value)
+
+
+@pytest.mark.parametrize('port', ['80', '80-90', b'80', float('inf'), 80.5, 1j])
+def test_batch_from_columns_rejects_non_integers(port):
+    with pytest.raises(ValueError) as e:
+        tagging_bulk.batch_from_columns(True, ['a', 'b', 'c'], ['src'] * 3, port=[443, port, None])
+    assert 'Invalid port in row 1' in str(e.value)
+
+
+def test_batch_from_columns_rejects_nan_values_in_arrays():
+    numpy = pytest.importorskip('numpy')
+    with pytest.raises(ValueError) as e:
+        tagging_bulk.batch_from_columns(True, numpy.array(['a', numpy.nan, 'c'], dtype=object), ['src'] * 3)
+    assert 'Invalid value in row 1' in str(e.value)
+    with pytest.raises(ValueError) as e:
+        tagging_bulk.batch_from_columns(True, ['a', 'b', 'c'], ['src'] * 3,
+                                        protocol=numpy.array([6, 'udp', None], dtype=object))
+    assert 'Invalid protocol in row 1' in str(e.value)
@@ -0,0 +1,103 @@
+import pytest
+
+from kentikapi.v5 import tagging
+
+
+def _canonical(direction='src', addrs=(), ports=(), asns=(), protocols=(), sites=()):
+    criteria = _criteria(direction, addrs, ports, asns, protocols, sites)
+    criteria.canonicalize()
+    return criteria.to_dict()
+
+
+def _criteria(direction='src', addrs=(), ports=(), asns=(), protocols=(), sites=()):
+    """Return a Criteria - ports and asns are (start, end) ranges"""
+    criteria = tagging.Criteria(direction)
+    for addr in addrs:
+        criteria.add_ip_address(addr)
+    for start, end in ports:
+        criteria.add_port_range(start, end)
+    for start, end in asns:
+        criteria.add_asn_range(start, end)
+    for protocol in protocols:
+        criteria.add_protocol(protocol)
+    for site in sites:
+        criteria.add_site_name(site)
+    return criteria
+
+
+@pytest.mark.parametrize('addrs, collapsed', [
+    # contained
+    (['10.1.2.0/24', '10.0.0.0/8', '10.1.2.3'], ['10.0.0.0/8']),
+    (['10.0.0.5', '10.0.0.5/32', '10.0.0.5'], ['10.0.0.5']),
+    # adjacent
+    (['10.0.0.128/25', '10.0.0.0/25'], ['10.0.0.0/24']),
+    (['10.0.0.0/24', '10.0.1.0/24', '10.0.2.0/24'], ['10.0.0.0/23', '10.0.2.0/24']),
+    (['10.0.0.2', '10.0.0.3', '10.0.0.1', '10.0.0.0'], ['10.0.0.0/30']),
+    # neither
+    (['10.0.1.0/24', '10.0.2.0/24'], ['10.0.1.0/24', '10.0.2.0/24']),
+    # host bits set after the prefix length
+    (['10.1.2.3/8'], ['10.0.0.0/8']),
+    (['2001:db8:8000::/33', '2001:DB8::/33', '2001:db8::1'], ['2001:db8::/32']),
+    (['2001:db8::1', '10.0.0.1', 'not-an-address', 'not-an-address'], ['10.0.0.1', '2001:db8::1', 'not-an-address']),
+])
+def test_addresses_are_collapsed(addrs, collapsed):
+    assert _canonical(addrs=addrs)['addr'] == collapsed
+
+
+def test_collapse_networks_splits_into_aligned_blocks():
+    # 10.0.0.1 - 10.0.0.6 isn't a single prefix
+    networks = [(0x0a000000 + i, tagging._noPrefixLength) for i in range(1, 7)]
+    assert tagging._collapse_networks(networks, 32) == \
+        [(0x0a000001, tagging._noPrefixLength), (0x0a000002, 31), (0x0a000004, 31),
+         (0x0a000006, tagging._noPrefixLength)]
+    assert tagging._collapse_networks([(0, 0), (0x0a000000, 8)], 32) == [(0, 0)]
+
+
+@pytest.mark.parametrize('ranges, merged', [
+    ([(80, 90), (85, 100)], ['80-100']),          # overlapping
+    ([(80, 90), (91, 100)], ['80-100']),          # adjacent
+    ([(100, 200), (120, 130)], ['100-200']),      # contained
+    ([(443, 443), (80, 80), (80, 80)], ['80', '443']),
+    ([(80, 90), (92, 100)], ['80-90', '92-100']),
+])
+def test_port_and_asn_ranges_are_merged(ranges, merged):
+    assert _canonical(ports=ranges)['port'] == merged
+    assert _canonical(asns=ranges)['asn'] == merged
+
+
+def test_duplicate_values_are_removed():
+    assert _canonical(protocols=[17, 6, 17], sites=['b', 'a', 'b']) == \
+        {'direction': 'src', 'protocol': [6, 17], 'site': ['b', 'a']}
+
+
+def _merged(*criteria_list):
+    return [criteria.to_dict() for criteria in tagging._merge_criteria(list(criteria_list))]
+
+
+def test_duplicate_criteria_are_removed():
+    assert _merged(_criteria(addrs=['10.0.0.1']), _criteria(addrs=['10.0.0.1/32']), _criteria(addrs=['10.0.0.1'])) \
+        == [{'direction': 'src', 'addr': ['10.0.0.1']}]
+    assert _merged(_criteria('dst'), _criteria('dst')) == [{'direction': 'dst'}]
+
+
+def test_criteria_differing_in_one_field_are_merged():
+    assert _merged(_criteria(addrs=['10.0.0.0/25'], ports=[(80, 80)]),
+                   _criteria(addrs=['10.0.0.128/25'], ports=[(80, 80)]),
+                   _criteria(addrs=['10.0.2.0/24'], ports=[(80, 80)])) == \
+        [{'direction': 'src', 'addr': ['10.0.0.0/24', '10.0.2.0/24'], 'port': ['80']}]
+    assert _merged(_criteria(ports=[(80, 80)], protocols=[6]), _criteria(ports=[(81, 90)], protocols=[6]),
+                   _criteria(ports=[(443, 443)], protocols=[6])) == \
+        [{'direction': 'src', 'port': ['80-90', '443'], 'protocol': [6]}]
+
+
+@pytest.mark.parametrize('criteria_list', [
+    # two fields differ
+    [_criteria(addrs=['10.0.0.1'], ports=[(80, 80)]), _criteria(addrs=['10.0.0.2'], ports=[(443, 443)])],
+    # a field is missing from one - it matches any port, not only 80
+    [_criteria(addrs=['10.0.0.1'], ports=[(80, 80)]), _criteria(addrs=['10.0.0.2'])],
+    # the direction differs
+    [_criteria('src', addrs=['10.0.0.1']), _criteria('dst', addrs=['10.0.0.2'])],
+])
+def test_criteria_differing_in_more_than_one_field_are_kept(criteria_list):
+    expected = [criteria.to_dict() for criteria in criteria_list]
+    assert _merged(*criteria_list) == expected
@@ -0,0 +1,94 @@
+import pytest
+
+from kentikapi.v5 import tagging, tagging_delta
+
+from conftest import expected_state, make_batch, random_populators
+
+
+@pytest.fixture
+def client(server):
+    with tagging.Client('test@example.com', 'token', base_url=server.url) as client:
+        yield client
+
+
+@pytest.fixture
+def store(tmp_path):
+    with tagging_delta.SnapshotStore(str(tmp_path / 'snapshot.db')) as store:
+        yield store
+
+
+def _changed(populators):
+    """Return the populators with some values changed, some removed and some added"""
+    changed = [(value, criteria_list[:1]) if i % 10 == 0 else (value, criteria_list)
+               for i, (value, criteria_list) in enumerate(populators) if i % 7 != 0]
+    return changed + [('New-%d' % value, criteria_list) for value, (_, criteria_list) in enumerate(populators[:5])]
+
+
+@pytest.mark.parametrize('tags', [False, True])
+def test_first_sync_submits_everything(server, client, store, tags):
+    populators = random_populators(200)
+    sync = tagging_delta.DeltaSync(client, store)
+    if tags:
+        guid = sync.sync_tags(make_batch(populators))
+        assert server.tags() == expected_state(populators)
+    else:
+        guid = sync.sync_populators('c_delta', make_batch(populators))
+        assert server.populators('c_delta') == expected_state(populators)
+    assert server.batch(guid)['replace_all'] is True
+    assert server.batch(guid)['upserts']['total'] == len(populators)
+    assert len(store.digests(':tags' if tags else 'c_delta')) == len(populators)
+
+
+@pytest.mark.parametrize('tags', [False, True])
+def test_sync_without_changes_submits_nothing(server, client, store, tags):
+    populators = random_populators(200)
+    sync = tagging_delta.DeltaSync(client, store)
+    if tags:
+        sync.sync_tags(make_batch(populators))
+        assert sync.sync_tags(make_batch(populators)) is None
+    else:
+        sync.sync_populators('c_delta', make_batch(populators))
+        assert sync.sync_populators('c_delta', make_batch(list(reversed(populators)))) is None
+    assert server.stats()['batches_completed'] == 1
+
+
+def test_delta_sync_submits_upserts_and_deletes(server, client, store):
+    populators = random_populators(200)
+    sync = tagging_delta.DeltaSync(client, store)
+    sync.sync_populators('c_delta', make_batch(populators))
+
+    changed = _changed(populators)
+    guid = sync.sync_populators('c_delta', make_batch(changed))
+
+    batch = server.batch(guid)
+    assert batch['replace_all'] is False
+    before = dict(populators)
+    upserts = [value for value, criteria_list in changed if before.get(value) != criteria_list]
+    assert 5 < len(upserts) < 40
+    assert batch['upserts']['total'] == len(upserts)
+    assert batch['deletes']['total'] == len(populators) + 5 - len(changed)
+    assert server.populators('c_delta') == expected_state(changed)
+    assert sync.sync_populators('c_delta', make_batch(changed)) is None
+
+
+def test_full_replace_after_the_interval(server, client, store):
+    populators = random_populators(200)
+    tagging_delta.DeltaSync(client, store).sync_populators('c_delta', make_batch(populators))
+    changed = _changed(populators)
+
+    sync = tagging_delta.DeltaSync(client, store, full_replace_interval=0)
+    guid = sync.sync_populators('c_delta', make_batch(changed))
+    assert server.batch(guid)['replace_all'] is True
+    assert server.batch(guid)['upserts']['total'] == len(changed)
+
+    # the full replace refreshed the snapshot, so there's nothing left to send
+    sync = tagging_delta.DeltaSync(client, store)
+    assert sync.sync_populators('c_delta', make_batch(changed)) is None
+    guid = sync.sync_populators('c_delta', make_batch(changed), force_full=True)
+    assert server.batch(guid)['replace_all'] is True
+    assert server.populators('c_delta') == expected_state(changed)
+
+
+def test_delta_sync_needs_a_replace_all_batch(client, store):
+    with pytest.raises(ValueError):
+        tagging_delta.DeltaSync(client, store).sync_populators('c_delta', make_batch(random_populators(10), False))
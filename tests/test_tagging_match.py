@@ -0,0 +1,180 @@
+import ipaddress
+import random
+
+import pytest
+
+from kentikapi.v5 import tagging
+
+numpy = pytest.importorskip('numpy')
+tagging_match = pytest.importorskip('kentikapi.v5.tagging_match')
+
+
+_sites = ['site-%d' % i for i in range(5)]
+
+
+def _random_v4(rng):
+    return '10.%d.%d.%d' % (rng.randrange(4), rng.randrange(256), rng.randrange(256))
+
+
+def _random_v6(rng):
+    return '2001:db8::%x:%x' % (rng.randrange(4), rng.randrange(65536))
+
+
+def _random_criteria(rng):
+    criteria = tagging.Criteria(rng.choice(['src', 'dst', 'either']))
+    if rng.random() < 0.7:
+        for _ in range(rng.randrange(1, 5)):
+            if rng.random() < 0.7:
+                criteria.add_ip_address('%s/%d' % (_random_v4(rng), rng.choice([16, 20, 24, 28, 30, 32])))
+            else:
+                criteria.add_ip_address('%s/%d' % (_random_v6(rng), rng.choice([64, 112, 120, 128])))
+    if rng.random() < 0.4:
+        for _ in range(rng.randrange(1, 4)):
+            start = rng.randrange(0, 2000)
+            criteria.add_port_range(start, start + rng.randrange(0, 300))
+    if rng.random() < 0.3:
+        criteria.add_protocol(rng.choice([6, 17]))
+    if rng.random() < 0.2:
+        criteria.add_site_name(rng.choice(_sites))
+    if rng.random() < 0.2:
+        criteria.add_asn_range(rng.randrange(100), rng.randrange(100, 200))
+    if rng.random() < 0.15:
+        criteria.add_tcp_flag(rng.choice([1, 2, 16]))
+    return criteria
+
+
+def _random_populators(rng, count):
+    return [('v%d' % i, [_random_criteria(rng) for _ in range(rng.randrange(1, 3))]) for i in range(count)]
+
+
+def _random_flows(rng, count):
+    flows = dict((name, []) for name in ('src_addr', 'dst_addr', 'src_port', 'dst_port', 'protocol', 'site',
+                                         'src_asn', 'dst_asn', 'tcp_flags'))
+    for _ in range(count):
+        for name in ('src_addr', 'dst_addr'):
+            r = rng.random()
+            flows[name].append(_random_v4(rng) if r < 0.6 else _random_v6(rng) if r < 0.9 else None)
+        for name in ('src_port', 'dst_port'):
+            flows[name].append(rng.randrange(2400) if rng.random() < 0.95 else None)
+        flows['protocol'].append(rng.choice([6, 17, 1]))
+        flows['site'].append(rng.choice(_sites + ['other', None]))
+        for name in ('src_asn', 'dst_asn'):
+            flows[name].append(rng.randrange(250))
+        flows['tcp_flags'].append(rng.randrange(32))
+    return flows
+
+
+def _in_ranges(x, ranges):
+    for r in ranges:
+        start, _, end = r.partition('-')
+        if int(start) <= x <= int(end or start):
+            return True
+    return False
+
+
+def _side_matches(d, flows, i, side):
+    """Whether flow i matches criteria dict d on one side - the reference the Matcher is checked against"""
+    if 'addr' in d:
+        address = flows[side + '_addr'][i]
+        if address is None:
+            return False
+        address = ipaddress.ip_address(address)
+        if not any(address in network for network in d['_networks']):
+            return False
+    if 'port' in d:
+        port = flows[side + '_port'][i]
+        if port is None or not _in_ranges(port, d['port']):
+            return False
+    if 'asn' in d and not _in_ranges(flows[side + '_asn'][i], d['asn']):
+        return False
+    if 'protocol' in d and flows['protocol'][i] not in d['protocol']:
+        return False
+    if 'site' in d and flows['site'][i] not in d['site']:
+        return False
+    if 'tcp_flags' in d and not flows['tcp_flags'][i] & d['tcp_flags']:
+        return False
+    return True
+
+
+def _brute_force(populators, flows, count):
+    """Return the index of the first value each flow matches (or -1), and the count of flows per value"""
+    rules = []
+    for value_index, (_, criteria_list) in enumerate(populators):
+        for criteria in criteria_list:
+            d = criteria.to_dict()
+            d['_networks'] = [ipaddress.ip_network(a, strict=False) for a in d.get('addr', [])]
+            sides = {'src': ['src'], 'dst': ['dst'], 'either': ['src', 'dst']}[d['direction']]
+            rules.append((value_index, d, sides))
+
+    first = []
+    counts = [0] * len(populators)
+    for i in range(count):
+        matched = set(value_index for value_index, d, sides in rules
+                      if any(_side_matches(d, flows, i, side) for side in sides))
+        for value_index in matched:
+            counts[value_index] += 1
+        first.append(min(matched) if matched else -1)
+    return first, counts
+
+
+@pytest.mark.parametrize('seed', [1, 2])
+def test_matcher_agrees_with_brute_force(seed):
+    rng = random.Random(seed)
+    populators = _random_populators(rng, 120)
+    flows = _random_flows(rng, 1500)
+    batch = tagging.Batch(True)
+    for value, criteria_list in populators:
+        for criteria in criteria_list:
+            batch.add_upsert(value, criteria)
+
+    result = tagging_match.Matcher(batch).match(flows, chunk_size=700)
+
+    first, counts = _brute_force(populators, flows, 1500)
+    assert result.values == [value for value, _ in populators]
+    assert result.value_index.tolist() == first
+    assert result.counts.tolist() == counts
+    assert sum(1 for i in first if i >= 0) > 100    # the flows are close enough to the criteria to match some
+
+
+def test_matcher_takes_criteria_pairs_and_integer_addresses():
+    criteria = tagging.Criteria('dst')
+    criteria.add_ip_address('192.168.0.0/16')
+    criteria.add_port(443)
+    matcher = tagging_match.Matcher([('web', criteria)])
+    flows = {'dst_addr': numpy.array([0xc0a80101, 0xc0a90101, 0xc0a80101]), 'dst_port': [443, 443, 80]}
+    result = matcher.match(flows)
+    assert result.matched_values() == ['web', None, None]
+    assert result.counts_by_value() == {'web': 1}
+
+
+@pytest.mark.parametrize('seed', [3, 4])
+def test_canonicalization_preserves_matches(seed):
+    rng = random.Random(seed)
+    populators = _random_populators(rng, 150)
+    # make the criteria worth canonicalizing: duplicate, adjacent and overlapping values
+    for _, criteria_list in populators:
+        for criteria in criteria_list:
+            d = criteria.to_dict()
+            for address in d.get('addr', []):
+                network = ipaddress.ip_network(address, strict=False)
+                if network.num_addresses > 1:
+                    criteria.add_ip_address(str(next(network.subnets())))
+                criteria.add_ip_address(address)
+            for port in d.get('port', []):
+                start, _, end = port.partition('-')
+                criteria.add_port_range(int(end or start), int(end or start) + 50)
+    flows = _random_flows(rng, 3000)
+
+    plain = tagging.Batch(True)
+    canonical = tagging.Batch(True, canonicalize=True)
+    for value, criteria_list in populators:
+        for criteria in criteria_list:
+            plain.add_upsert(value, criteria)
+            canonical.add_upsert(value, criteria)
+
+    plain_result = tagging_match.Matcher(plain).match(flows)
+    canonical_result = tagging_match.Matcher(canonical).match(flows)
+    assert canonical_result.value_index.tolist() == plain_result.value_index.tolist()
+    assert canonical_result.counts.tolist() == plain_result.counts.tolist()
+    assert sum(len(part.build_json('')) for part in canonical.parts()) < \
+        sum(len(part.build_json('')) for part in plain.parts())
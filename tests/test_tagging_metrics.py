@@ -0,0 +1,56 @@
+import socket
+
+import pytest
+
+from kentikapi.v5 import tagging, tagging_metrics
+
+from conftest import make_batch, random_populators
+
+
+class _SizeRecorder(tagging.Instrumentation):
+    def __init__(self):
+        self.sizes = []
+
+    def part_serialized(self, url, index, estimated_bytes, json_bytes, body_bytes, seconds):
+        self.sizes.append((estimated_bytes, body_bytes))
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_estimated_part_sizes_match_the_bodies(server, compression):
+    recorder = _SizeRecorder()
+    client = tagging.Client('test@example.com', 'token', base_url=server.url, compression=compression,
+                            part_size=tagging.PartSizePolicy(30000, 30000), instrumentation=recorder)
+    with client:
+        client.submit_populator_batch('c_metrics', make_batch(random_populators(2000)))
+
+    assert len(recorder.sizes) > 2
+    for estimated_bytes, body_bytes in recorder.sizes:
+        if compression is None:
+            # the packer counts the last part as not completing the batch - "false" is a byte longer than "true"
+            assert 0 <= estimated_bytes - body_bytes <= 1
+        else:
+            # flushing the compressor while packing costs some compression: the estimate is a little high, never low
+            assert 0 <= estimated_bytes - body_bytes <= estimated_bytes * 0.05
+
+
+def test_exporters_report_the_size_error_the_same_way(server):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(5)
+    statsd = tagging_metrics.StatsdInstrumentation('127.0.0.1', receiver.getsockname()[1])
+    prometheus = tagging_metrics.PrometheusInstrumentation()
+    try:
+        for metrics in (statsd, prometheus):
+            metrics.part_serialized(server.url + '/api/v5/batch/tags', 0, 1036, 1000, 1000, 0.01)
+            metrics.part_serialized(server.url + '/api/v5/batch/tags', 1, 900, 1000, 1000, 0.01)
+        lines = receiver.recv(65536).decode('utf-8').split('\n') + receiver.recv(65536).decode('utf-8').split('\n')
+    finally:
+        statsd.close()
+        receiver.close()
+
+    assert [line for line in lines if 'size_error' in line] == \
+        ['kentik.tagging.tags.part.size_error_bytes:36|ms', 'kentik.tagging.tags.part.size_error_bytes:100|ms']
+    rendered = prometheus.render()
+    assert 'kentik_tagging_part_size_error_bytes_sum{target="tags"} 136' in rendered
+    assert 'kentik_tagging_part_size_error_bytes_bucket{target="tags",le="64.0"} 1' in rendered
+    assert 'kentik_tagging_part_size_error_bytes_count{target="tags"} 2' in rendered
@@ -0,0 +1,99 @@
+import time
+
+from kentikapi.v5 import tagging, tagging_scheduler, tagging_testserver
+
+from conftest import expected_state, make_batch, random_populators
+
+
+def _timed(function, count):
+    start = time.monotonic()
+    for _ in range(count):
+        function()
+    return time.monotonic() - start
+
+
+def test_token_bucket_bursts_then_blocks():
+    bucket = tagging_scheduler.TokenBucket(rate=20, burst=3)
+    assert _timed(bucket.acquire, 3) < 0.05
+    # the bucket is empty: each request now waits for a token to refill
+    assert _timed(bucket.acquire, 4) >= 0.15
+    time.sleep(0.1)
+    assert _timed(bucket.acquire, 2) < 0.05
+
+
+def test_token_bucket_pauses_on_retry_after():
+    bucket = tagging_scheduler.TokenBucket(rate=100)
+    bucket.throttled(retry_after=0.3)
+    assert _timed(bucket.acquire, 1) >= 0.3
+
+
+def test_token_bucket_cuts_the_rate_and_recovers(monkeypatch):
+    bucket = tagging_scheduler.TokenBucket(rate=1000, min_rate=200)
+    bucket.throttled()
+    assert bucket.rate == 500
+    # 429s right after the first one don't cut the rate again
+    bucket.throttled()
+    assert bucket.rate == 500
+
+    monkeypatch.setattr(tagging_scheduler, '_throttleCooldown', 0)
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.rate == 200
+
+    # every request granted wins back 2% of the configured rate
+    bucket.acquire()
+    assert bucket.rate == 220
+    _timed(bucket.acquire, 50)
+    assert bucket.rate == 1000
+
+
+def _batches(count):
+    return [make_batch(random_populators(20, seed=seed)) for seed in range(count)]
+
+
+def test_jobs_run_in_priority_order(server):
+    finished = []
+    with tagging.Client('test@example.com', 'token', base_url=server.url) as client:
+        scheduler = tagging_scheduler.SubmissionScheduler(client, max_concurrent=1)
+        batches = _batches(4)
+        low = scheduler.add_populator_batch('c_low', batches[0])
+        first_high = scheduler.add_populator_batch('c_first_high', batches[1], priority=2)
+        tags = scheduler.add_tag_batch(batches[2], priority=1)
+        second_high = scheduler.add_populator_batch('c_second_high', batches[3], priority=2)
+        jobs = scheduler.run(callback=finished.append)
+
+    assert jobs == [low, first_high, tags, second_high]
+    assert finished == [first_high, second_high, tags, low]
+    assert all(job.error is None and job.guid is not None for job in jobs)
+    assert server.tags() == expected_state(random_populators(20, seed=2))
+
+
+def test_failed_jobs_do_not_stop_the_others(server):
+    server.inject(500, 1)
+    with tagging.Client('test@example.com', 'token', base_url=server.url, max_retries=0) as client:
+        scheduler = tagging_scheduler.SubmissionScheduler(client, max_concurrent=1)
+        batches = _batches(3)
+        jobs = [scheduler.add_populator_batch('c_%d' % i, batch, priority=-i) for i, batch in enumerate(batches)]
+        scheduler.run()
+
+    assert jobs[0].guid is None
+    assert jobs[0].error.response.status_code == 500
+    for i, job in enumerate(jobs[1:], 1):
+        assert job.error is None
+        assert server.populators('c_%d' % i) == expected_state(random_populators(20, seed=i))
+    assert scheduler.run() == []
+
+
+def test_scheduler_stays_under_the_server_rate_limit():
+    limiter = tagging_scheduler.TokenBucket(rate=20)
+    with tagging_testserver.BatchServer(rate_limit=4) as server, \
+            tagging.Client('test@example.com', 'token', base_url=server.url, rate_limiter=limiter) as client:
+        scheduler = tagging_scheduler.SubmissionScheduler(client, max_concurrent=3)
+        jobs = [scheduler.add_populator_batch('c_%d' % i, batch) for i, batch in enumerate(_batches(6))]
+        scheduler.run()
+
+        assert all(job.error is None for job in jobs)
+        assert server.stats()['status_429'] > 0
+        assert limiter.rate < 20
+        for i in range(len(jobs)):
+            assert server.populators('c_%d' % i) == expected_state(random_populators(20, seed=i))
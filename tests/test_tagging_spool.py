@@ -0,0 +1,129 @@
+import pytest
+import requests
+
+from kentikapi.v5 import tagging
+
+from conftest import expected_state, FailAfter, make_batch, random_populators
+
+
+def _client(server, **kwargs):
+    return tagging.Client('test@example.com', 'token', base_url=server.url,
+                          part_size=tagging.PartSizePolicy(20000, 20000), **kwargs)
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'deflate'])
+def test_spool_round_trip(server, tmp_path, compression):
+    path = str(tmp_path / 'c_spooled.spool')
+    populators = random_populators(2000)
+    batch = make_batch(populators)
+    part_count = batch.write_spool(path, 20000, compression=compression)
+    assert part_count > 1
+
+    with tagging.BatchSpool(path) as spool:
+        assert len(spool) == part_count
+        assert spool.replace_all is True
+        assert spool.compression == compression
+        assert max(spool.part_sizes()) <= 20000
+        with _client(server) as client:
+            guid = client.submit_populator_spool('c_spooled', spool)
+            # a spool can be uploaded again
+            tag_guid = client.submit_tag_spool(spool)
+
+    assert server.batch(guid)['parts'] == part_count
+    assert server.batch(tag_guid)['complete']
+    assert server.populators('c_spooled') == expected_state(populators)
+    assert server.tags() == expected_state(populators)
+
+
+def test_corrupt_spool_part_is_rejected(server, tmp_path):
+    path = str(tmp_path / 'c_spooled.spool')
+    make_batch(random_populators(2000)).write_spool(path, 20000)
+    with tagging.BatchSpool(path) as spool:
+        second_part_offset = len(tagging._spoolMagic) + spool.part_sizes()[0]
+    with open(path, 'r+b') as f:
+        f.seek(second_part_offset + 100)
+        byte = f.read(1)
+        f.seek(second_part_offset + 100)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+    with tagging.BatchSpool(path) as spool:
+        spool.get(0)
+        with pytest.raises(ValueError) as e:
+            spool.get(1)
+        assert 'part 1 is corrupt' in str(e.value)
+
+        with _client(server) as client, pytest.raises(ValueError):
+            client.submit_populator_spool('c_spooled', spool)
+    assert server.populators('c_spooled') == dict()
+
+
+def test_not_a_spool_is_rejected(tmp_path):
+    path = tmp_path / 'not.spool'
+    path.write_bytes(b'{"replace_all": true}' * 10)
+    with pytest.raises(ValueError):
+        tagging.BatchSpool(str(path))
+
+
+def _fail_submission(server, checkpoint_path, submit):
+    with _client(server, max_retries=0, instrumentation=FailAfter(server, 3)) as client, \
+            pytest.raises(requests.HTTPError):
+        submit(client, tagging.SubmissionCheckpoint.load(checkpoint_path))
+    return tagging.SubmissionCheckpoint.load(checkpoint_path)
+
+
+def test_spool_submission_resumes_from_memory(server, tmp_path):
+    spool_path = str(tmp_path / 'c_spooled.spool')
+    checkpoint_path = str(tmp_path / 'c_spooled.checkpoint')
+    populators = random_populators(2000)
+    batch = make_batch(populators)
+    part_count = batch.write_spool(spool_path, 20000)
+
+    with tagging.BatchSpool(spool_path) as spool:
+        failed = _fail_submission(server, checkpoint_path,
+                                  lambda client, checkpoint: client.submit_populator_spool('c_spooled', spool,
+                                                                                           checkpoint))
+    assert failed.parts_acked == 3
+
+    with _client(server) as client:
+        guid = client.submit_populator_batch('c_spooled', batch, tagging.SubmissionCheckpoint.load(checkpoint_path))
+
+    assert guid == failed.guid
+    assert server.stats()['parts_accepted'] == part_count
+    assert server.populators('c_spooled') == expected_state(populators)
+
+
+def test_memory_submission_resumes_from_spool(server, tmp_path):
+    spool_path = str(tmp_path / 'c_spooled.spool')
+    checkpoint_path = str(tmp_path / 'c_spooled.checkpoint')
+    populators = random_populators(2000)
+    batch = make_batch(populators)
+    part_count = batch.write_spool(spool_path, 20000)
+
+    failed = _fail_submission(server, checkpoint_path,
+                              lambda client, checkpoint: client.submit_populator_batch('c_spooled', batch, checkpoint))
+    with tagging.BatchSpool(spool_path) as spool, _client(server) as client:
+        guid = client.submit_populator_spool('c_spooled', spool, tagging.SubmissionCheckpoint.load(checkpoint_path))
+
+    assert guid == failed.guid
+    assert server.stats()['parts_accepted'] == part_count
+    assert server.populators('c_spooled') == expected_state(populators)
+
+
+def test_checkpoint_does_not_resume_a_different_spool(server, tmp_path):
+    checkpoint_path = str(tmp_path / 'c_spooled.checkpoint')
+    make_batch(random_populators(2000, seed=1)).write_spool(str(tmp_path / 'first.spool'), 20000)
+    populators = random_populators(2000, seed=2)
+    part_count = make_batch(populators).write_spool(str(tmp_path / 'second.spool'), 20000)
+
+    with tagging.BatchSpool(str(tmp_path / 'first.spool')) as spool:
+        failed = _fail_submission(server, checkpoint_path,
+                                  lambda client, checkpoint: client.submit_populator_spool('c_spooled', spool,
+                                                                                           checkpoint))
+    with tagging.BatchSpool(str(tmp_path / 'second.spool')) as spool, _client(server) as client:
+        checkpoint = tagging.SubmissionCheckpoint.load(checkpoint_path)
+        assert checkpoint.fingerprint != spool.fingerprint
+        guid = client.submit_populator_spool('c_spooled', spool, checkpoint)
+
+    assert guid != failed.guid
+    assert server.batch(guid)['parts'] == part_count
+    assert server.populators('c_spooled') == expected_state(populators)
@@ -0,0 +1,67 @@
+import pytest
+
+from kentikapi.v5 import tagging, tagging_cli, tagging_testserver
+
+from conftest import expected_state, random_populators
+
+
+def _stream(client, rows):
+    with client.stream_populator_batch('c_streamed', True, max_upload_size=30000) as batch:
+        for value, criteria in rows:
+            batch.add_upsert(value, criteria)
+    return batch
+
+
+def _sorted_state(state):
+    return dict((value, sorted(criteria_list, key=lambda criteria: sorted(criteria.items())))
+                for value, criteria_list in state.items())
+
+
+def _interleaved_rows(populators, group_size):
+    """Return (value, criteria) rows taking one criteria of each value of a group of values in turn"""
+    rows = []
+    for start in range(0, len(populators), group_size):
+        group = populators[start:start + group_size]
+        for i in range(max(len(criteria_list) for _, criteria_list in group)):
+            rows.extend((value, criteria_list[i]) for value, criteria_list in group if i < len(criteria_list))
+    return rows
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_interleaved_values_are_regrouped(compression):
+    populators = [(value, criteria_list * 5) for value, criteria_list in random_populators(1000)]
+    # the server merges a value's upserts, so criteria would only be missing if the client dropped them
+    with tagging_testserver.BatchServer(merge_upserts=True) as server:
+        with tagging.Client('test@example.com', 'token', base_url=server.url, compression=compression) as client:
+            grouped = _stream(client, [(value, criteria) for value, criteria_list in populators
+                                       for criteria in criteria_list])
+            interleaved = _stream(client, _interleaved_rows(populators, 10))
+        stats = server.stats()
+
+        assert _sorted_state(server.populators('c_streamed')) == _sorted_state(expected_state(populators))
+    assert grouped.values_regrouped == 0
+    assert interleaved.values_regrouped > 1000
+    assert interleaved.parts_sent <= grouped.parts_sent + 1
+    assert stats['parts_accepted'] == grouped.parts_sent + interleaved.parts_sent
+
+
+def test_upsert_without_room_for_more_criteria_moves_to_the_next_part(server):
+    criteria = [c for _, criteria_list in random_populators(300, seed=6) for c in criteria_list]
+    rows = [('A', c) for c in criteria[:150]] + [('B', c) for c in criteria[250:350]] + \
+        [('A', c) for c in criteria[150:250]]
+    with tagging.Client('test@example.com', 'token', base_url=server.url) as client:
+        batch = _stream(client, rows)
+
+    assert batch.values_regrouped == 1
+    assert batch.parts_sent == 2
+    assert server.populators('c_streamed') == expected_state([('A', criteria[:250]), ('B', criteria[250:350])])
+
+
+def test_push_warns_about_ungrouped_input(tmp_path, capsys):
+    path = tmp_path / 'populators.csv'
+    path.write_text('value,direction,addr\nweb,src,10.0.0.1\ndb,src,10.0.0.2\nweb,src,10.0.0.3\n')
+    assert tagging_cli.main(['push', '--dimension', 'c_pushed', '--dry-run', '--progress', '0', str(path)]) == 0
+
+    err = capsys.readouterr().err
+    assert "line 4: the input isn't grouped by value" in err
+    assert '1 values came back after other values' in err
@@ -0,0 +1,189 @@
+import os
+
+import pytest
+import requests
+
+from kentikapi.v5 import tagging, tagging_testserver
+
+from conftest import expected_state, FailAfter, make_batch, random_populators
+
+
+def fixed_size(size):
+    return tagging.PartSizePolicy(max_size=size, min_size=size)
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'deflate'])
+@pytest.mark.parametrize('max_in_flight', [1, 4])
+def test_round_trip(server, compression, max_in_flight):
+    populators = random_populators(3000)
+    client = tagging.Client('test@example.com', 'token', base_url=server.url, compression=compression,
+                            max_in_flight=max_in_flight, part_size=fixed_size(60000))
+    with client:
+        guid = client.submit_populator_batch('c_round_trip', make_batch(populators))
+        tag_guid = client.submit_tag_batch(make_batch(populators))
+
+    assert server.populators('c_round_trip') == expected_state(populators)
+    assert server.tags() == expected_state(populators)
+    assert server.batch(guid)['complete']
+    assert server.batch(guid)['parts'] > 1
+    assert server.batch(tag_guid)['complete']
+
+
+def test_deletes_round_trip(server):
+    populators = random_populators(100)
+    with tagging.Client('test@example.com', 'token', base_url=server.url) as client:
+        client.submit_populator_batch('c_deletes', make_batch(populators))
+        batch = tagging.Batch(False)
+        for value, _ in populators[:10]:
+            batch.add_delete(value)
+        client.submit_populator_batch('c_deletes', batch)
+
+    assert server.populators('c_deletes') == expected_state(populators[10:])
+
+
+def test_parts_stay_under_the_size_limit():
+    batch = make_batch(random_populators(5000))
+    for compression in (None, 'gzip'):
+        parts = batch.parts(50000, compression=compression)
+        assert len(parts) > 1
+        for part in parts:
+            assert part.json_size() == len(part.build_json('x' * tagging.BatchPart.guid_size))
+            assert part.packed_size <= 50000
+            body = tagging._SerializedPart(part, compression).request('x' * tagging.BatchPart.guid_size)[1]
+            assert len(body) <= 50000
+
+
+def test_too_big_parts_are_resplit():
+    populators = random_populators(3000)
+    with tagging_testserver.BatchServer(max_body_size=100000) as server:
+        policy = tagging.PartSizePolicy(max_size=300000, min_size=20000)
+        with tagging.Client('test@example.com', 'token', base_url=server.url, part_size=policy) as client:
+            client.submit_populator_batch('c_resplit', make_batch(populators))
+        stats = server.stats()
+
+    assert stats['status_413'] >= 1
+    assert policy.size <= 100000
+    assert server.populators('c_resplit') == expected_state(populators)
+
+
+def test_transient_errors_are_retried():
+    populators = random_populators(500)
+    with tagging_testserver.BatchServer(error_rate=0.2, throttle_rate=0.1, retry_after=0, seed=3) as server:
+        client = tagging.Client('test@example.com', 'token', base_url=server.url, max_retries=10,
+                                backoff_factor=0.001, part_size=fixed_size(20000))
+        with client:
+            client.submit_populator_batch('c_retried', make_batch(populators))
+        stats = server.stats()
+
+    assert stats['requests'] > stats['parts_accepted']
+    assert server.populators('c_retried') == expected_state(populators)
+
+
+def _submit_until_failure(server, batch, checkpoint_path, parts):
+    client = tagging.Client('test@example.com', 'token', base_url=server.url, max_retries=0,
+                            part_size=fixed_size(20000), instrumentation=FailAfter(server, parts))
+    with client, pytest.raises(requests.HTTPError):
+        client.submit_populator_batch('c_resumed', batch, checkpoint=tagging.SubmissionCheckpoint.load(checkpoint_path))
+
+
+def test_checkpoint_resumes_a_failed_submission(server, tmp_path):
+    path = str(tmp_path / 'c_resumed.checkpoint')
+    populators = random_populators(2000)
+    batch = make_batch(populators)
+    part_count = len(batch.parts(20000))
+    _submit_until_failure(server, batch, path, 3)
+    assert os.path.exists(path)
+    assert server.populators('c_resumed') == dict()
+
+    with tagging.Client('test@example.com', 'token', base_url=server.url, part_size=fixed_size(20000)) as client:
+        guid = client.submit_populator_batch('c_resumed', batch, checkpoint=tagging.SubmissionCheckpoint.load(path))
+
+    assert not os.path.exists(path)
+    assert server.batch(guid)['parts'] == part_count
+    assert server.stats()['parts_accepted'] == part_count
+    assert server.populators('c_resumed') == expected_state(populators)
+
+
+def test_checkpoint_does_not_resume_a_different_batch(server, tmp_path):
+    path = str(tmp_path / 'c_resumed.checkpoint')
+    populators = random_populators(2000)
+    _submit_until_failure(server, make_batch(populators), path, 3)
+    failed_guid = tagging.SubmissionCheckpoint.load(path).guid
+
+    # the same values and parts, with other addresses of the same length
+    changed = [(value, [tagging.Criteria.from_dict(dict(criteria.to_dict(),
+                                                        addr=[a.replace('10.', '11.', 1) for a in
+                                                              criteria.to_dict()['addr']]))
+                        for criteria in criteria_list])
+               for value, criteria_list in populators]
+    batch = make_batch(changed)
+    assert [part.json_size() for part in batch.parts(20000)] == \
+        [part.json_size() for part in make_batch(populators).parts(20000)]
+
+    with tagging.Client('test@example.com', 'token', base_url=server.url, part_size=fixed_size(20000)) as client:
+        guid = client.submit_populator_batch('c_resumed', batch, checkpoint=tagging.SubmissionCheckpoint.load(path))
+
+    assert guid != failed_guid
+    assert server.batch(guid)['parts'] == len(batch.parts(20000))
+    assert server.populators('c_resumed') == expected_state(changed)
+
+
+def _big_value_populators():
+    """Return populators with one value that has too many criteria for a part of 20000 bytes"""
+    populators = random_populators(200)
+    criteria_list = []
+    for i in range(1000):
+        criteria = tagging.Criteria('src')
+        criteria.add_ip_address('10.1.%d.%d' % (i // 256, i % 256))
+        criteria_list.append(criteria)
+    populators.append(('Big', criteria_list))
+    return populators
+
+
+def _sorted_state(state):
+    return dict((value, sorted(criteria_list, key=lambda criteria: sorted(criteria.items())))
+                for value, criteria_list in state.items())
+
+
+def test_values_too_big_for_a_part_are_not_split_by_default(server):
+    batch = make_batch(_big_value_populators())
+    with pytest.raises(ValueError):
+        batch.parts(20000)
+
+    with tagging.Client('test@example.com', 'token', base_url=server.url, part_size=fixed_size(20000)) as client:
+        with pytest.raises(ValueError):
+            client.submit_populator_batch('c_big', batch)
+        with pytest.raises(ValueError):
+            with client.stream_populator_batch('c_big', True) as streaming_batch:
+                for value, criteria_list in _big_value_populators():
+                    for criteria in criteria_list:
+                        streaming_batch.add_upsert(value, criteria)
+    assert server.populators('c_big') == dict()
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_split_values_round_trip(streaming):
+    populators = _big_value_populators()
+    with tagging_testserver.BatchServer(merge_upserts=True) as server:
+        client = tagging.Client('test@example.com', 'token', base_url=server.url, part_size=fixed_size(20000),
+                                split_values=True)
+        with client:
+            if streaming:
+                with client.stream_populator_batch('c_big', True) as batch:
+                    for value, criteria_list in populators:
+                        for criteria in criteria_list:
+                            batch.add_upsert(value, criteria)
+            else:
+                client.submit_populator_batch('c_big', make_batch(populators))
+
+        assert _sorted_state(server.populators('c_big')) == _sorted_state(expected_state(populators))
+
+
+def test_last_upsert_of_a_value_wins_without_merge_upserts(server):
+    populators = _big_value_populators()
+    client = tagging.Client('test@example.com', 'token', base_url=server.url, part_size=fixed_size(20000),
+                            split_values=True)
+    with client:
+        client.submit_populator_batch('c_big', make_batch(populators))
+
+    assert 0 < len(server.populators('c_big')['Big']) < 1000
@@ -0,0 +1,98 @@
+import pytest
+
+from kentikapi.v5 import tagging
+
+
+def _criteria(**values):
+    criteria = tagging.Criteria('src')
+    for method, value_list in values.items():
+        for value in value_list:
+            getattr(criteria, method)(value)
+    return criteria
+
+
+@pytest.mark.parametrize('method, value', [
+    ('add_ip_address', '10.0.0.1'),
+    ('add_ip_address', '10.0.0.0/8'),
+    ('add_ip_address', '2001:db8::1'),
+    ('add_ip_address', '2001:DB8::/32'),
+    ('add_next_hop_ip_address', '192.168.1.1'),
+    ('add_mac_address', '00:1a:2B:3c:4d:5e'),
+    ('add_mac_address', '00-1a-2b-3c-4d-5e'),
+    ('add_mac_address', '001a.2b3c.4d5e'),
+    ('add_country_code', 'US'),
+    ('add_bgp_as_path', '^3737 1212'),
+    ('add_bgp_as_path', '_7018_'),
+    ('add_bgp_community', '2096:2212'),
+])
+def test_valid_values(method, value):
+    assert _criteria(**{method: [value]}).invalid_values() == []
+
+
+@pytest.mark.parametrize('method, value, name', [
+    ('add_ip_address', 'not-an-ip', 'ip_address'),
+    ('add_ip_address', '10.0.0.256', 'ip_address'),
+    ('add_ip_address', '10.0.0.0/33', 'ip_address'),
+    ('add_next_hop_ip_address', 'abcdefg', 'next_hop_ip_address'),
+    ('add_mac_address', '00:1a:2b:3c:4d', 'mac_address'),
+    ('add_mac_address', '00:1a-2b:3c:4d:5e', 'mac_address'),
+    ('add_country_code', 'USA', 'country_code'),
+    ('add_bgp_as_path', '3737 abc', 'bgp_as_path'),
+    ('add_bgp_as_path', '(3737', 'bgp_as_path'),
+    ('add_bgp_community', '2096:x', 'bgp_community'),
+])
+def test_invalid_values(method, value, name):
+    assert _criteria(**{method: [value]}).invalid_values() == [(name, value)]
+
+
+def test_invalid_values_lists_each_one():
+    criteria = _criteria(add_ip_address=['10.0.0.1', 'bad', 'worse'], add_country_code=['US', 'XYZ'])
+    assert sorted(criteria.invalid_values()) == [('country_code', 'XYZ'), ('ip_address', 'bad'),
+                                                 ('ip_address', 'worse')]
+
+
+def test_no_validation_by_default():
+    batch = tagging.Batch(True)
+    batch.add_upsert('value', _criteria(add_ip_address=['bad']))
+    assert len(batch.parts()[0].upserts) == 1
+    assert batch.validation_errors == dict()
+
+
+def test_strict_validation_raises():
+    batch = tagging.Batch(True, validation='strict')
+    batch.add_upsert('good', _criteria(add_ip_address=['10.0.0.1']))
+    with pytest.raises(ValueError, match='bad'):
+        batch.add_upsert('bad value', _criteria(add_ip_address=['bad']))
+    assert [upsert for part in batch.parts() for upsert in part.upserts] == \
+        [b'{"value": "good", "criteria": [{"direction": "src", "addr": ["10.0.0.1"]}]}']
+
+
+def test_lenient_validation_skips_and_records():
+    batch = tagging.Batch(True, validation='lenient')
+    batch.add_upsert('mixed', _criteria(add_ip_address=['10.0.0.1']))
+    batch.add_upsert('mixed', _criteria(add_ip_address=['bad'], add_mac_address=['zz']))
+    batch.add_upsert('only bad', _criteria(add_country_code=['USA']))
+    assert batch.validation_errors == {
+        'mixed': ['Invalid ip_address "bad".', 'Invalid mac_address "zz".'],
+        'only bad': ['Invalid country_code "USA".'],
+    }
+    upserts = [upsert for part in batch.parts() for upsert in part.upserts]
+    assert upserts == [b'{"value": "mixed", "criteria": [{"direction": "src", "addr": ["10.0.0.1"]}]}']
+
+
+def test_invalid_validation_mode():
+    with pytest.raises(ValueError):
+        tagging.Batch(True, validation='sometimes')
+
+
+def test_streaming_batch_validation(server):
+    with tagging.Client('test@example.com', 'token', base_url=server.url) as client:
+        with client.stream_populator_batch('c_validated', True, validation='lenient') as lenient:
+            lenient.add_upsert('good', _criteria(add_ip_address=['10.0.0.1']))
+            lenient.add_upsert('bad', _criteria(add_ip_address=['10.0.0.300']))
+        with pytest.raises(ValueError):
+            with client.stream_populator_batch('c_validated', True, validation='strict') as strict:
+                strict.add_upsert('bad', _criteria(add_ip_address=['10.0.0.300']))
+
+    assert lenient.validation_errors == {'bad': ['Invalid ip_address "10.0.0.300".']}
+    assert server.populators('c_validated') == {'good': [{'direction': 'src', 'addr': ['10.0.0.1']}]}
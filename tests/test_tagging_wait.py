@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+import pytest
+
+from kentikapi.v5 import tagging, tagging_testserver
+
+from conftest import make_batch, random_populators
+
+
+_pollMin = 0.05
+_pollMax = 0.1
+
+
+@pytest.fixture
+def slow_server():
+    with tagging_testserver.BatchServer(processing_time=0.5) as server:
+        yield server
+
+
+def _submit_staggered(server):
+    """Submit three tag batches 0.2s apart, returning their guids in the order they were submitted"""
+    guids = []
+    with tagging.Client('test@example.com', 'token', base_url=server.url) as client:
+        for seed in range(3):
+            if len(guids) > 0:
+                time.sleep(0.2)
+            guids.append(client.submit_tag_batch(make_batch(random_populators(20, seed=seed))))
+    return guids
+
+
+def test_batches_are_yielded_as_they_finish(slow_server):
+    guids = _submit_staggered(slow_server)
+    with tagging.Client('test@example.com', 'token', base_url=slow_server.url) as client:
+        finished = [batch_response.guid for batch_response in
+                    client.iter_finished_batches(list(reversed(guids)), poll_min=_pollMin, poll_max=_pollMax)]
+    assert finished == guids
+
+
+def test_wait_for_batches_calls_back_as_they_finish(slow_server):
+    guids = _submit_staggered(slow_server)
+    finished = []
+    with tagging.Client('test@example.com', 'token', base_url=slow_server.url) as client:
+        batch_responses = client.wait_for_batches(list(reversed(guids)), callback=finished.append,
+                                                  poll_min=_pollMin, poll_max=_pollMax)
+
+    assert [batch_response.guid for batch_response in finished] == guids
+    # the result is in the order of the guids asked for, not of finishing
+    assert [batch_response.guid for batch_response in batch_responses] == list(reversed(guids))
+    assert all(batch_response.is_finished() for batch_response in batch_responses)
+
+
+def test_wait_for_batches_times_out():
+    with tagging_testserver.BatchServer(processing_time=60) as server:
+        guids = _submit_staggered(server)
+        with tagging.Client('test@example.com', 'token', base_url=server.url) as client:
+            with pytest.raises(TimeoutError):
+                client.wait_for_batches(guids, timeout=0.3, poll_min=_pollMin, poll_max=_pollMax)
+
+
+def test_async_batches_are_yielded_as_they_finish(slow_server):
+    tagging_async = pytest.importorskip('kentikapi.v5.tagging_async')
+    guids = _submit_staggered(slow_server)
+
+    async def wait():
+        async with tagging_async.AsyncClient('test@example.com', 'token', base_url=slow_server.url) as client:
+            return [batch_response.guid async for batch_response in
+                    client.iter_finished_batches(list(reversed(guids)), poll_min=_pollMin, poll_max=_pollMax)]
+
+    assert asyncio.run(wait()) == guids
+
+
+def test_async_wait_for_batches_calls_back_as_they_finish(slow_server):
+    tagging_async = pytest.importorskip('kentikapi.v5.tagging_async')
+    guids = _submit_staggered(slow_server)
+    finished = []
+
+    async def wait():
+        async with tagging_async.AsyncClient('test@example.com', 'token', base_url=slow_server.url) as client:
+            return await client.wait_for_batches(list(reversed(guids)), callback=finished.append,
+                                                 poll_min=_pollMin, poll_max=_pollMax)
+
+    batch_responses = asyncio.run(wait())
+    assert [batch_response.guid for batch_response in finished] == guids
+    assert [batch_response.guid for batch_response in batch_responses] == list(reversed(guids))
+
+
+def test_async_wait_for_batches_times_out():
+    tagging_async = pytest.importorskip('kentikapi.v5.tagging_async')
+    with tagging_testserver.BatchServer(processing_time=60) as server:
+        guids = _submit_staggered(server)
+
+        async def wait():
+            async with tagging_async.AsyncClient('test@example.com', 'token', base_url=server.url) as client:
+                await client.wait_for_batches(guids, timeout=0.3, poll_min=_pollMin, poll_max=_pollMax)
+
+        with pytest.raises(TimeoutError):
+            asyncio.run(wait())